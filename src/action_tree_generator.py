@@ -4,9 +4,12 @@
 import json
 import time
 import requests
-from typing import Union, Dict, Any
+from typing import Union, Dict, Any, Optional
 import os
 
+from llm_cache import LLMResponseCache
+from llm_transport import get_transport
+
 class ActionTreeGenerator:
     """
     Класс для вызова OpenRouter/DeepSeek и получения JSON‑ответа
@@ -29,6 +32,9 @@ class ActionTreeGenerator:
         api_key: str,
         model: str = "x-ai/grok-4.1-fast:free",
         base_url: str = "https://openrouter.ai/api/v1/chat/completions",
+        cache: Optional[LLMResponseCache] = None,
+        read_timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
     ) -> None:
         """
         Инициализация генератора.
@@ -37,10 +43,16 @@ class ActionTreeGenerator:
             api_key: OpenRouter API ключ (str)
             model: Название модели для использования (str)
             base_url: URL OpenRouter API (str)
+            cache: Кэш ответов LLM (Optional[LLMResponseCache])
+            read_timeout: Таймаут ответа, сек; None — из настроек транспорта (Optional[float])
+            connect_timeout: Таймаут соединения, сек; None — из настроек транспорта (Optional[float])
         """
+        self.read_timeout: Optional[float] = read_timeout
+        self.connect_timeout: Optional[float] = connect_timeout
         self.model: str = model
         self.api_key: str = api_key
         self.base_url: str = base_url
+        self.cache: Optional[LLMResponseCache] = cache
 
     # ---------- Вспомогательные методы (приватные) ----------
 
@@ -141,7 +153,8 @@ class ActionTreeGenerator:
             Текстовое содержимое ответа от модели (str)
             
         Raises:
-            RuntimeError: Если API вернул ошибку (включая 429 rate limit)
+            RuntimeError: Если API вернул ошибку (включая 429 rate limit после повторов)
+            llm_resilience.CircuitOpenError: Если провайдер временно отключён circuit breaker'ом
             requests.HTTPError: При HTTP ошибке
         """
         payload: Dict[str, Any] = {
@@ -154,21 +167,15 @@ class ActionTreeGenerator:
             "Content-Type": "application/json",
         }
 
-        response: requests.Response = requests.post(
+        # Ошибки OpenRouter (включая 429 в теле ответа) проверяются и
+        # повторяются с backoff на уровне транспорта
+        data: Dict[str, Any] = get_transport().post_json(
             self.base_url,
             headers=headers,
-            json=payload,
-            timeout=120,
+            payload=payload,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
         )
-        response.raise_for_status()
-
-        data: Dict[str, Any] = response.json()
-        
-        # Проверяем ошибки от OpenRouter
-        if "error" in data:
-            error_msg: str = data["error"].get("metadata", {}).get("raw") or data["error"].get("message", "Unknown error")
-            error_code: int = data["error"].get("code", 0)
-            raise RuntimeError(f"OpenRouter API error (код {error_code}): {error_msg}")
         
         # Проверяем наличие choices
         if "choices" not in data or len(data["choices"]) == 0:
@@ -212,13 +219,21 @@ class ActionTreeGenerator:
             print("📨 Формирование запроса...")
         messages: list[Dict[str, str]] = self._build_messages(parsed_tree, system_prompt)
 
-        if verbose:
-            print("🔄 Отправка запроса к модели...")
-        start: float = time.time()
-        raw_content: str = self._make_api_call(messages)
-        elapsed: float = time.time() - start
-        if verbose:
-            print(f"⏱️  Время запроса: {elapsed:.2f} сек")
+        # temperature не передаётся в API, поэтому в ключе кэша None
+        raw_content: Optional[str] = self.cache.get(self.model, None, messages) if self.cache else None
+        from_cache: bool = raw_content is not None
+
+        if from_cache:
+            if verbose:
+                print("💾 Ответ взят из кэша")
+        else:
+            if verbose:
+                print("🔄 Отправка запроса к модели...")
+            start: float = time.time()
+            raw_content = self._make_api_call(messages)
+            elapsed: float = time.time() - start
+            if verbose:
+                print(f"⏱️  Время запроса: {elapsed:.2f} сек")
 
         if verbose:
             print("🧹 Очистка ответа...")
@@ -228,6 +243,10 @@ class ActionTreeGenerator:
             print("🔍 Парсинг JSON...")
         parsed: Dict[str, Any] = self._parse_json_with_fallback(cleaned)
 
+        # Кэшируем только ответы, которые удалось распарсить
+        if self.cache and not from_cache:
+            self.cache.put(self.model, None, messages, raw_content)
+
         if verbose:
             print("✅ Успешно!")
 
@@ -263,4 +282,5 @@ class ActionTreeGenerator:
         return {
             "model": self.model,
             "api_url": self.base_url,
+            "timeouts": str(get_transport().timeouts(self.connect_timeout, self.read_timeout)),
         }
@@ -2,21 +2,30 @@
 
 import json
 import os
-import sys
 import logging
 import sqlite3
 from datetime import datetime
 from contextlib import contextmanager
-import subprocess
 import argparse
-from typing import Dict, Any, List, Optional, Union
+import hashlib
+from typing import Dict, Any, List, Optional, Tuple, Union
 import uuid
 
 from peewee import (
     Model, SqliteDatabase, AutoField, TextField, IntegerField
 )
 from action_tree_generator import ActionTreeGenerator
+from crawler import (
+    SiteCrawler, CRAWL_MAX_PAGES, CRAWL_MAX_DEPTH, CRAWL_CONCURRENCY, CRAWL_PER_HOST_LIMIT, CRAWL_TIMEOUT
+)
+from dom_compactor import DOMCompactor
+from dom_extractor import DOMExtractor, DOM_EXTRACT_WORKERS
 from intent_extracter import process_instructions_pipeline
+from llm_cache import LLMResponseCache
+from llm_transport import configure_transport, LLM_POOL_SIZE, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT
+from llm_resilience import LLMResilience, LLM_MAX_RETRIES, LLM_RETRY_DEADLINE
+from page_store import PageStore
+from tree_sharding import ShardedTreeGenerator, TREE_SHARD_MAX_CHARS
 
 from dotenv import load_dotenv  # pip install python-dotenv
 
@@ -32,9 +41,19 @@ logger = logging.getLogger(__name__)
 # Конфигурация базы данных
 DATABASE_PATH: str = "ai_assistant.db"
 
+# SQLite в режиме WAL: API продолжает читать, пока анализатор пишет;
+# ожидание блокировки записи (мс), если API в этот момент пишет сам
+SQLITE_BUSY_TIMEOUT: int = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+
 # Конфигурация API
 DEEPSEEK_API_URL: str = "https://api.deepseek.com/v1/chat/completions"
 
+# Файл кэша ответов LLM (создаётся рядом с БД)
+LLM_CACHE_FILENAME: str = "llm_cache.db"
+
+# Файл снимков скачанных страниц для условных запросов (создаётся рядом с БД)
+PAGE_STORE_FILENAME: str = "page_snapshots.db"
+
 
 
 db: SqliteDatabase | None = None
@@ -47,12 +66,23 @@ class BaseModel(Model):
         database = db
 
 
+class AnalysisVersions(BaseModel):
+    id = AutoField()
+    application = TextField()
+    analyzed_at = TextField()
+    published_at = TextField(null=True)
+
+    class Meta:
+        table_name = "analysis_versions"
+
+
 class TasksTrees(BaseModel):
     id = AutoField()
     application = TextField()
     analyzed_at = TextField()
     tasks_json = TextField()
     created_at = TextField()  # TEXT DEFAULT CURRENT_TIMESTAMP
+    version_id = IntegerField(null=True)  # индекс создаётся в _migrate_unversioned_rows
 
     class Meta:
         table_name = "tasks_trees"
@@ -64,6 +94,7 @@ class InstructionsIntents(BaseModel):
     analyzed_at = TextField()
     instructions = TextField()
     created_at = TextField()
+    version_id = IntegerField(null=True)  # индекс создаётся в _migrate_unversioned_rows
 
     class Meta:
         table_name = "instructions_intents"
@@ -75,7 +106,8 @@ class Instructions(BaseModel):
     task_data_json = TextField(null=True)
     steps_json = TextField()
     user_query = TextField(null=True)
-    context_json = TextField(null=True)
+    context_json = TextField(null=True)  # устаревшее: контекст теперь в context_blobs
+    context_hash = TextField(null=True)
     timestamp = TextField()
     usage_count = IntegerField(default=0)
     last_used = TextField(null=True)
@@ -84,11 +116,22 @@ class Instructions(BaseModel):
     dislikes = IntegerField(default=0)
     created_at = TextField()
     updated_at = TextField()
+    version_id = IntegerField(null=True)  # индекс создаётся в _migrate_unversioned_rows
 
     class Meta:
         table_name = "instructions"
 
 
+class ContextBlobs(BaseModel):
+    hash = TextField(primary_key=True)  # sha256 канонического JSON
+    data = TextField()
+    size = IntegerField()
+    created_at = TextField()
+
+    class Meta:
+        table_name = "context_blobs"
+
+
 class InstructionRatings(BaseModel):
     id = AutoField()
     instruction_id = TextField()
@@ -123,6 +166,21 @@ class ChatHistory(BaseModel):
         table_name = "chat_history"
 
 
+# Таблицы, строки которых принадлежат версии анализа
+VERSIONED_MODELS = [TasksTrees, InstructionsIntents, Instructions]
+
+ALL_MODELS = [
+    AnalysisVersions,
+    TasksTrees,
+    InstructionsIntents,
+    Instructions,
+    ContextBlobs,
+    InstructionRatings,
+    UserSessions,
+    ChatHistory,
+]
+
+
 # ---------- DatabaseManager на Peewee ----------
 
 class DatabaseManager:
@@ -137,7 +195,13 @@ class DatabaseManager:
         self.db_path: str = db_path
 
         # инициализируем peewee-базу
-        db = SqliteDatabase(self.db_path, pragmas={"foreign_keys": 1})
+        db = SqliteDatabase(self.db_path, pragmas=[
+            ("journal_mode", "wal"),
+            ("busy_timeout", SQLITE_BUSY_TIMEOUT),
+            ("foreign_keys", 1),
+        ])
+        # модели объявлены до создания БД, поэтому привязываем их явно
+        db.bind(ALL_MODELS)
         db.connect(reuse_if_open=True)
 
         self.init_database()
@@ -164,17 +228,13 @@ class DatabaseManager:
         """Инициализация структуры базы данных"""
 
         # создаём таблицы, если их нет
-        db.create_tables(
-            [
-                TasksTrees,
-                InstructionsIntents,
-                Instructions,
-                InstructionRatings,
-                UserSessions,
-                ChatHistory,
-            ],
-            safe=True,
-        )
+        db.create_tables(ALL_MODELS, safe=True)
+
+        instruction_columns = {c.name for c in db.get_columns("instructions")}
+        if "context_hash" not in instruction_columns:
+            db.execute_sql("ALTER TABLE instructions ADD COLUMN context_hash TEXT")
+        self._migrate_inline_contexts()
+        self._migrate_unversioned_rows()
 
         # индексы (peewee не знает о них, поэтому создаём сырыми запросами один раз)
         db.execute_sql(
@@ -190,16 +250,187 @@ class DatabaseManager:
             "CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history(session_id)"
         )
 
+        self._init_fulltext_index()
+
         logger.info("Database initialized successfully")
 
+    @staticmethod
+    def _canonical_context(context: Any) -> str:
+        """Канонический JSON контекста: одинаковые данные дают одинаковый хэш"""
+        return json.dumps(context, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    def _store_context_json(self, data: str) -> str:
+        """Сохраняет канонический JSON в context_blobs и возвращает его хэш"""
+        blob_hash: str = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        ContextBlobs.insert(
+            hash=blob_hash,
+            data=data,
+            size=len(data),
+            created_at=datetime.now().isoformat(),
+        ).on_conflict_ignore().execute()
+        return blob_hash
+
+    def save_context_blob(self, context: Dict[str, Any]) -> str:
+        """
+        Сохранение контекста (например, dom_analysis) один раз по хэшу содержимого
+
+        Args:
+            context: Контекст (Dict[str, Any])
+
+        Returns:
+            Хэш контекста для ссылки из instructions (str)
+        """
+        return self._store_context_json(self._canonical_context(context))
+
+    def _migrate_inline_contexts(self) -> None:
+        """Переносит context_json старых строк instructions в context_blobs"""
+        inline = db.execute_sql(
+            "SELECT DISTINCT context_json FROM instructions WHERE context_json IS NOT NULL"
+        ).fetchall()
+        if not inline:
+            return
+
+        with db.atomic():
+            for (context_json,) in inline:
+                try:
+                    data: str = self._canonical_context(json.loads(context_json))
+                except json.JSONDecodeError:
+                    data = context_json
+                blob_hash: str = self._store_context_json(data)
+                db.execute_sql(
+                    "UPDATE instructions SET context_hash = ?, context_json = NULL WHERE context_json = ?",
+                    (blob_hash, context_json),
+                )
+        logger.info(f"Moved {len(inline)} inline instruction contexts to context_blobs")
+
+    def _migrate_unversioned_rows(self) -> None:
+        """
+        Добавляет version_id в таблицы, созданные до появления версий анализа;
+        строки без версии публикуются как одна версия, чтобы API их видел
+        """
+        for model in VERSIONED_MODELS:
+            table: str = model._meta.table_name
+            if "version_id" not in {c.name for c in db.get_columns(table)}:
+                db.execute_sql(f"ALTER TABLE {table} ADD COLUMN version_id INTEGER")
+            db.execute_sql(f"CREATE INDEX IF NOT EXISTS {table}_version_id ON {table}(version_id)")
+
+        if not any(model.select().where(model.version_id.is_null()).exists() for model in VERSIONED_MODELS):
+            return
+
+        latest_tree: Optional[TasksTrees] = TasksTrees.select().order_by(TasksTrees.id.desc()).first()
+        with db.atomic():
+            now_iso: str = datetime.now().isoformat()
+            version: AnalysisVersions = AnalysisVersions.create(
+                application=latest_tree.application if latest_tree else "",
+                analyzed_at=latest_tree.analyzed_at if latest_tree else now_iso,
+                published_at=now_iso,
+            )
+            for model in VERSIONED_MODELS:
+                model.update(version_id=version.id).where(model.version_id.is_null()).execute()
+        logger.info(f"Existing analysis rows published as version {version.id}")
+
+    # Значения колонок FTS для строки instructions (алиас new/old/instructions).
+    # ё приводится к е: токенайзер unicode61 не снимает с неё диакритику.
+    _FTS_COLUMNS: str = "rowid, task_id, task_name, description, user_query, steps"
+    _FTS_VALUES: str = """{row}.rowid,
+        {row}.task_id,
+        CASE WHEN json_valid({row}.task_data_json)
+             THEN replace(replace(json_extract({row}.task_data_json, '$.task_name'), 'ё', 'е'), 'Ё', 'Е') END,
+        CASE WHEN json_valid({row}.task_data_json)
+             THEN replace(replace(json_extract({row}.task_data_json, '$.description'), 'ё', 'е'), 'Ё', 'Е') END,
+        replace(replace({row}.user_query, 'ё', 'е'), 'Ё', 'Е'),
+        CASE WHEN json_valid({row}.steps_json)
+             THEN replace(replace((SELECT group_concat(value, ' ') FROM json_each({row}.steps_json)), 'ё', 'е'), 'Ё', 'Е') END"""
+
+    def _init_fulltext_index(self) -> None:
+        """
+        Полнотекстовый индекс FTS5 по инструкциям.
+
+        Индексируются только осмысленные тексты (название, описание, запрос,
+        шаги), а не сырой JSON. Триггеры держат индекс в синхронизации с
+        таблицей instructions; при расхождении индекс перестраивается.
+        """
+        db.execute_sql(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS instructions_fts USING fts5(
+                task_id, task_name, description, user_query, steps,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3 4'
+            )"""
+        )
+
+        new_values: str = self._FTS_VALUES.format(row="new")
+        db.execute_sql(
+            f"""CREATE TRIGGER IF NOT EXISTS instructions_fts_ai AFTER INSERT ON instructions BEGIN
+                INSERT INTO instructions_fts ({self._FTS_COLUMNS}) VALUES ({new_values});
+            END"""
+        )
+        db.execute_sql(
+            """CREATE TRIGGER IF NOT EXISTS instructions_fts_ad AFTER DELETE ON instructions BEGIN
+                DELETE FROM instructions_fts WHERE rowid = old.rowid;
+            END"""
+        )
+        db.execute_sql(
+            f"""CREATE TRIGGER IF NOT EXISTS instructions_fts_au
+                AFTER UPDATE OF task_id, task_data_json, steps_json, user_query ON instructions BEGIN
+                DELETE FROM instructions_fts WHERE rowid = old.rowid;
+                INSERT INTO instructions_fts ({self._FTS_COLUMNS}) VALUES ({new_values});
+            END"""
+        )
+
+        indexed: int = db.execute_sql("SELECT count(*) FROM instructions_fts").fetchone()[0]
+        total: int = db.execute_sql("SELECT count(*) FROM instructions").fetchone()[0]
+        if indexed != total:
+            logger.info(f"Rebuilding full-text index ({indexed} of {total} instructions indexed)")
+            with db.atomic():
+                db.execute_sql("DELETE FROM instructions_fts")
+                db.execute_sql(
+                    f"INSERT INTO instructions_fts ({self._FTS_COLUMNS}) "
+                    f"SELECT {self._FTS_VALUES.format(row='instructions')} FROM instructions"
+                )
+
     # ---------- те же публичные методы ----------
 
-    def save_tasks_tree(self, tasks_tree_js: Dict[str, Any]) -> None:
+    @contextmanager
+    def publish_version(self, application: str, analyzed_at: Optional[str] = None):
+        """
+        Атомарная публикация версии анализа
+
+        Всё, что записано внутри блока with с полученным version_id, коммитится
+        одной транзакцией: API видит либо предыдущую версию целиком, либо новую.
+        При ошибке транзакция откатывается и версия не появляется.
+
+        Yields:
+            id новой версии (int)
+        """
+        now_iso: str = datetime.now().isoformat()
+        with db.atomic():
+            version: AnalysisVersions = AnalysisVersions.create(
+                application=application,
+                analyzed_at=analyzed_at or now_iso,
+            )
+            yield version.id
+            version.published_at = datetime.now().isoformat()
+            version.save()
+        logger.info(f"📦 Analysis version {version.id} published")
+
+    def get_published_version(self) -> Optional[int]:
+        """id последней опубликованной версии или None"""
+        version = (
+            AnalysisVersions
+            .select(AnalysisVersions.id)
+            .where(AnalysisVersions.published_at.is_null(False))
+            .order_by(AnalysisVersions.id.desc())
+            .first()
+        )
+        return version.id if version else None
+
+    def save_tasks_tree(self, tasks_tree_js: Dict[str, Any], version_id: Optional[int] = None) -> None:
         """
         Сохранение дерева задач в БД
 
         Args:
             tasks_tree_js: Дерево задач (Dict[str, Any])
+            version_id: Версия анализа (Optional[int], см. publish_version)
         """
         application = tasks_tree_js.get("application", "EcoStore")
         analyzed_at = tasks_tree_js.get("analyzed_at", datetime.now().isoformat())
@@ -210,18 +441,20 @@ class DatabaseManager:
             analyzed_at=analyzed_at,
             tasks_json=tasks_json,
             created_at=datetime.now().isoformat(),
+            version_id=version_id,
         )
 
         logger.info(
             f"Tasks tree saved for application: {tasks_tree_js.get('application', 'EcoStore')}"
         )
 
-    def save_instructions(self, instructions_js: Dict[str, Any]) -> None:
+    def save_instructions(self, instructions_js: Dict[str, Any], version_id: Optional[int] = None) -> None:
         """
         Сохранение списка намерений в БД
 
         Args:
             instructions_js: Намерения (Dict[str, Any])
+            version_id: Версия анализа (Optional[int], см. publish_version)
         """
         application = instructions_js.get("application", "EcoStore")
         analyzed_at = instructions_js.get("analyzed_at", datetime.now().isoformat())
@@ -234,6 +467,7 @@ class DatabaseManager:
             analyzed_at=analyzed_at,
             instructions=instructions,
             created_at=datetime.now().isoformat(),
+            version_id=version_id,
         )
 
         logger.info(
@@ -249,6 +483,11 @@ class DatabaseManager:
         """
         now_iso = datetime.now().isoformat()
 
+        # Контекст хранится один раз в context_blobs, инструкция ссылается на хэш
+        context_hash: Optional[str] = instruction_data.get("context_hash")
+        if context_hash is None and instruction_data.get("context"):
+            context_hash = self.save_context_blob(instruction_data["context"])
+
         Instructions.insert(
             id=instruction_data["id"],
             task_id=instruction_data["task_id"],
@@ -259,9 +498,8 @@ class DatabaseManager:
                 instruction_data.get("steps", []), ensure_ascii=False
             ),
             user_query=instruction_data.get("user_query", ""),
-            context_json=json.dumps(
-                instruction_data.get("context", {}), ensure_ascii=False
-            ),
+            context_json=None,
+            context_hash=context_hash,
             timestamp=instruction_data["timestamp"],
             usage_count=instruction_data.get("usage_count", 0),
             last_used=instruction_data.get("last_used"),
@@ -272,6 +510,7 @@ class DatabaseManager:
             dislikes=instruction_data.get("dislikes", 0),
             created_at=now_iso,
             updated_at=now_iso,
+            version_id=instruction_data.get("version_id"),
         ).on_conflict(
             conflict_target=[Instructions.id],
             preserve=[
@@ -286,9 +525,8 @@ class DatabaseManager:
                     instruction_data.get("steps", []), ensure_ascii=False
                 ),
                 Instructions.user_query: instruction_data.get("user_query", ""),
-                Instructions.context_json: json.dumps(
-                    instruction_data.get("context", {}), ensure_ascii=False
-                ),
+                Instructions.context_json: None,
+                Instructions.context_hash: context_hash,
                 Instructions.timestamp: instruction_data["timestamp"],
                 Instructions.usage_count: instruction_data.get("usage_count", 0),
                 Instructions.last_used: instruction_data.get("last_used"),
@@ -298,6 +536,7 @@ class DatabaseManager:
                 Instructions.likes: instruction_data.get("likes", 0),
                 Instructions.dislikes: instruction_data.get("dislikes", 0),
                 Instructions.updated_at: now_iso,
+                Instructions.version_id: instruction_data.get("version_id"),
             },
         ).execute()
 
@@ -308,15 +547,30 @@ class DatabaseManager:
 class DOMAnalyzer:
     """Класс для анализа DOM структуры сайта"""
 
-    def download_and_analyze(self, urls: Optional[List[str]] = None) -> Union[Dict[str, Any], Dict[str, str]]:
+    def __init__(self, crawler: Optional[SiteCrawler] = None, extractor: Optional[DOMExtractor] = None) -> None:
+        """
+        Args:
+            crawler: Обходчик сайта (Optional[SiteCrawler], по умолчанию — настройки из окружения)
+            extractor: Разбор DOM (Optional[DOMExtractor], по умолчанию — DOM_EXTRACT_WORKERS процессов)
+        """
+        self.crawler: SiteCrawler = crawler if crawler is not None else SiteCrawler()
+        self.extractor: DOMExtractor = extractor if extractor is not None else DOMExtractor()
+
+    def download_and_analyze(
+        self,
+        urls: Optional[List[str]] = None,
+        skip_unchanged: bool = False
+    ) -> Union[Dict[str, Any], Dict[str, str]]:
         """
         Скачивание и анализ DOM структуры
         
         Args:
-            urls: Список URL для анализа (Optional[List[str]])
+            urls: Стартовые URL: список страниц или корень сайта (Optional[List[str]])
+            skip_unchanged: Не разбирать DOM, если ни одна страница не изменилась
+                с последнего анализа (нужно хранилище снимков у обходчика) (bool)
             
         Returns:
-            Dict с результатами анализа или ошибкой (Dict[str, Any])
+            Dict с результатами анализа, ошибкой или {"unchanged": True, ...} (Dict[str, Any])
         """
         if urls is None:
             urls = ["http://localhost:8000/index.html"]
@@ -324,35 +578,25 @@ class DOMAnalyzer:
         try:
             logger.info(f"Starting DOM analysis for URLs: {urls}")
 
-            # Скачиваем HTML файлы
-            download_result = subprocess.run(
-                [sys.executable, "download_html.py"],
-                capture_output=True,
-                text=True,
-                errors='replace'
-            )
-
-            if download_result.returncode != 0:
-                error_msg: str = download_result.stderr or "Unknown download error"
-                logger.error(f"Download failed: {error_msg}")
-                return {"error": f"Download failed: {error_msg}"}
-
-            # Анализируем DOM структуру
-            dom_result = subprocess.run(
-                ["node", "dom_parser.js", "temp_files.json"],
-                capture_output=True,
-                text=True,
-                errors='replace'
-            )
-
-            if dom_result.returncode != 0:
-                error_msg: str = dom_result.stderr or "Unknown DOM analysis error"
-                logger.error(f"DOM analysis failed: {error_msg}")
-                return {"error": f"DOM analysis failed: {error_msg}"}
-
-            # Читаем результат анализа
-            with open('dom_analysis.json', 'r', encoding='utf-8') as f:
-                dom_analysis: Dict[str, Any] = json.load(f)
+            pages: List[Tuple[str, str]] = [(page.url, page.text) for page in self.crawler.crawl(urls)]
+            if not pages:
+                logger.error("Download failed: no pages fetched")
+                return {"error": "Download failed: no pages fetched"}
+
+            store: Optional[PageStore] = self.crawler.store
+            if store is not None:
+                changes: Dict[str, List[str]] = store.changes()
+                logger.info(
+                    f"Page changes since last analysis: {len(changes['new'])} new, "
+                    f"{len(changes['changed'])} changed, {len(changes['removed'])} removed, "
+                    f"{len(changes['unchanged'])} unchanged, {len(changes['unreachable'])} unreachable"
+                )
+                if skip_unchanged and not store.has_changes():
+                    logger.info("⏭️ No page changed since the last analysis, skipping DOM analysis")
+                    return {"unchanged": True, "changes": changes}
+
+            # Разбор DOM в пуле процессов, результат — в памяти
+            dom_analysis: Dict[str, Any] = self.extractor.extract(pages)
 
             logger.info("DOM analysis completed successfully")
             return dom_analysis
@@ -366,20 +610,23 @@ class DOMAnalyzer:
 class DeepSeekClient:
     """Клиент для работы с DeepSeek API через ActionTreeGenerator"""
 
-    def __init__(self, api_key: str, api_url: str) -> None:
+    def __init__(self, api_key: str, api_url: str, cache: Optional[LLMResponseCache] = None) -> None:
         """
         Args:
             api_key: OpenRouter API ключ (str)
             api_url: URL для API (str) - не используется, но оставляем для совместимости
+            cache: Кэш ответов LLM (Optional[LLMResponseCache])
         """
         self.api_key: str = api_key
         self.api_url: str = api_url
-        self.gen: ActionTreeGenerator = ActionTreeGenerator(api_key=api_key)
+        self.cache: Optional[LLMResponseCache] = cache
+        self.gen: ActionTreeGenerator = ActionTreeGenerator(api_key=api_key, cache=cache)
 
     def generate_tasks_tree(
         self,
         dom_analysis: Dict[str, Any],
-        system_prompt: Optional[str] = None
+        system_prompt: Optional[str] = None,
+        sharder: Optional[ShardedTreeGenerator] = None
     ) -> Dict[str, Any]:
         """
         Генерация дерева задач на основе анализа DOM
@@ -387,6 +634,7 @@ class DeepSeekClient:
         Args:
             dom_analysis: Результат анализа DOM (Dict[str, Any])
             system_prompt: Системный промпт (Optional[str])
+            sharder: Генерация по частям для больших сайтов (Optional[ShardedTreeGenerator])
             
         Returns:
             Дерево задач (Dict[str, Any])
@@ -398,6 +646,9 @@ class DeepSeekClient:
             system_prompt = self._get_default_system_prompt()
 
         try:
+            if sharder is not None:
+                return sharder.generate(dom_analysis, system_prompt)
+
             # ActionTreeGenerator.generate_dict() принимает dict или str и возвращает dict
             tasks_tree: Dict[str, Any] = self.gen.generate_dict(
                 action_tree=dom_analysis,
@@ -417,12 +668,16 @@ class DeepSeekClient:
         self,
         tasks_tree: Dict[str, Any],
         api_key: str,
+        max_workers: int = 1,
+        max_concurrency: int = 4,
     ) -> Dict[str, Any]:
         """
         Генерация намерений на основе анализа DOM
         
         Args:
             tasks_tree: Результат генерации дерева задач (Dict[str, Any])
+            max_workers: Параллельные генерации листьев (int)
+            max_concurrency: Лимит одновременных запросов к провайдеру (int)
             
         Returns:
             Список намерений (Dict[str, Any])
@@ -434,7 +689,10 @@ class DeepSeekClient:
             # ActionTreeGenerator.generate_dict() принимает dict или str и возвращает dict
             tasks_tree: Dict[str, Any] = process_instructions_pipeline(
                 tree_dict=tasks_tree,
-                api_key=api_key
+                api_key=api_key,
+                max_workers=max_workers,
+                max_concurrency=max_concurrency,
+                cache=self.cache
             )
 
             return tasks_tree
@@ -468,23 +726,25 @@ class InstructionManager:
         """
         self.db_manager: DatabaseManager = db_manager
 
-    def save_tasks_tree(self, tasks_tree: Dict[str, Any]) -> None:
+    def save_tasks_tree(self, tasks_tree: Dict[str, Any], version_id: Optional[int] = None) -> None:
         """
         Сохранение дерева задач
         
         Args:
             tasks_tree: Дерево задач (Dict[str, Any])
+            version_id: Версия анализа (Optional[int])
         """
-        self.db_manager.save_tasks_tree(tasks_tree)
+        self.db_manager.save_tasks_tree(tasks_tree, version_id)
 
-    def save_instructions(self, instructions: Dict[str, Any]) -> None:
+    def save_instructions(self, instructions: Dict[str, Any], version_id: Optional[int] = None) -> None:
         """
         Сохранение намерений
         
         Args:
             instructions: Список намерений (Dict[str, Any])
+            version_id: Версия анализа (Optional[int])
         """
-        self.db_manager.save_instructions(instructions)
+        self.db_manager.save_instructions(instructions, version_id)
 
     def save_instruction(
         self,
@@ -492,7 +752,9 @@ class InstructionManager:
         steps: List[str],
         user_query: Optional[str] = None,
         context: Optional[Dict[str, Any]] = None,
-        task_data: Optional[Dict[str, Any]] = None
+        task_data: Optional[Dict[str, Any]] = None,
+        context_hash: Optional[str] = None,
+        version_id: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Сохранение инструкции
@@ -503,6 +765,8 @@ class InstructionManager:
             user_query: Запрос пользователя (Optional[str])
             context: Контекст (Optional[Dict[str, Any]])
             task_data: Данные задачи (Optional[Dict[str, Any]])
+            context_hash: Хэш уже сохранённого контекста (Optional[str])
+            version_id: Версия анализа (Optional[int])
             
         Returns:
             Сохранённые данные инструкции (Dict[str, Any])
@@ -517,12 +781,14 @@ class InstructionManager:
              "steps": steps or [],
             "user_query": user_query or "",
             "context": context or {},
+            "context_hash": context_hash,
             "timestamp": timestamp,
             "usage_count": 0,
             "last_used": None,
             "file_paths": {},
             "likes": 0,
-            "dislikes": 0
+            "dislikes": 0,
+            "version_id": version_id
         }
 
         self.db_manager.save_instruction(instruction_data)
@@ -532,13 +798,14 @@ class InstructionManager:
 
 
 
-def generate_instructions_recursive(task, dom_analysis, instruction_manager, instructions_accum):
-    # Генерация инструкции для текущей задачи
+def generate_instructions_recursive(task, context_hash, instruction_manager, instructions_accum, version_id=None):
+    # Генерация инструкции для текущей задачи; общий контекст передаётся по хэшу
     instruction_data = instruction_manager.save_instruction(
         task_id=task["task_id"],
         task_data=task,
         steps = [],
-        context=dom_analysis
+        context_hash=context_hash,
+        version_id=version_id
     )
     instructions_accum.append({
         "task_id": task["task_id"],
@@ -548,29 +815,73 @@ def generate_instructions_recursive(task, dom_analysis, instruction_manager, ins
 
     # Рекурсивно вызываем для дочерних задач
     for child_task in task.get("children", []):
-        generate_instructions_recursive(child_task, dom_analysis, instruction_manager, instructions_accum)
+        generate_instructions_recursive(child_task, context_hash, instruction_manager, instructions_accum, version_id)
 
 class SiteAnalyzer:
     """Главный класс для анализа сайта"""
 
-    def __init__(self, db_path: str, api_key: str, api_url: str) -> None:
+    def __init__(
+        self,
+        db_path: str,
+        api_key: str,
+        api_url: str,
+        workers: int = 1,
+        provider_concurrency: int = 4,
+        use_llm_cache: bool = True,
+        llm_cache_ttl: Optional[float] = 7 * 24 * 3600,
+        crawler: Optional[SiteCrawler] = None,
+        use_page_store: bool = True,
+        dom_workers: int = DOM_EXTRACT_WORKERS,
+        compact_dom: bool = True,
+        sharded: bool = False,
+        shard_max_chars: int = TREE_SHARD_MAX_CHARS
+    ) -> None:
         """
         Args:
             db_path: Путь к БД (str)
             api_key: OpenRouter API ключ (str)
             api_url: URL API (str)
+            workers: Параллельные генерации инструкций (int)
+            provider_concurrency: Лимит одновременных запросов к провайдеру (int)
+            use_llm_cache: Использовать ли кэш ответов LLM (bool)
+            llm_cache_ttl: Время жизни записей кэша в секундах (Optional[float])
+            crawler: Обходчик сайта (Optional[SiteCrawler])
+            use_page_store: Хранить снимки страниц и скачивать повторно только изменённые (bool)
+            dom_workers: Процессы разбора DOM (int)
+            compact_dom: Сжимать DOM перед генерацией дерева задач (bool)
+            sharded: Генерировать дерево задач по частям сайта (bool)
+            shard_max_chars: Максимальный размер части в символах JSON (int)
         """
+        self.workers: int = workers
+        self.provider_concurrency: int = provider_concurrency
+        self.llm_cache: Optional[LLMResponseCache] = None
+        if use_llm_cache:
+            cache_path: str = os.path.join(os.path.dirname(os.path.abspath(db_path)), LLM_CACHE_FILENAME)
+            self.llm_cache = LLMResponseCache(cache_path, ttl_seconds=llm_cache_ttl)
+        if crawler is None:
+            crawler = SiteCrawler()
+        if use_page_store and crawler.store is None:
+            store_path: str = os.path.join(os.path.dirname(os.path.abspath(db_path)), PAGE_STORE_FILENAME)
+            crawler.store = PageStore(store_path)
+        self.page_store: Optional[PageStore] = crawler.store
         self.db_manager: DatabaseManager = DatabaseManager(db_path)
-        self.dom_analyzer: DOMAnalyzer = DOMAnalyzer()
-        self.deepseek_client: DeepSeekClient = DeepSeekClient(api_key, api_url)
+        self.dom_analyzer: DOMAnalyzer = DOMAnalyzer(crawler, DOMExtractor(dom_workers))
+        self.compactor: Optional[DOMCompactor] = DOMCompactor() if compact_dom else None
+        self.deepseek_client: DeepSeekClient = DeepSeekClient(api_key, api_url, cache=self.llm_cache)
+        self.tree_sharder: Optional[ShardedTreeGenerator] = None
+        if sharded:
+            self.tree_sharder = ShardedTreeGenerator(
+                self.deepseek_client.gen, shard_max_chars, workers, provider_concurrency
+            )
         self.instruction_manager: InstructionManager = InstructionManager(self.db_manager)
 
-    def analyze_site(self, urls: Optional[List[str]] = None, api_key: str =None) -> Dict[str, Any]:
+    def analyze_site(self, urls: Optional[List[str]] = None, api_key: str =None, force: bool = False) -> Dict[str, Any]:
         """
         Полный анализ сайта
         
         Args:
             urls: Список URL для анализа (Optional[List[str]])
+            force: Анализировать, даже если страницы не изменились (bool)
             
         Returns:
             Результат анализа (Dict[str, Any])
@@ -580,55 +891,97 @@ class SiteAnalyzer:
         try:
             # Шаг 1: Анализ DOM
             logger.info("Step 1: Analyzing DOM structure...")
-            dom_analysis: Dict[str, Any] = self.dom_analyzer.download_and_analyze(urls)
-            with open("prompt.txt", "r", encoding="utf-8") as f:
-                system_prompt = f.read()
+            published_version: Optional[int] = self.db_manager.get_published_version()
+            dom_analysis: Dict[str, Any] = self.dom_analyzer.download_and_analyze(
+                urls, skip_unchanged=not force and published_version is not None
+            )
 
             if "error" in dom_analysis:
                 logger.error(f"DOM analysis error: {dom_analysis['error']}")
                 return {"status": "failed", "error": dom_analysis["error"]}
 
-            # Шаг 2: Генерация дерева задач
+            if dom_analysis.get("unchanged"):
+                logger.info(f"Site unchanged, analysis version {published_version} stays current")
+                return {
+                    "status": "unchanged",
+                    "version_id": published_version,
+                    "tasks_generated": 0,
+                    "instructions_created": 0
+                }
+
+            with open("prompt.txt", "r", encoding="utf-8") as f:
+                system_prompt = f.read()
+
+            # Шаг 2: Генерация дерева задач (по сжатому DOM; полный остаётся контекстом инструкций)
             logger.info("Step 2: Generating tasks tree...")
+            prompt_dom: Dict[str, Any] = self.compactor.compact(dom_analysis) if self.compactor else dom_analysis
+            # Причины, по которым версия неполная: такой анализ публикуется,
+            # но не становится базой сравнения — следующий запуск повторит его
+            degraded: List[str] = []
             try:
                 # generate_dict возвращает Dict[str, Any]
-                tasks_tree: Dict[str, Any] = self.deepseek_client.generate_tasks_tree(dom_analysis, system_prompt=system_prompt)
+                tasks_tree: Dict[str, Any] = self.deepseek_client.generate_tasks_tree(
+                    prompt_dom, system_prompt=system_prompt, sharder=self.tree_sharder
+                )
+                if self.tree_sharder is not None and self.tree_sharder.failed:
+                    degraded.append(f"{self.tree_sharder.failed} tasks tree shards failed")
             except RuntimeError as e:
                 logger.warning(f"Could not generate tasks tree from API: {str(e)}. Using fallback.")
                 tasks_tree: Dict[str, Any] = self._get_fallback_tasks_tree()
-
-            # Сохраняем дерево задач
-            self.instruction_manager.save_tasks_tree(tasks_tree)
+                degraded.append("fallback tasks tree")
 
             # генерация намерений
             logger.info("Step 3: Generating instructions...")
             try:
                 # generate_dict возвращает Dict[str, Any]
-                instructions: Dict[str, Any] = self.deepseek_client.generate_instructions(tasks_tree, api_key)
+                instructions: Dict[str, Any] = self.deepseek_client.generate_instructions(
+                    tasks_tree, api_key, self.workers, self.provider_concurrency
+                )
             except RuntimeError as e:
-                logger.warning(f"Could not generate tasks tree from API: {str(e)}. Using fallback.")
-                tasks_tree: Dict[str, Any] = self._get_fallback_tasks_tree()
-
-            self.instruction_manager.save_instructions(instructions)
-
-            # Шаг 3: Генерация инструкций для всех задач
-            logger.info("Step 4: Generating instructions for all tasks...")
+                logger.warning(f"Could not generate instructions from API: {str(e)}")
+                instructions: Dict[str, Any] = {"status": "error", "instructions": [], "error_message": str(e)}
+            if instructions.get("status") != "success":
+                degraded.append(f"instructions failed: {instructions.get('error_message')}")
+            elif instructions.get("failed_instructions"):
+                degraded.append(f"{instructions['failed_instructions']} instructions failed")
+
+            # Шаг 4: Дерево, намерения и инструкции публикуются одной транзакцией
+            logger.info("Step 4: Publishing analysis version...")
             generated_instructions: List[Dict[str, Any]] = []
-            
-            root_task = tasks_tree.get("root_task")
-            if root_task:
-                generate_instructions_recursive(root_task, dom_analysis, self.instruction_manager, generated_instructions)
 
+            with self.db_manager.publish_version(
+                tasks_tree.get("application", "EcoStore"), tasks_tree.get("analyzed_at")
+            ) as version_id:
+                self.instruction_manager.save_tasks_tree(tasks_tree, version_id)
+                self.instruction_manager.save_instructions(instructions, version_id)
+
+                root_task = tasks_tree.get("root_task")
+                if root_task:
+                    context_hash: str = self.db_manager.save_context_blob(dom_analysis)
+                    generate_instructions_recursive(
+                        root_task, context_hash, self.instruction_manager, generated_instructions, version_id
+                    )
+
+            # Полная версия опубликована — текущие снимки страниц становятся базой для сравнения
+            if degraded:
+                logger.warning(f"⚠️ Analysis version {version_id} is degraded: {'; '.join(degraded)}")
+            elif self.page_store is not None:
+                self.page_store.commit_baseline()
 
             result: Dict[str, Any] = {
-                "status": "success",
+                "status": "degraded" if degraded else "success",
+                "degraded": degraded,
+                "version_id": version_id,
                 "tasks_generated": len(tasks_tree.get("tasks", [])),
                 "instructions_created": len(generated_instructions),
+                "compaction": self.compactor.get_info() if self.compactor else None,
+                "sharding": self.tree_sharder.get_info() if self.tree_sharder else None,
                 "tasks_tree": tasks_tree,
                 "instructions": generated_instructions
             }
 
-            logger.info("Site analysis completed successfully")
+            if not degraded:
+                logger.info("Site analysis completed successfully")
             return result
 
         except Exception as e:
@@ -678,9 +1031,30 @@ def main() -> Dict[str, Any]:
     """
     parser = argparse.ArgumentParser(description="Site Analyzer - Analyze website and generate task tree")
     parser.add_argument('--db', type=str, default=DATABASE_PATH, help='Path to database file')
-    parser.add_argument('--urls', type=str, nargs='+', default=None, help='URLs to analyze')
+    parser.add_argument('--urls', type=str, nargs='+', default=None, help='Seed URLs: pages to analyze or the site root')
+    parser.add_argument('--max-pages', type=int, default=CRAWL_MAX_PAGES, help='Max pages fetched per crawl')
+    parser.add_argument('--max-depth', type=int, default=CRAWL_MAX_DEPTH, help='Follow same-site links this deep from the seeds (0 = seeds only)')
+    parser.add_argument('--crawl-concurrency', type=int, default=CRAWL_CONCURRENCY, help='Concurrent page downloads')
+    parser.add_argument('--per-host-limit', type=int, default=CRAWL_PER_HOST_LIMIT, help='Concurrent page downloads per host')
+    parser.add_argument('--crawl-timeout', type=float, default=CRAWL_TIMEOUT, help='Page download timeout, seconds')
+    parser.add_argument('--ignore-robots', action='store_true', help='Do not honor robots.txt')
+    parser.add_argument('--no-page-store', action='store_true', help='Do not keep page snapshots (always download full pages)')
+    parser.add_argument('--force', action='store_true', help='Re-analyze even if no page changed since the last analysis')
+    parser.add_argument('--dom-workers', type=int, default=DOM_EXTRACT_WORKERS, help='Processes for DOM extraction (1 = in-process)')
+    parser.add_argument('--no-compact', action='store_true', help='Send the full DOM analysis to the tasks tree prompt')
+    parser.add_argument('--sharded', action='store_true', help='Generate the tasks tree per site part and merge (large sites)')
+    parser.add_argument('--shard-max-chars', type=int, default=TREE_SHARD_MAX_CHARS, help='Max JSON chars of one tasks tree shard prompt')
     parser.add_argument('--api-key', type=str, default=api_key, help='OpenRouter API key')
     parser.add_argument('--api-url', type=str, default=DEEPSEEK_API_URL, help='DeepSeek API URL')
+    parser.add_argument('--workers', type=int, default=4, help='Parallel leaf instruction generations')
+    parser.add_argument('--provider-concurrency', type=int, default=4, help='Max concurrent requests per LLM provider')
+    parser.add_argument('--llm-pool-size', type=int, default=LLM_POOL_SIZE, help='Keep-alive connections per LLM host')
+    parser.add_argument('--llm-connect-timeout', type=float, default=LLM_CONNECT_TIMEOUT, help='LLM connect timeout, seconds')
+    parser.add_argument('--llm-read-timeout', type=float, default=LLM_READ_TIMEOUT, help='LLM read timeout, seconds')
+    parser.add_argument('--llm-max-retries', type=int, default=LLM_MAX_RETRIES, help='Retries for 429/5xx/timeouts per LLM call')
+    parser.add_argument('--llm-retry-deadline', type=float, default=LLM_RETRY_DEADLINE, help='Max seconds per LLM call including retries')
+    parser.add_argument('--no-llm-cache', action='store_true', help='Do not reuse cached LLM responses')
+    parser.add_argument('--llm-cache-ttl', type=float, default=7 * 24 * 3600, help='LLM cache entry TTL in seconds')
 
     args = parser.parse_args()
 
@@ -690,13 +1064,52 @@ def main() -> Dict[str, Any]:
     logger.info(f"Database: {args.db}")
     logger.info("="*60)
 
-    analyzer: SiteAnalyzer = SiteAnalyzer(args.db, args.api_key, args.api_url)
-    result: Dict[str, Any] = analyzer.analyze_site(args.urls, args.api_key)
+    configure_transport(
+        pool_size=max(args.llm_pool_size, args.provider_concurrency),
+        connect_timeout=args.llm_connect_timeout,
+        read_timeout=args.llm_read_timeout,
+        # Пакетный анализ ждёт восстановления провайдера, а не заполняет дерево ошибками
+        resilience=LLMResilience(
+            max_retries=args.llm_max_retries, deadline=args.llm_retry_deadline, wait_for_circuit=True
+        )
+    )
+
+    analyzer: SiteAnalyzer = SiteAnalyzer(
+        args.db, args.api_key, args.api_url,
+        workers=args.workers,
+        provider_concurrency=args.provider_concurrency,
+        use_llm_cache=not args.no_llm_cache,
+        llm_cache_ttl=args.llm_cache_ttl,
+        crawler=SiteCrawler(
+            max_pages=args.max_pages,
+            max_depth=args.max_depth,
+            concurrency=args.crawl_concurrency,
+            per_host_limit=args.per_host_limit,
+            timeout=args.crawl_timeout,
+            respect_robots=not args.ignore_robots
+        ),
+        use_page_store=not args.no_page_store,
+        dom_workers=args.dom_workers,
+        compact_dom=not args.no_compact,
+        sharded=args.sharded,
+        shard_max_chars=args.shard_max_chars
+    )
+    result: Dict[str, Any] = analyzer.analyze_site(args.urls, args.api_key, force=args.force)
 
     logger.info("="*60)
     logger.info(f"Result: {result.get('status', 'unknown')}")
     logger.info(f"Tasks generated: {result.get('tasks_generated', 0)}")
     logger.info(f"Instructions created: {result.get('instructions_created', 0)}")
+    if analyzer.llm_cache:
+        logger.info(f"LLM cache: {analyzer.llm_cache.get_info()}")
+    logger.info(f"Crawl: {analyzer.dom_analyzer.crawler.get_info()}")
+    logger.info(f"DOM extraction: {analyzer.dom_analyzer.extractor.get_info()}")
+    if analyzer.compactor:
+        logger.info(f"DOM compaction: {analyzer.compactor.get_info()}")
+    if analyzer.tree_sharder:
+        logger.info(f"Tasks tree sharding: {analyzer.tree_sharder.get_info()}")
+    if analyzer.page_store:
+        logger.info(f"Page store: {analyzer.page_store.get_info()}")
     logger.info("="*60)
 
     return result
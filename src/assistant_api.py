@@ -6,18 +6,29 @@ import sys
 import uuid
 import logging
 import sqlite3
+import queue
+import atexit
+import asyncio
+import copy
+import time
+import threading
+from collections import Counter, OrderedDict, deque
 from datetime import datetime
-from contextlib import contextmanager
-from flask import Flask, request, jsonify
+from functools import lru_cache
+from contextlib import asynccontextmanager, contextmanager
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv 
 from peewee import (
     Model, SqliteDatabase, TextField, IntegerField, DateTimeField,
-    AutoField
+    AutoField, IntegrityError, fn
 )
 
 # Импорт InstructionAssistant
-from instruction_finder import InstructionAssistant
+from instruction_finder import AnswerCache, DEFAULT_API_URL, InstructionAssistant, normalize_query, tokenize
+from llm_resilience import LLMResilience
+from llm_transport import configure_transport, get_transport
+from metrics import CHAT_ANSWERS, CONTENT_TYPE, REGISTRY, observe_db_query, observe_http_request
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,11 +43,74 @@ CORS(app, origins=["*"])
 # Конфигурация базы данных
 DATABASE_PATH = "ai_assistant.db"
 
+# SQLite: журнал WAL — чтения не блокируются записью истории чата и публикацией
+# анализа; busy_timeout (мс) — ожидание блокировки писателем; synchronous=normal
+# в WAL не теряет целостность при падении процесса; mmap_size (байт) и
+# cache_size (отрицательный — в КиБ) задаются на каждое соединение
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "wal")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "normal")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+
+# Отложенная запись сессий, истории чата и счётчиков использования:
+# "async" — пакетами в фоне (до WRITE_BEHIND_INTERVAL сек могут быть потеряны при падении),
+# "sync" — сразу на потоке запроса, как раньше
+WRITE_BEHIND_MODE = os.getenv("WRITE_BEHIND_MODE", "async")
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.5"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+# Сколько раз операция переносится на следующий сброс при временной ошибке БД (SQLITE_BUSY)
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+
+# Порог совпадения с названием задачи для ответа без LLM (0-1)
+FAST_PATH_THRESHOLD = float(os.getenv("FAST_PATH_THRESHOLD", "0.75"))
+
+# Кэш ответов чата: размер, время жизни (сек) и порог сходства перефразов (0-1)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.8"))
+
+# Период проверки новой опубликованной версии анализа для горячей перезагрузки (сек, 0 — выключено)
+INSTRUCTIONS_RELOAD_INTERVAL = float(os.getenv("INSTRUCTIONS_RELOAD_INTERVAL", "5"))
+
+# Допуск запросов к LLM: одновременные вызовы, длина очереди ожидания,
+# предельное ожидание в очереди (сек); при отказе — текстовый fallback
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+
+# Предельное время LLM-вызова чата с повторами (сек): пользователь ждёт ответа,
+# поэтому срок короче, чем у анализатора; таймауты каждой попытки урезаются до остатка срока
+CHAT_LLM_RETRY_DEADLINE = float(os.getenv("CHAT_LLM_RETRY_DEADLINE", "20"))
+
+# Адрес chat completions API для ответов чата
+CHAT_LLM_API_URL = os.getenv("CHAT_LLM_API_URL", DEFAULT_API_URL)
+
 
 # ==================== Database Manager ====================
 # ---------- Peewee DB/модели ----------
 
-db = SqliteDatabase(DATABASE_PATH, pragmas={"foreign_keys": 1})
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase с замером времени каждого SQL-запроса для /metrics"""
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            observe_db_query(sql, time.perf_counter() - started)
+
+
+# Соединения peewee — своё на каждый поток; в Flask открываются и закрываются
+# вместе с запросом (см. open_db_connection / close_db_connection)
+db = InstrumentedSqliteDatabase(DATABASE_PATH, pragmas=[
+    ("journal_mode", SQLITE_JOURNAL_MODE),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT),
+    ("synchronous", SQLITE_SYNCHRONOUS),
+    ("mmap_size", SQLITE_MMAP_SIZE),
+    ("cache_size", SQLITE_CACHE_SIZE),
+    ("foreign_keys", 1),
+])
 
 
 class BaseModel(Model):
@@ -44,11 +118,22 @@ class BaseModel(Model):
         database = db
 
 
+class AnalysisVersions(BaseModel):
+    id = AutoField()
+    application = TextField()
+    analyzed_at = DateTimeField()
+    published_at = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "analysis_versions"
+
+
 class InstructionsIntents(BaseModel):
     id = AutoField()
     application = TextField()
     analyzed_at = DateTimeField()
     instructions = TextField()
+    version_id = IntegerField(null=True)
 
     class Meta:
         table_name = "instructions_intents"
@@ -60,6 +145,7 @@ class TasksTrees(BaseModel):
     analyzed_at = DateTimeField()
     tasks_json = TextField()
     created_at = DateTimeField()
+    version_id = IntegerField(null=True)
 
     class Meta:
         table_name = "tasks_trees"
@@ -71,7 +157,8 @@ class Instructions(BaseModel):
     task_data_json = TextField(null=True)
     steps_json = TextField(null=True)
     user_query = TextField()
-    context_json = TextField(null=True)
+    context_json = TextField(null=True)  # устаревшее: контекст теперь в context_blobs
+    context_hash = TextField(null=True)
     timestamp = DateTimeField()
     usage_count = IntegerField()
     last_used = DateTimeField(null=True)
@@ -80,11 +167,22 @@ class Instructions(BaseModel):
     dislikes = IntegerField()
     created_at = DateTimeField()
     updated_at = DateTimeField()
+    version_id = IntegerField(null=True)
 
     class Meta:
         table_name = "instructions"
 
 
+class ContextBlobs(BaseModel):
+    hash = TextField(primary_key=True)
+    data = TextField()
+    size = IntegerField()
+    created_at = DateTimeField()
+
+    class Meta:
+        table_name = "context_blobs"
+
+
 class InstructionRatings(BaseModel):
     id = AutoField()
     instruction_id = IntegerField()
@@ -117,6 +215,265 @@ class UserSessions(BaseModel):
         table_name = "user_sessions"
 
 
+# ---------- Отложенная запись ----------
+
+class WriteBehindQueue:
+    """
+    Буфер отложенной записи для UserSessions, ChatHistory и Instructions.usage_count.
+
+    Запросы только кладут операции в ограниченную очередь; фоновый поток
+    раз в flush_interval записывает их одной транзакцией, схлопывая
+    повторные обновления сессий и счётчиков. При переполнении очереди
+    очередь сбрасывается и операция пишется синхронно (back-pressure
+    вместо потери данных).
+
+    Если пакет не записался, операции пишутся по одной: строка с ошибкой
+    целостности отбрасывается, не задевая остальных, а при временной
+    ошибке БД (база занята публикацией анализа) операции переносятся
+    на следующий сброс — до max_attempts раз.
+    """
+
+    def __init__(self, mode="async", flush_interval=0.5, max_queue=10000, batch_size=500, max_attempts=5):
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._retry = deque()  # (операция, число неудачных попыток) до следующего сброса
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.retried = 0
+        self.dropped = 0
+
+        if self.mode == "async":
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def submit(self, kind, payload):
+        """Ставит операцию в очередь (или пишет сразу в режиме sync)"""
+        if self.mode != "async":
+            self._write([(kind, payload)])
+            return
+        try:
+            self._queue.put_nowait((kind, payload))
+        except queue.Full:
+            logger.warning("Write-behind queue is full, writing synchronously")
+            # Сначала ранее поставленные операции: сообщение чата ссылается на сессию из очереди
+            with self._flush_lock:
+                self._flush_pending()
+                self._write_batch([((kind, payload), 0)])
+
+    def depth(self):
+        """Текущее количество операций в очереди (включая отложенные повторы)"""
+        return self._queue.qsize() + len(self._retry)
+
+    def flush(self):
+        """Записывает все накопленные операции"""
+        with self._flush_lock:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        """Сброс очереди (вызывается под self._flush_lock)"""
+        # Повторы — раньше новых операций (порядок сохраняется); новые неудачи ждут следующего сброса
+        pending = list(self._retry)
+        self._retry.clear()
+        while True:
+            batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append((self._queue.get_nowait(), 0))
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """Пишет пакет; при ошибке — по одной операции, чтобы изолировать плохую строку"""
+        try:
+            self._write([item for item, _ in batch])
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Write-behind batch of {len(batch)} failed ({e}), writing one by one")
+
+        for index, (item, attempts) in enumerate(batch):
+            try:
+                self._write([item])
+            except IntegrityError as e:
+                self.dropped += 1
+                logger.error(f"❌ Write-behind dropped {item[0]} operation: {e}")
+            except Exception as e:
+                # БД недоступна — остальные операции пакета не пробуем, переносим на следующий сброс
+                self._defer(batch[index:], e)
+                return
+
+    def _defer(self, batch, error):
+        for item, attempts in batch:
+            if attempts + 1 >= self.max_attempts:
+                self.dropped += 1
+                logger.error(f"❌ Write-behind dropped {item[0]} operation after {attempts + 1} attempts: {error}")
+            else:
+                self.retried += 1
+                self._retry.append((item, attempts + 1))
+        if self._retry:
+            logger.warning(f"⚠️ Write-behind deferred {len(self._retry)} operations to the next flush: {error}")
+
+    def close(self):
+        """Останавливает фоновый поток и дописывает очередь"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+
+    def _write(self, items):
+        """Записывает пакет операций одной транзакцией"""
+        sessions = {}
+        activity = {}
+        messages = []
+        usage = Counter()
+        last_used = {}
+
+        for kind, payload in items:
+            if kind == "session":
+                sessions[payload["session_id"]] = payload
+            elif kind == "activity":
+                activity[payload["session_id"]] = payload["last_activity"]
+            elif kind == "chat":
+                messages.append(payload)
+            elif kind == "usage":
+                usage[payload["instruction_id"]] += 1
+                last_used[payload["instruction_id"]] = payload["last_used"]
+
+        if db.is_closed():
+            db.connect()
+
+        with db.atomic():
+            if sessions:
+                UserSessions.insert_many(list(sessions.values())).on_conflict_replace().execute()
+            for session_id, last_activity in activity.items():
+                if session_id in sessions:
+                    continue
+                (
+                    UserSessions
+                    .update(last_activity=last_activity)
+                    .where(UserSessions.session_id == session_id)
+                    .execute()
+                )
+            if messages:
+                ChatHistory.insert_many(messages).execute()
+            for instruction_id, count in usage.items():
+                (
+                    Instructions
+                    .update(
+                        usage_count=Instructions.usage_count + count,
+                        last_used=last_used[instruction_id].isoformat(),
+                        updated_at=last_used[instruction_id],
+                    )
+                    .where(Instructions.id == instruction_id)
+                    .execute()
+                )
+
+
+# ---------- Индекс дерева задач ----------
+
+class TasksTreeIndex:
+    """
+    Плоский индекс дерева задач: task_id → узел, родитель, глубина, полный путь.
+
+    Строится один раз на версию дерева; поиск задачи, хлебные крошки и
+    поддеревья отвечаются без обхода JSON. Поддерживает как вложенный
+    root_task из анализатора, так и плоский список задач (fallback-дерево).
+    """
+
+    def __init__(self, tasks):
+        self.entries = {}
+
+        if isinstance(tasks, list):
+            roots = tasks
+        else:
+            roots = [tasks] if tasks else []
+
+        # Итеративный обход в глубину: дерево может быть очень глубоким
+        stack = [(node, None, 0, "") for node in reversed(roots)]
+        while stack:
+            node, parent_id, depth, parent_path = stack.pop()
+            if not isinstance(node, dict):
+                continue
+
+            task_id = self.task_id_of(node)
+            name = self.task_name_of(node)
+            full_path = f"{parent_path} > {name}" if parent_path else name
+
+            if task_id in self.entries:
+                logger.warning(f"Duplicate task_id in tasks tree: {task_id}")
+            elif task_id:
+                self.entries[task_id] = {
+                    "node": node,
+                    "parent_id": parent_id,
+                    "depth": depth,
+                    "full_path": full_path,
+                    "children": [],
+                }
+                if parent_id in self.entries:
+                    self.entries[parent_id]["children"].append(task_id)
+
+            for child in reversed(node.get("children") or []):
+                stack.append((child, task_id or parent_id, depth + 1, full_path))
+
+    @staticmethod
+    def task_id_of(node):
+        """Id задачи (task_id в дереве анализатора, id в плоском fallback)"""
+        return node.get("task_id") or node.get("id")
+
+    @staticmethod
+    def task_name_of(node):
+        """Название задачи"""
+        return node.get("task_name") or node.get("name") or ""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, task_id):
+        """Запись индекса по task_id или None"""
+        return self.entries.get(task_id)
+
+    def breadcrumbs(self, task_id):
+        """Цепочка задач от корня до task_id включительно"""
+        crumbs = []
+        entry = self.entries.get(task_id)
+        while entry is not None:
+            crumbs.append({
+                "task_id": task_id,
+                "task_name": self.task_name_of(entry["node"]),
+            })
+            task_id = entry["parent_id"]
+            entry = self.entries.get(task_id)
+        crumbs.reverse()
+        return crumbs
+
+    def subtree_ids(self, task_id):
+        """Id всех задач поддерева (включая корень) в порядке обхода"""
+        if task_id not in self.entries:
+            return []
+        result = []
+        stack = [task_id]
+        while stack:
+            current = stack.pop()
+            result.append(current)
+            stack.extend(reversed(self.entries[current]["children"]))
+        return result
+
+
 # ---------- Новый DatabaseManager на Peewee ----------
 
 class DatabaseManager:
@@ -133,6 +490,58 @@ class DatabaseManager:
         # Peewee сам управляет подключениями; здесь можно просто проверить коннект
         db.connect(reuse_if_open=True)
 
+        journal_mode = db.execute_sql("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.lower() != SQLITE_JOURNAL_MODE.lower():
+            logger.warning(f"SQLite journal mode is {journal_mode}, expected {SQLITE_JOURNAL_MODE}")
+
+        self._ensure_schema()
+
+        self.writes = WriteBehindQueue(
+            mode=WRITE_BEHIND_MODE,
+            flush_interval=WRITE_BEHIND_INTERVAL,
+            max_queue=WRITE_BEHIND_MAX_QUEUE,
+            max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+        )
+
+        # Контексты неизменяемы (адресуются хэшем), поэтому их можно кэшировать
+        self._load_context_blob = lru_cache(maxsize=16)(self._load_context_blob_uncached)
+
+        # FTS5-индекс создаётся анализатором; без него поиск работает по LIKE
+        self.fulltext_enabled = "instructions_fts" in db.get_tables()
+        if not self.fulltext_enabled:
+            logger.warning("Full-text index not found, run analyzer.py to build it")
+
+        # Кэш распарсенного дерева задач: (версия анализа, дерево, индекс)
+        self._tasks_tree_cache = None
+        self._tasks_tree_lock = threading.Lock()
+
+    def _ensure_schema(self):
+        """Добавляет колонки и таблицы, появившиеся после создания БД"""
+        db.create_tables([ContextBlobs, AnalysisVersions], safe=True)
+        columns = {c.name for c in db.get_columns("instructions")}
+        if "context_hash" not in columns:
+            db.execute_sql("ALTER TABLE instructions ADD COLUMN context_hash TEXT")
+
+        # Версии анализа: строки, записанные старым анализатором, публикуются одной версией
+        versioned = [TasksTrees, InstructionsIntents, Instructions]
+        for model in versioned:
+            table = model._meta.table_name
+            if "version_id" not in {c.name for c in db.get_columns(table)}:
+                db.execute_sql(f"ALTER TABLE {table} ADD COLUMN version_id INTEGER")
+            db.execute_sql(f"CREATE INDEX IF NOT EXISTS {table}_version_id ON {table}(version_id)")
+
+        if any(model.select().where(model.version_id.is_null()).exists() for model in versioned):
+            latest_tree = TasksTrees.select().order_by(TasksTrees.id.desc()).first()
+            with db.atomic():
+                version = AnalysisVersions.create(
+                    application=latest_tree.application if latest_tree else "",
+                    analyzed_at=latest_tree.analyzed_at if latest_tree else datetime.now(),
+                    published_at=datetime.now(),
+                )
+                for model in versioned:
+                    model.update(version_id=version.id).where(model.version_id.is_null()).execute()
+            logger.info(f"Existing analysis rows published as version {version.id}")
+
     @contextmanager
     def get_connection(self):
         """
@@ -149,14 +558,34 @@ class DatabaseManager:
 
     # ---------- методы с тем же интерфейсом ----------
 
-    def get_latest_instructions_intents(self):
-        """Получение последних инструкций для интентов из таблицы instructions_intents"""
+    def get_published_version(self):
+        """
+        Последняя опубликованная версия анализа (дешёвый probe по первичному ключу)
+
+        Анализатор публикует дерево, намерения и инструкции одной транзакцией,
+        поэтому все строки версии становятся видны одновременно.
+        """
+        return (
+            AnalysisVersions
+            .select(fn.MAX(AnalysisVersions.id))
+            .where(AnalysisVersions.published_at.is_null(False))
+            .scalar()
+        )
+
+    def _resolve_version(self, version):
+        return version if version is not None else self.get_published_version()
+
+    def get_latest_instructions_intents(self, version=None):
+        """Инструкции для интентов версии анализа (по умолчанию — опубликованной)"""
+        version = self._resolve_version(version)
+        if version is None:
+            return None
         try:
             row = (
                 InstructionsIntents
                 .select()
-                .order_by(InstructionsIntents.analyzed_at.desc())
-                .limit(1)
+                .where(InstructionsIntents.version_id == version)
+                .order_by(InstructionsIntents.id.desc())
                 .first()
             )
             if not row:
@@ -165,6 +594,7 @@ class DatabaseManager:
             instructions = json.loads(row.instructions)
             return {
                 "id": row.id,
+                "version": version,
                 "application": row.application,
                 "analyzed_at": row.analyzed_at,
                 "instructions": (
@@ -177,36 +607,94 @@ class DatabaseManager:
             logger.error("Failed to parse instructions JSON from DB")
             return None
 
-    def get_latest_tasks_tree(self):
-        """Получение последнего дерева задач из БД"""
+    def _get_cached_tasks_tree(self, version=None):
+        """
+        Возвращает (дерево, индекс) версии анализа из кэша процесса.
+
+        Распарсенное дерево и его индекс переиспользуются, пока анализатор
+        не опубликует новую версию. Запрос, закреплённый за предыдущей
+        версией, получает её дерево, не вытесняя из кэша новое.
+        """
+        version = self._resolve_version(version)
+        if version is None:
+            return {}, TasksTreeIndex([])
+
+        cached = self._tasks_tree_cache
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        with self._tasks_tree_lock:
+            cached = self._tasks_tree_cache
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+
+            row = (
+                TasksTrees
+                .select()
+                .where(TasksTrees.version_id == version)
+                .order_by(TasksTrees.id.desc())
+                .first()
+            )
+            if not row:
+                return {}, TasksTreeIndex([])
+            tasks_tree = {
+                "application": row.application,
+                "analyzed_at": row.analyzed_at,
+                "tasks": json.loads(row.tasks_json),
+            }
+            tasks_index = TasksTreeIndex(tasks_tree["tasks"])
+            if not cached or cached[0] < version:
+                self._tasks_tree_cache = (version, tasks_tree, tasks_index)
+                logger.info(f"Tasks tree of version {version} loaded into cache ({len(tasks_index)} tasks)")
+            return tasks_tree, tasks_index
+
+    def get_latest_tasks_tree(self, version=None):
+        """
+        Получение дерева задач версии анализа (через кэш процесса).
+        Возвращаемый словарь общий для всех вызовов — не изменяйте его.
+        """
+        return self._get_cached_tasks_tree(version)[0]
+
+    def get_latest_tasks_index(self, version=None):
+        """Плоский индекс задач дерева версии анализа (TasksTreeIndex)"""
+        return self._get_cached_tasks_tree(version)[1]
+
+    @staticmethod
+    def _instruction_fields(include_context=False):
+        """Колонки instructions для выборки: тяжёлый context_json — только по запросу"""
+        if include_context:
+            return [Instructions]
+        return [f for f in Instructions._meta.sorted_fields if f is not Instructions.context_json]
+
+    def _load_context_blob_uncached(self, context_hash):
+        row = ContextBlobs.get_or_none(ContextBlobs.hash == context_hash)
+        return json.loads(row.data) if row else {}
+
+    def get_context(self, context_hash):
+        """Получение контекста инструкции по хэшу (с LRU-кэшем)"""
+        if not context_hash:
+            return {}
+        return self._load_context_blob(context_hash)
+
+    def get_instruction(self, instruction_id, include_context=False):
+        """Получение инструкции по ID (любой версии: ID не переиспользуются)"""
         row = (
-            TasksTrees
-            .select()
-            .order_by(TasksTrees.created_at.desc())
-            .limit(1)
+            Instructions
+            .select(*self._instruction_fields(include_context))
+            .where(Instructions.id == instruction_id)
             .first()
         )
-        if not row:
-            return {}
-        return {
-            "application": row.application,
-            "analyzed_at": row.analyzed_at,
-            "tasks": json.loads(row.tasks_json),
-        }
-
-    def get_instruction(self, instruction_id):
-        """Получение инструкции по ID"""
-        row = Instructions.get_or_none(Instructions.id == instruction_id)
         if row:
-            return self._row_to_instruction_dict(row)
+            return self._row_to_instruction_dict(row, include_context)
         return None
 
-    def get_instruction_by_task_id(self, task_id):
-        """Получение инструкции по ID задачи"""
+    def get_instruction_by_task_id(self, task_id, version=None):
+        """Получение инструкции по ID задачи в версии анализа"""
+        version = self._resolve_version(version)
         row = (
             Instructions
-            .select()
-            .where(Instructions.task_id == task_id)
+            .select(*self._instruction_fields())
+            .where((Instructions.task_id == task_id) & (Instructions.version_id == version))
             .order_by(Instructions.usage_count.desc())
             .limit(1)
             .first()
@@ -216,18 +704,11 @@ class DatabaseManager:
         return None
 
     def update_instruction_usage(self, instruction_id):
-        """Обновление счетчика использования инструкции"""
-        now_iso = datetime.now().isoformat()
-        (
-            Instructions
-            .update(
-                usage_count=Instructions.usage_count + 1,
-                last_used=now_iso,
-                updated_at=datetime.now(),
-            )
-            .where(Instructions.id == instruction_id)
-            .execute()
-        )
+        """Обновление счетчика использования инструкции (через буфер записи)"""
+        self.writes.submit("usage", {
+            "instruction_id": instruction_id,
+            "last_used": datetime.now(),
+        })
 
     def rate_instruction(self, instruction_id, rating, user_session=None):
         """Оценка инструкции (лайк/дизлайк)"""
@@ -283,44 +764,124 @@ class DatabaseManager:
                 ratings["dislikes"] = row.count
         return ratings
 
-    def get_popular_instructions(self, limit=10):
-        """Получение популярных инструкций"""
+    def get_popular_instructions(self, limit=10, include_context=False, version=None):
+        """Получение популярных инструкций версии анализа"""
         query = (
             Instructions
-            .select()
+            .select(*self._instruction_fields(include_context))
+            .where(Instructions.version_id == self._resolve_version(version))
             .order_by((Instructions.usage_count + Instructions.likes * 5).desc())
             .limit(limit)
         )
-        return [self._row_to_instruction_dict(row) for row in query]
+        return [self._row_to_instruction_dict(row, include_context) for row in query]
 
-    def search_instructions(self, query):
-        """Поиск инструкций по запросу"""
+    # Веса колонок instructions_fts для bm25:
+    # task_id, task_name, description, user_query, steps
+    FTS_BM25 = "bm25(instructions_fts, 2.0, 5.0, 2.0, 1.0, 1.0)"
+
+    def search_instructions(self, query, limit=20, cursor=None, include_context=False, version=None):
+        """
+        Поиск инструкций версии анализа по запросу
+
+        Returns:
+            (список инструкций, курсор следующей страницы или None)
+        """
+        version = self._resolve_version(version)
+        if not self.fulltext_enabled:
+            return self._search_instructions_like(query, limit, include_context, version), None
+
+        # Префиксные термы покрывают русские окончания: «корзину» → корзи*
+        terms = tokenize(query)
+        if not terms:
+            return [], None
+        match = " ".join(f'"{term}"*' for term in terms)
+
+        params = [match, version]
+        keyset = ""
+        if cursor:
+            after_score, after_rowid = self._decode_search_cursor(cursor)
+            keyset = f"AND ({self.FTS_BM25} > ? OR ({self.FTS_BM25} = ? AND f.rowid > ?))"
+            params.extend([after_score, after_score, after_rowid])
+        params.append(limit + 1)
+
+        rows = db.execute_sql(
+            f"""SELECT i.id, f.rowid, {self.FTS_BM25} AS score,
+                       snippet(instructions_fts, -1, '<mark>', '</mark>', '…', 12)
+                FROM instructions_fts AS f
+                JOIN instructions AS i ON i.rowid = f.rowid
+                WHERE instructions_fts MATCH ? AND i.version_id = ? {keyset}
+                ORDER BY score, f.rowid
+                LIMIT ?""",
+            params,
+        ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1][2]!r}:{rows[-1][1]}"
+
+        by_id = {
+            row.id: row
+            for row in (
+                Instructions
+                .select(*self._instruction_fields(include_context))
+                .where(Instructions.id.in_([r[0] for r in rows]))
+            )
+        }
+        result = []
+        for instruction_id, _, score, snippet in rows:
+            row = by_id.get(instruction_id)
+            if row is None:
+                continue
+            item = self._row_to_instruction_dict(row, include_context)
+            item["score"] = -score  # bm25 в SQLite отрицательный: меньше — лучше
+            item["snippet"] = snippet
+            result.append(item)
+        return result, next_cursor
+
+    @staticmethod
+    def _decode_search_cursor(cursor):
+        """Разбирает курсор вида '<bm25>:<rowid>'"""
+        try:
+            score, rowid = cursor.rsplit(":", 1)
+            return float(score), int(rowid)
+        except ValueError:
+            raise ValueError("Invalid cursor")
+
+    def _search_instructions_like(self, query, limit, include_context=False, version=None):
+        """Поиск по LIKE для баз без полнотекстового индекса"""
         pattern = f"%{query}%"
         q = (
             Instructions
-            .select()
+            .select(*self._instruction_fields(include_context))
             .where(
-                (Instructions.task_id ** pattern)
-                | (Instructions.user_query ** pattern)
-                | (Instructions.task_data_json ** pattern)
-                | (Instructions.steps_json ** pattern)
+                (Instructions.version_id == version)
+                & (
+                    (Instructions.task_id ** pattern)
+                    | (Instructions.user_query ** pattern)
+                    | (Instructions.task_data_json ** pattern)
+                    | (Instructions.steps_json ** pattern)
+                )
             )
             .order_by(Instructions.usage_count.desc())
+            .limit(limit)
         )
-        return [self._row_to_instruction_dict(row) for row in q]
+        return [self._row_to_instruction_dict(row, include_context) for row in q]
 
     def save_chat_message(self, session_id, message_text, message_type, instruction_id=None):
-        """Сохранение сообщения чата в историю"""
-        ChatHistory.create(
-            session_id=session_id,
-            message_text=message_text,
-            message_type=message_type,
-            instruction_id=instruction_id,
-            created_at=datetime.now(),
-        )
+        """Сохранение сообщения чата в историю (через буфер записи)"""
+        self.writes.submit("chat", {
+            "session_id": session_id,
+            "message_text": message_text,
+            "message_type": message_type,
+            "instruction_id": instruction_id,
+            "created_at": datetime.now(),
+        })
 
     def get_chat_history(self, session_id, limit=50):
         """Получение истории чата для сессии"""
+        # история должна включать сообщения, ещё не записанные из буфера
+        self.writes.flush()
         q = (
             ChatHistory
             .select(
@@ -347,33 +908,34 @@ class DatabaseManager:
         return result
 
     def create_user_session(self, session_id, user_agent=None, ip_address=None):
-        """Создание новой пользовательской сессии"""
-        UserSessions.insert(
-            session_id=session_id,
-            user_agent=user_agent,
-            ip_address=ip_address,
-            last_activity=datetime.now(),
-        ).on_conflict_replace().execute()
+        """Создание (или обновление) пользовательской сессии через буфер записи"""
+        self.writes.submit("session", {
+            "session_id": session_id,
+            "user_agent": user_agent,
+            "ip_address": ip_address,
+            "last_activity": datetime.now(),
+        })
 
     def update_session_activity(self, session_id):
-        """Обновление времени последней активности сессии"""
-        (
-            UserSessions
-            .update(last_activity=datetime.now())
-            .where(UserSessions.session_id == session_id)
-            .execute()
-        )
+        """Обновление времени последней активности сессии через буфер записи"""
+        self.writes.submit("activity", {
+            "session_id": session_id,
+            "last_activity": datetime.now(),
+        })
 
-    def _row_to_instruction_dict(self, row):
-        """Преобразование строки БД в словарь инструкции"""
+    def _row_to_instruction_dict(self, row, include_context=False):
+        """
+        Преобразование строки БД в словарь инструкции.
+        Контекст загружается лениво — только при include_context.
+        """
         # row здесь — объект Instructions
-        return {
+        result = {
             "id": row.id,
             "task_id": row.task_id,
             "task_data": json.loads(row.task_data_json) if row.task_data_json else {},
             "steps": json.loads(row.steps_json) if row.steps_json else [],
             "user_query": row.user_query,
-            "context": json.loads(row.context_json) if row.context_json else {},
+            "context_hash": row.context_hash,
             "timestamp": row.timestamp,
             "usage_count": row.usage_count,
             "last_used": row.last_used,
@@ -383,45 +945,401 @@ class DatabaseManager:
             "created_at": row.created_at,
             "updated_at": row.updated_at,
         }
+        if include_context:
+            if row.context_json:
+                result["context"] = json.loads(row.context_json)
+            else:
+                result["context"] = self.get_context(row.context_hash)
+        return result
+
+
+# ==================== Single-flight ====================
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов.
+
+    Первый вызов с ключом (лидер) выполняет функцию, остальные вызовы с тем же
+    ключом ждут его завершения и получают копию результата. После завершения
+    ключ удаляется — это не кэш: следующий запрос снова пойдёт в LLM.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}  # ключ -> asyncio.Task (ASGI-режим, один event loop)
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """Выполняет func() один раз на ключ среди одновременных вызовов"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.leaders += 1
+
+        if leader:
+            try:
+                call["result"] = func()
+            except Exception as e:
+                call["error"] = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+            return call["result"]
+
+        call["done"].wait()
+        with self._lock:
+            self.shared += 1
+        if call["error"] is not None:
+            raise call["error"]
+        # Каждый ожидающий получает собственную копию — ответы дополняются по месту
+        return copy.deepcopy(call["result"])
+
+    async def ado(self, key, coro_func):
+        """
+        Асинхронная версия do
+
+        Вызов выполняется отдельной задачей: отключение клиента-лидера
+        не отменяет ответ для остальных ожидающих.
+        """
+        task = self._async_calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(coro_func())
+            self._async_calls[key] = task
+            task.add_done_callback(lambda t: self._async_done(key, t))
+        with self._lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        result = await asyncio.shield(task)
+        return result if leader else copy.deepcopy(result)
+
+    def _async_done(self, key, task):
+        del self._async_calls[key]
+        if not task.cancelled():
+            task.exception()  # ошибка уже доставлена ожидающим, не логируем повторно
+
+    def get_info(self):
+        """Статистика объединения"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "leaders": self.leaders,
+                "shared": self.shared,
+            }
+
+
+# ==================== LLM Admission Control ====================
+
+class AdmissionRejected(Exception):
+    """Запрос к LLM не допущен: очередь переполнена или истёк срок ожидания"""
+
+
+class LLMAdmissionController:
+    """
+    Глобальный лимит одновременных вызовов LLM с ограниченной очередью.
+
+    Свободный слот выдаётся сразу; иначе запрос ждёт в очереди не дольше
+    max_wait секунд. Освободившийся слот передаётся ожидающим сессиям по
+    кругу (по одному запросу на сессию за проход), поэтому одна активная
+    сессия не вытесняет остальных. При полной очереди или истечении срока
+    ожидания бросается AdmissionRejected.
+    """
+
+    def __init__(self, max_concurrency=8, max_queue=64, max_wait=10.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._waiting = OrderedDict()  # session_id -> deque билетов
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+
+    def _grant_next(self):
+        """Передаёт слот следующей по кругу сессии (вызывается под self._lock)"""
+        session_id, tickets = next(iter(self._waiting.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            self._waiting.move_to_end(session_id)
+        else:
+            del self._waiting[session_id]
+        self._queued -= 1
+        ticket["granted"] = True
+        ticket["wake"]()
+
+    def _release(self):
+        with self._lock:
+            if self._waiting:
+                self._grant_next()
+            else:
+                self._active -= 1
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self.admitted += 1
+            self.total_wait += waited
+            self.max_observed_wait = max(self.max_observed_wait, waited)
+
+    def _enqueue(self, session_id, make_ticket):
+        """Выдаёт слот сразу (None) или ставит билет в очередь сессии"""
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiting:
+                self._active += 1
+                return None
+            if self._queued >= self.max_queue:
+                self.rejected_full += 1
+                raise AdmissionRejected("LLM queue is full")
+            ticket = make_ticket()
+            ticket["granted"] = False
+            self._waiting.setdefault(session_id, deque()).append(ticket)
+            self._queued += 1
+            return ticket
+
+    def _withdraw(self, session_id, ticket):
+        """Снимает билет из очереди; True — слот уже выдан и его нужно освободить"""
+        with self._lock:
+            if ticket["granted"]:
+                return True
+            tickets = self._waiting[session_id]
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[session_id]
+            self._queued -= 1
+            return False
+
+    def _abandon(self, session_id, ticket):
+        """Снимает билет с истёкшим ожиданием (если слот не успел прийти)"""
+        if self._withdraw(session_id, ticket):
+            return
+        with self._lock:
+            self.rejected_timeout += 1
+        raise AdmissionRejected(f"LLM slot wait exceeded {self.max_wait}s")
+
+    def _cancel(self, session_id, ticket):
+        """Ожидание прервано (отмена корутины, разрыв клиента): слот не должен потеряться"""
+        if self._withdraw(session_id, ticket):
+            self._release()
+
+    @contextmanager
+    def slot(self, session_id=None):
+        """
+        Занимает слот LLM на время блока with
+
+        Raises:
+            AdmissionRejected: Очередь заполнена или слот не освободился за max_wait
+        """
+        start = time.monotonic()
+
+        def make_ticket():
+            event = threading.Event()
+            return {"wake": event.set, "event": event}
+
+        ticket = self._enqueue(session_id, make_ticket)
+        if ticket is not None:
+            try:
+                granted = ticket["event"].wait(self.max_wait)
+            except BaseException:
+                self._cancel(session_id, ticket)
+                raise
+            if not granted:
+                self._abandon(session_id, ticket)
+
+        self._record_wait(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aslot(self, session_id=None):
+        """Асинхронная версия slot: ожидание в очереди не занимает поток"""
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+
+        def make_ticket():
+            future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+            return {"wake": wake, "future": future}
+
+        ticket = self._enqueue(session_id, make_ticket)
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket["future"]), self.max_wait)
+            except asyncio.TimeoutError:
+                self._abandon(session_id, ticket)
+            except BaseException:
+                # CancelledError: Starlette отменяет генератор потока при разрыве клиента
+                self._cancel(session_id, ticket)
+                raise
+
+        self._record_wait(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def get_info(self):
+        """Метрики допуска: занятые слоты, глубина очереди, ожидание, отказы"""
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self._active,
+                "queue_depth": self._queued,
+                "queue_limit": self.max_queue,
+                "waiting_sessions": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected_full": self.rejected_full,
+                "rejected_timeout": self.rejected_timeout,
+                "avg_wait_ms": round(self.total_wait / self.admitted * 1000, 2) if self.admitted else 0.0,
+                "max_wait_ms": round(self.max_observed_wait * 1000, 2),
+            }
 
 
 # ==================== Instruction Assistant Manager ====================
 
 class AssistantManager:
-    """Менеджер для работы с InstructionAssistant"""
+    """
+    Менеджер для работы с InstructionAssistant
+
+    Фоновый поток следит за публикацией новой версии анализа, строит
+    новый ассистент (индекс, кэши) вне потока запросов и подменяет его одним
+    присваиванием. Запрос берёт пару (версия, ассистент) один раз в начале,
+    поэтому уже начатые запросы дорабатывают на старой версии.
+    """
     
-    def __init__(self, db_manager: DatabaseManager, api_key: str):
+    def __init__(self, db_manager: DatabaseManager, api_key: str, reload_interval: float = 0):
         self.db_manager = db_manager
         self.api_key = api_key
-        self.assistant: InstructionAssistant = None
-        self.instructions_loaded = False
+        self.reload_interval = reload_interval
+        self._active = (None, None)  # (версия инструкций, InstructionAssistant)
+        self._reload_lock = threading.Lock()
+        self._seen_version = None
+        self._stop = threading.Event()
+        self._watcher = None
+        self.inflight = SingleFlight()
+        self.admission = LLMAdmissionController(
+            max_concurrency=LLM_MAX_CONCURRENCY,
+            max_queue=LLM_QUEUE_SIZE,
+            max_wait=LLM_QUEUE_TIMEOUT
+        )
+        self.answer_cache = AnswerCache(
+            max_entries=ANSWER_CACHE_SIZE,
+            ttl_seconds=ANSWER_CACHE_TTL,
+            similarity_threshold=ANSWER_CACHE_SIMILARITY
+        )
         self._load_instructions()
+        
+        if self.reload_interval > 0:
+            self._watcher = threading.Thread(target=self._watch, name="instructions-watcher", daemon=True)
+            self._watcher.start()
+            atexit.register(self.stop)
+    
+    @property
+    def assistant(self) -> InstructionAssistant:
+        return self._active[1]
+    
+    @property
+    def instructions_version(self):
+        return self._active[0]
+    
+    @property
+    def instructions_loaded(self) -> bool:
+        return self._active[1] is not None
     
     def _load_instructions(self):
-        """Загружает инструкции из БД и инициализирует ассистента"""
-        try:
-            # Получаем инструкции из таблицы instructions_intents
-            intent_data = self.db_manager.get_latest_instructions_intents()
+        """Загружает инструкции из БД и подменяет ассистента готовым экземпляром"""
+        with self._reload_lock:
+            try:
+                # Получаем инструкции из таблицы instructions_intents
+                intent_data = self.db_manager.get_latest_instructions_intents()
+                
+                if not intent_data:
+                    logger.warning("No intent instructions found in database")
+                    return False
+                
+                if intent_data['version'] == self.instructions_version:
+                    return True
+                
+                logger.info(f"Loaded {len(intent_data['instructions'])} instructions from DB")
+                
+                # Строим нового ассистента целиком, старый продолжает обслуживать запросы
+                assistant = InstructionAssistant(
+                    api_key=self.api_key,
+                    fast_path_threshold=FAST_PATH_THRESHOLD,
+                    answer_cache=self.answer_cache,
+                    base_url=CHAT_LLM_API_URL
+                )
+                assistant.load_instructions(intent_data['instructions'], version=intent_data['version'])
+                
+                self._active = (intent_data['version'], assistant)
+                logger.info(f"✅ InstructionAssistant initialized successfully (version {intent_data['version']})")
+                return True
             
-            if not intent_data:
-                logger.warning("No intent instructions found in database")
+            except Exception as e:
+                logger.error(f"❌ Failed to load instructions: {e}")
                 return False
+    
+    def _watch(self):
+        """Фоновая проверка новой опубликованной версии анализа"""
+        while not self._stop.wait(self.reload_interval):
+            try:
+                latest_id = self.db_manager.get_published_version()
+            except Exception as e:
+                logger.error(f"❌ Instructions watcher probe failed: {e}")
+                continue
             
-            logger.info(f"Loaded {len(intent_data['instructions'])} instructions from DB")
-            
-            # Инициализируем ассистента
-            self.assistant = InstructionAssistant(api_key=self.api_key)
-            self.assistant.load_instructions(intent_data['instructions'])
+            if latest_id is None or latest_id == self._seen_version:
+                continue
             
-            self.instructions_loaded = True
-            logger.info("✅ InstructionAssistant initialized successfully")
-            return True
-        
-        except Exception as e:
-            logger.error(f"❌ Failed to load instructions: {e}")
-            return False
+            if latest_id != self.instructions_version:
+                logger.info(f"🔄 New analysis version {latest_id}, reloading...")
+            if self._load_instructions():
+                self._seen_version = latest_id
+    
+    def stop(self):
+        """Останавливает фоновую проверку"""
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=self.reload_interval + 1)
+    
+    @staticmethod
+    def _busy_result(reason):
+        logger.warning(f"⏳ LLM admission rejected: {reason}")
+        return {
+            'status': 'busy',
+            'message': 'Сервис перегружен, попробуйте повторить вопрос позже'
+        }
     
-    def answer_question(self, user_query: str) -> dict:
+    def _answer_with_llm(self, assistant, user_query, session_id):
+        """Вызов ассистента с LLM внутри слота допуска"""
+        with self.admission.slot(session_id):
+            return assistant.answer_question(
+                user_query=user_query,
+                min_relevance=0.3,
+                top_k=3,
+                include_recommendation=True,
+                local_first=False
+            )
+    
+    def answer_question(self, user_query: str, session_id: str = None) -> dict:
         """Отвечает на вопрос пользователя используя InstructionAssistant"""
         
         if not self.instructions_loaded:
@@ -435,18 +1353,108 @@ class AssistantManager:
         try:
             logger.info(f"Processing query: '{user_query}'")
             
-            # Используем InstructionAssistant для поиска
-            result = self.assistant.answer_question(
-                user_query=user_query,
-                min_relevance=0.3,
-                top_k=3,
-                include_recommendation=True
-            )
+            # Версия и ассистент берутся один раз: перезагрузка не затронет этот запрос
+            version, assistant = self._active
+            
+            # Ответы без LLM не занимают слот допуска
+            result = assistant.answer_locally(user_query)
+            if result is None:
+                # Одинаковые одновременные вопросы ждут один вызов InstructionAssistant
+                key = (version, normalize_query(user_query))
+                result = self.inflight.do(
+                    key, lambda: self._answer_with_llm(assistant, user_query, session_id)
+                )
             
             logger.info(f"Query processed successfully, status: {result.get('status')}")
             
             return result
         
+        except AdmissionRejected as e:
+            return self._busy_result(e)
+        
+        except Exception as e:
+            logger.error(f"Error processing query: {e}")
+            return {
+                'status': 'error',
+                'message': f'Ошибка при обработке запроса: {str(e)}'
+            }
+
+
+    def answer_question_stream(self, user_query: str, session_id: str = None):
+        """
+        Потоковый ответ на вопрос пользователя
+
+        Yields:
+            ("token" | "description", str), в конце ("result", dict)
+        """
+        if not self.instructions_loaded and not self._load_instructions():
+            yield 'result', {
+                'status': 'error',
+                'message': 'Инструкции не загружены. Система инициализируется...'
+            }
+            return
+
+        try:
+            logger.info(f"Processing streaming query: '{user_query}'")
+            assistant = self.assistant
+            
+            local_result = assistant.answer_locally(user_query)
+            if local_result is not None:
+                yield 'result', local_result
+                return
+            
+            # Слот занят до конца потока (или до отключения клиента)
+            with self.admission.slot(session_id):
+                yield from assistant.answer_question_stream(
+                    user_query=user_query,
+                    min_relevance=0.3,
+                    top_k=3,
+                    local_first=False
+                )
+        except AdmissionRejected as e:
+            yield 'result', self._busy_result(e)
+        except Exception as e:
+            logger.error(f"Error processing streaming query: {e}")
+            yield 'result', {
+                'status': 'error',
+                'message': f'Ошибка при обработке запроса: {str(e)}'
+            }
+
+
+    # ---------- Асинхронные версии (ASGI-режим, assistant_asgi.py) ----------
+
+    async def _aanswer_with_llm(self, assistant, user_query, session_id):
+        async with self.admission.aslot(session_id):
+            return await assistant.aanswer_question(
+                user_query=user_query,
+                min_relevance=0.3,
+                top_k=3,
+                local_first=False
+            )
+
+    async def aanswer_question(self, user_query: str, session_id: str = None) -> dict:
+        """Асинхронная версия answer_question"""
+        if not self.instructions_loaded and not await asyncio.to_thread(self._load_instructions):
+            return {
+                'status': 'error',
+                'message': 'Инструкции не загружены. Система инициализируется...'
+            }
+
+        try:
+            logger.info(f"Processing query (async): '{user_query}'")
+            version, assistant = self._active
+
+            result = assistant.answer_locally(user_query)
+            if result is None:
+                key = (version, normalize_query(user_query))
+                result = await self.inflight.ado(
+                    key, lambda: self._aanswer_with_llm(assistant, user_query, session_id)
+                )
+            return result
+
+        except AdmissionRejected as e:
+            return self._busy_result(e)
+
         except Exception as e:
             logger.error(f"Error processing query: {e}")
             return {
@@ -454,6 +1462,41 @@ class AssistantManager:
                 'message': f'Ошибка при обработке запроса: {str(e)}'
             }
 
+    async def aanswer_question_stream(self, user_query: str, session_id: str = None):
+        """Асинхронная версия answer_question_stream"""
+        if not self.instructions_loaded and not await asyncio.to_thread(self._load_instructions):
+            yield 'result', {
+                'status': 'error',
+                'message': 'Инструкции не загружены. Система инициализируется...'
+            }
+            return
+
+        try:
+            logger.info(f"Processing streaming query (async): '{user_query}'")
+            assistant = self.assistant
+
+            local_result = assistant.answer_locally(user_query)
+            if local_result is not None:
+                yield 'result', local_result
+                return
+
+            async with self.admission.aslot(session_id):
+                async for event, data in assistant.aanswer_question_stream(
+                    user_query=user_query,
+                    min_relevance=0.3,
+                    top_k=3,
+                    local_first=False
+                ):
+                    yield event, data
+        except AdmissionRejected as e:
+            yield 'result', self._busy_result(e)
+        except Exception as e:
+            logger.error(f"Error processing streaming query: {e}")
+            yield 'result', {
+                'status': 'error',
+                'message': f'Ошибка при обработке запроса: {str(e)}'
+            }
+
 
 # ==================== AI Service ====================
 
@@ -487,26 +1530,204 @@ def get_user_session():
     user_agent = request.headers.get('User-Agent', '')
     ip_address = request.remote_addr
     
+    # INSERT OR REPLACE уже выставляет last_activity, отдельный UPDATE не нужен
     db_manager.create_user_session(session_id, user_agent, ip_address)
-    db_manager.update_session_activity(session_id)
     
     return session_id
 
 
-# Инициализация сервисов
-db_manager = DatabaseManager(DATABASE_PATH)
+# Сервисы создаются в init_app(): импорт модуля не открывает БД, не меняет
+# её схему и не запускает фоновые потоки (тесты, ASGI-режим, бенчмарк)
+db_manager = None
+assistant_manager = None
+ai_service = None
+api_key = None
 
-# API ключ для OpenAI (прочитать из переменных окружения)
+_init_lock = threading.Lock()
+_initialized = False
 
 
-load_dotenv()  # подгрузит .env
-api_key = os.getenv("OPENROUTER_API_KEY")
+def init_app():
+    """
+    Инициализирует сервисы API (один раз на процесс)
 
-# Инициализируем менеджер ассистента
-assistant_manager = AssistantManager(db_manager=db_manager, api_key=api_key)
+    Открывает и мигрирует БД, настраивает LLM-транспорт, загружает
+    инструкции и запускает фоновые потоки (отложенная запись, перезагрузка
+    версий). Вызывается main(), lifespan ASGI-приложения и, если сервер
+    импортировал app напрямую, первым запросом.
 
-# Вспомогательный сервис
-ai_service = AIService(db_manager=db_manager)
+    Returns:
+        Flask-приложение
+    """
+    global db_manager, assistant_manager, ai_service, api_key, _initialized
+
+    with _init_lock:
+        if _initialized:
+            return app
+
+        db_manager = DatabaseManager(DATABASE_PATH)
+
+        # API ключ для OpenAI (прочитать из переменных окружения)
+        load_dotenv()  # подгрузит .env
+        api_key = os.getenv("OPENROUTER_API_KEY")
+
+        # Повторы LLM-вызовов чата укладываются в короткий срок ответа пользователю
+        configure_transport(resilience=LLMResilience(deadline=CHAT_LLM_RETRY_DEADLINE))
+
+        # Инициализируем менеджер ассистента
+        assistant_manager = AssistantManager(
+            db_manager=db_manager,
+            api_key=api_key,
+            reload_interval=INSTRUCTIONS_RELOAD_INTERVAL
+        )
+
+        # Вспомогательный сервис
+        ai_service = AIService(db_manager=db_manager)
+
+        register_metrics()
+        _initialized = True
+    return app
+
+
+# ==================== Metrics ====================
+
+def register_metrics():
+    """Метрики, которые читаются из состояния сервисов при выгрузке /metrics"""
+    REGISTRY.callback(
+        "write_behind_queue_depth", "Pending write-behind operations",
+        db_manager.writes.depth
+    )
+    REGISTRY.callback(
+        "write_behind_failed_operations_total", "Write-behind operations that failed to write, by outcome",
+        lambda: {
+            ("retried",): db_manager.writes.retried,
+            ("dropped",): db_manager.writes.dropped,
+        },
+        type_name="counter", labelnames=("outcome",)
+    )
+    REGISTRY.callback(
+        "answer_cache_lookups_total", "Answer cache lookups by result",
+        lambda: {
+            ("exact_hit",): assistant_manager.answer_cache.exact_hits,
+            ("similar_hit",): assistant_manager.answer_cache.similar_hits,
+            ("miss",): assistant_manager.answer_cache.misses,
+        },
+        type_name="counter", labelnames=("result",)
+    )
+    REGISTRY.callback(
+        "answer_cache_hit_ratio", "Answer cache hit ratio since start",
+        lambda: assistant_manager.answer_cache.get_info()["hit_ratio"]
+    )
+    REGISTRY.callback(
+        "answer_cache_entries", "Entries in the answer cache",
+        lambda: assistant_manager.answer_cache.get_info()["entries"]
+    )
+
+    def context_cache_ratio():
+        info = db_manager._load_context_blob.cache_info()
+        lookups = info.hits + info.misses
+        return info.hits / lookups if lookups else 0.0
+
+    REGISTRY.callback(
+        "context_cache_hit_ratio", "Instruction context blob cache hit ratio since start",
+        context_cache_ratio
+    )
+    REGISTRY.callback(
+        "single_flight_calls_total", "Chat LLM calls by single-flight role",
+        lambda: {
+            ("leader",): assistant_manager.inflight.leaders,
+            ("shared",): assistant_manager.inflight.shared,
+        },
+        type_name="counter", labelnames=("role",)
+    )
+
+    def admission_value(key):
+        return lambda: assistant_manager.admission.get_info()[key]
+
+    REGISTRY.callback("llm_admission_active", "LLM calls holding an admission slot", admission_value("active"))
+    REGISTRY.callback("llm_admission_queue_depth", "Chats waiting for an LLM slot", admission_value("queue_depth"))
+    REGISTRY.callback(
+        "llm_admission_rejected_total", "Chats rejected by LLM admission control",
+        lambda: {
+            ("queue_full",): assistant_manager.admission.rejected_full,
+            ("timeout",): assistant_manager.admission.rejected_timeout,
+        },
+        type_name="counter", labelnames=("reason",)
+    )
+    REGISTRY.callback(
+        "llm_retries_total", "LLM call retries",
+        lambda: get_transport().resilience.retries,
+        type_name="counter"
+    )
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def open_db_connection():
+    init_app()
+    db.connect(reuse_if_open=True)
+
+
+@app.teardown_request
+def close_db_connection(exc):
+    # Потоки dev-сервера живут один запрос: соединение не должно их пережить
+    if not db.is_closed():
+        db.close()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_http_request(route, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def request_version():
+    """
+    Версия анализа, закреплённая за текущим запросом
+
+    Берётся один раз при первом обращении: все чтения запроса видят одну
+    версию, даже если анализатор опубликует новую посередине.
+    """
+    if 'analysis_version' not in g:
+        g.analysis_version = db_manager.get_published_version()
+    return g.analysis_version
+
+
+def wants_context():
+    """Запросил ли клиент тяжёлый контекст инструкций (?include_context=1)"""
+    return request.args.get('include_context', '').lower() in ('1', 'true', 'yes')
+
+
+def build_chat_response(session_id, message, result):
+    """Формирует ответ чата по результату ассистента (с текстовым fallback)"""
+    CHAT_ANSWERS.inc(answered_by=result.get('answered_by', 'none'), status=result.get('status', 'unknown'))
+
+    if result.get('status') == 'success' or result.get('status') == 'partial':
+        return {
+            'message': result.get('description'),
+            'type': 'instruction',
+            'search_result': result
+        }
+
+    # Fallback: текстовый ответ
+    response = ai_service.chat_response(message)
+    db_manager.save_chat_message(session_id, response, 'assistant')
+    return {
+        'message': response,
+        'type': 'text'
+    }
+
+
+def sse_event(event, data):
+    """Кодирует событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
 
 
 # ==================== API ENDPOINTS ====================
@@ -515,14 +1736,20 @@ ai_service = AIService(db_manager=db_manager)
 def health_check():
     """Health-check endpoint"""
     try:
-        tasks_tree = db_manager.get_latest_tasks_tree()
+        tasks_tree = db_manager.get_latest_tasks_tree(request_version())
         is_initialized = bool(tasks_tree)
         
         return jsonify({
             'status': 'ok',
             'database': 'connected',
             'initialized': is_initialized,
+            'analysis_version': request_version(),
             'assistant_ready': assistant_manager.instructions_loaded,
+            'instructions_version': assistant_manager.instructions_version,
+            'single_flight': assistant_manager.inflight.get_info(),
+            'answer_cache': assistant_manager.answer_cache.get_info(),
+            'llm_admission': assistant_manager.admission.get_info(),
+            'llm_resilience': get_transport().resilience.get_info(),
             'timestamp': datetime.now().isoformat()
         })
     
@@ -533,11 +1760,17 @@ def health_check():
         }), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/api/get-tasks-tree', methods=['GET'])
 def get_tasks_tree():
     """Получение дерева задач"""
     try:
-        tasks_tree = db_manager.get_latest_tasks_tree()
+        tasks_tree = db_manager.get_latest_tasks_tree(request_version())
         if not tasks_tree:
             return jsonify({'error': 'Tasks tree not found. Please run analyzer first.'}), 404
         
@@ -558,7 +1791,7 @@ def get_help():
         data = request.json or {}
         
         # Получаем доступные задачи из дерева задач
-        tasks_tree = db_manager.get_latest_tasks_tree()
+        tasks_tree = db_manager.get_latest_tasks_tree(request_version())
         available_tasks = tasks_tree.get("tasks", [])
         
         return jsonify({
@@ -582,26 +1815,23 @@ def get_instruction():
         if not task_id:
             return jsonify({"error": "task_id is required"}), 400
         
-        # Получаем задачу из дерева задач
-        tasks_tree = db_manager.get_latest_tasks_tree()
-        task_data = None
+        # Получаем задачу из индекса дерева задач
+        tasks_index = db_manager.get_latest_tasks_index(request_version())
+        task_entry = tasks_index.get(task_id)
         
-        for task in tasks_tree.get("tasks", []):
-            if task["id"] == task_id:
-                task_data = task
-                break
-        
-        if not task_data:
+        if not task_entry:
             return jsonify({"error": "Task not found"}), 404
         
+        task_data = task_entry["node"]
+        
         # Ищем инструкцию в БД
-        instruction = db_manager.get_instruction_by_task_id(task_id)
+        instruction = db_manager.get_instruction_by_task_id(task_id, request_version())
         
         if instruction:
             db_manager.update_instruction_usage(instruction['id'])
             db_manager.save_chat_message(
                 session_id,
-                f"Запрос инструкции: {task_data['name']}",
+                f"Запрос инструкции: {TasksTreeIndex.task_name_of(task_data)}",
                 'user',
                 instruction['id']
             )
@@ -610,6 +1840,7 @@ def get_instruction():
                 'steps': instruction['steps'],
                 'instruction_id': instruction['id'],
                 'task_data': task_data,
+                'breadcrumbs': tasks_index.breadcrumbs(task_id),
                 'file_paths': instruction['file_paths'],
                 'source': 'database',
                 'likes': instruction['likes'],
@@ -646,37 +1877,60 @@ def chat():
         db_manager.save_chat_message(session_id, message, 'user')
         
         # Используем InstructionAssistant для обработки запроса
-        result = assistant_manager.answer_question(message)
+        result = assistant_manager.answer_question(message, session_id=session_id)
         
         logger.info(f"Assistant response status: {result.get('status')}")
-        
-        # Формируем ответ для клиента
-        if result.get('status') == 'success' or result.get('status') == 'partial':
-            top_match = result.get('description')
-            
-                
-            return jsonify({
-                'message': top_match,
-                'type': 'instruction',
-                'search_result': result
-            })
-        
-        # Fallback: текстовый ответ
-        response = ai_service.chat_response(message)
-        db_manager.save_chat_message(session_id, response, 'assistant')
-        
         logger.info("=" * 60)
         
-        return jsonify({
-            'message': response,
-            'type': 'text'
-        })
+        return jsonify(build_chat_response(session_id, message, result))
     
     except Exception as e:
         logger.error(f"Error in chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Потоковый чат (Server-Sent Events).
+
+    События: token — сырые фрагменты ответа модели, description — новые
+    символы описания инструкции, result — итоговый ответ в формате /api/chat,
+    error — ошибка обработки.
+    """
+    try:
+        session_id = get_user_session()
+        data = request.json or {}
+        message = data.get('message', '').strip()
+        
+        if not message:
+            return jsonify({"error": "message is required"}), 400
+        
+        logger.info(f"User message (stream): '{message}'")
+        db_manager.save_chat_message(session_id, message, 'user')
+    
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    def generate():
+        try:
+            for event, payload in assistant_manager.answer_question_stream(message, session_id=session_id):
+                if event == 'result':
+                    yield sse_event('result', build_chat_response(session_id, message, payload))
+                else:
+                    yield sse_event(event, {'text': payload})
+        except Exception as e:
+            logger.error(f"Error in chat stream: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/rate-instruction', methods=['POST'])
 def rate_instruction():
     """Оценка инструкции (лайк/дизлайк)"""
@@ -734,12 +1988,32 @@ def get_instruction_ratings_endpoint(instruction_id):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/instruction-context/<instruction_id>', methods=['GET'])
+def get_instruction_context(instruction_id):
+    """Получение контекста анализа, на котором построена инструкция"""
+    try:
+        instruction = db_manager.get_instruction(instruction_id, include_context=True)
+        
+        if not instruction:
+            return jsonify({'error': 'Instruction not found'}), 404
+        
+        return jsonify({
+            'instruction_id': instruction_id,
+            'context_hash': instruction['context_hash'],
+            'context': instruction['context']
+        })
+    
+    except Exception as e:
+        logger.error(f"Error getting instruction context: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/popular-instructions', methods=['GET'])
 def get_popular_instructions():
     """Получение популярных инструкций"""
     try:
         limit = request.args.get('limit', 10, type=int)
-        instructions = db_manager.get_popular_instructions(limit)
+        instructions = db_manager.get_popular_instructions(limit, wants_context(), request_version())
         
         return jsonify({
             'count': len(instructions),
@@ -756,16 +2030,24 @@ def search_instructions():
     """Поиск инструкций по запросу"""
     try:
         query = request.args.get('q', '', type=str)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        cursor = request.args.get('cursor', None, type=str)
         
         if not query:
             return jsonify({"error": "q parameter is required"}), 400
         
-        instructions = db_manager.search_instructions(query)
+        try:
+            instructions, next_cursor = db_manager.search_instructions(
+                query, limit, cursor, wants_context(), request_version()
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         return jsonify({
             'query': query,
             'count': len(instructions),
-            'instructions': instructions
+            'instructions': instructions,
+            'next_cursor': next_cursor
         })
     
     except Exception as e:
@@ -797,6 +2079,7 @@ def get_chat_history():
 
 def main():
     """Запуск Flask приложения"""
+    init_app()
     logger.info("=" * 60)
     logger.info("ASSISTANT API - Starting")
     logger.info("=" * 60)
@@ -805,14 +2088,17 @@ def main():
     logger.info(f"Assistant Status: {'✅ Ready' if assistant_manager.instructions_loaded else '⚠️ Initializing'}")
     logger.info("\nAvailable endpoints:")
     logger.info(" - GET /api/health - Health check")
+    logger.info(" - GET /metrics - Prometheus metrics")
     logger.info(" - GET /api/get-tasks-tree - Get task tree")
     logger.info(" - POST /api/get-help - Get available tasks")
     logger.info(" - POST /api/get-instruction - Get instruction for task")
     logger.info(" - POST /api/chat - Chat with assistant (uses InstructionAssistant)")
+    logger.info(" - POST /api/chat/stream - Chat with streamed answer (Server-Sent Events)")
     logger.info(" - POST /api/rate-instruction - Rate instruction")
     logger.info(" - GET /api/instruction-ratings/<id> - Get instruction ratings")
+    logger.info(" - GET /api/instruction-context/<id> - Get instruction analysis context")
     logger.info(" - GET /api/popular-instructions - Get popular instructions")
-    logger.info(" - GET /api/search-instructions?q=query - Search instructions")
+    logger.info(" - GET /api/search-instructions?q=query&limit=20&cursor= - Search instructions")
     logger.info(" - GET /api/chat-history - Get chat history")
     logger.info("=" * 60)
     
@@ -0,0 +1,170 @@
+# assistant_asgi.py - Асинхронный (ASGI) режим API ассистента
+#
+# Те же маршруты и JSON-контракты, что у assistant_api.py. Чат (/api/chat,
+# /api/chat/stream) обслуживается асинхронно: ожидание LLM не занимает
+# поток, поэтому тысячи чатов могут ждать провайдера в одном процессе.
+# Остальные маршруты отдаются Flask-приложением через WSGI-мост.
+# Доступ к БД синхронный (peewee) и выполняется в пуле потоков
+# (asyncio.to_thread), event loop им не блокируется. Сервисы (БД, менеджер
+# ассистента) создаются в lifespan, а не при импорте модуля.
+#
+# Запуск:
+#     uvicorn assistant_asgi:app --host 0.0.0.0 --port 5000
+#
+# pip install starlette uvicorn aiohttp a2wsgi
+
+import asyncio
+import functools
+import json
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import assistant_api
+from assistant_api import app as flask_app, build_chat_response, init_app, sse_event
+from llm_transport import close_async_transport
+from metrics import observe_http_request
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== Helpers ====================
+
+async def get_user_session(request: Request) -> str:
+    """Получение или создание пользовательской сессии (запись в БД — вне event loop)"""
+    session_id = request.headers.get('X-Session-ID') or str(uuid.uuid4())
+    user_agent = request.headers.get('User-Agent', '')
+    ip_address = request.client.host if request.client else None
+
+    db_manager = request.app.state.db_manager
+    await asyncio.to_thread(db_manager.create_user_session, session_id, user_agent, ip_address)
+    return session_id
+
+
+async def read_message(request: Request) -> str:
+    """Текст сообщения из JSON-тела запроса ('' если его нет)"""
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return ''
+    return (data.get('message') or '').strip()
+
+
+def timed(route: str):
+    """Учитывает запрос к асинхронному маршруту в /metrics (Flask-маршруты учитывает сам Flask)"""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request: Request):
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = await endpoint(request)
+                status = response.status_code
+                return response
+            finally:
+                observe_http_request(route, request.method, status, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# ==================== API ENDPOINTS ====================
+
+@timed('/api/chat')
+async def chat(request: Request):
+    """Обработка чат-запроса пользователя (асинхронная версия /api/chat)"""
+    try:
+        session_id = await get_user_session(request)
+        message = await read_message(request)
+
+        if not message:
+            return JSONResponse({"error": "message is required"}, status_code=400)
+
+        logger.info(f"User message (async): '{message}'")
+        await asyncio.to_thread(request.app.state.db_manager.save_chat_message, session_id, message, 'user')
+
+        result = await request.app.state.assistant_manager.aanswer_question(message, session_id=session_id)
+
+        logger.info(f"Assistant response status: {result.get('status')}")
+        response = await asyncio.to_thread(build_chat_response, session_id, message, result)
+        return JSONResponse(response)
+
+    except Exception as e:
+        logger.error(f"Error in chat: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@timed('/api/chat/stream')
+async def chat_stream(request: Request):
+    """Потоковый чат (асинхронная версия /api/chat/stream, Server-Sent Events)"""
+    try:
+        session_id = await get_user_session(request)
+        message = await read_message(request)
+
+        if not message:
+            return JSONResponse({"error": "message is required"}, status_code=400)
+
+        logger.info(f"User message (async stream): '{message}'")
+        await asyncio.to_thread(request.app.state.db_manager.save_chat_message, session_id, message, 'user')
+
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+    async def generate():
+        try:
+            async for event, payload in request.app.state.assistant_manager.aanswer_question_stream(message, session_id=session_id):
+                if event == 'result':
+                    response = await asyncio.to_thread(build_chat_response, session_id, message, payload)
+                    yield sse_event('result', response)
+                else:
+                    yield sse_event(event, {'text': payload})
+        except Exception as e:
+            logger.error(f"Error in chat stream: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+# ==================== Application ====================
+
+@asynccontextmanager
+async def lifespan(app):
+    logger.info("ASSISTANT API (ASGI) - Starting")
+    # Открытие и миграция БД, загрузка инструкций — синхронные, вне event loop
+    await asyncio.to_thread(init_app)
+    app.state.db_manager = assistant_api.db_manager
+    app.state.assistant_manager = assistant_api.assistant_manager
+    logger.info(
+        f"Assistant Status: {'✅ Ready' if app.state.assistant_manager.instructions_loaded else '⚠️ Initializing'}"
+    )
+    yield
+    await close_async_transport()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['POST']),
+        # Все остальные маршруты — Flask-приложение как есть
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
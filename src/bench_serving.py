@@ -0,0 +1,250 @@
+# bench_serving.py - Сравнение многопоточного Flask-режима и ASGI-режима API под нагрузкой
+#
+# Поднимает локальный имитатор LLM-провайдера с заданной задержкой, по очереди
+# запускает assistant_api (Flask, threaded) и assistant_asgi (uvicorn) на копии
+# ai_assistant.db и отправляет N одновременных /api/chat с уникальными
+# вопросами (чтобы не срабатывали fast path, кэш ответов и single-flight).
+#
+# Пример:
+#     python bench_serving.py --concurrency 50 200 1000 --llm-latency 2
+#
+# pip install starlette uvicorn aiohttp a2wsgi
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+import requests
+
+SRC_DIR = Path(__file__).resolve().parent
+
+FAKE_ANSWER = json.dumps({
+    "relevance_score": 0.9,
+    "instruction": "Инструкция",
+    "reasoning": "benchmark",
+    "description": "Шаг 1: benchmark",
+}, ensure_ascii=False)
+
+
+# ==================== Имитатор провайдера ====================
+
+def run_fake_provider(port: int, latency: float) -> None:
+    """OpenAI-совместимый /chat/completions, отвечающий через latency секунд"""
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    async def completions(request):
+        await request.body()
+        await asyncio.sleep(latency)
+        return JSONResponse({"choices": [{"message": {"content": FAKE_ANSWER}}]})
+
+    app = Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", backlog=4096)
+
+
+# ==================== Вспомогательные функции ====================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=2.0)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.3)
+    raise RuntimeError(f"Server at {url} did not start in {timeout}s")
+
+
+def process_stats(pid: int) -> Dict[str, Any]:
+    """Число потоков и RSS процесса (Linux, /proc)"""
+    stats: Dict[str, Any] = {}
+    status = Path(f"/proc/{pid}/status")
+    if not status.exists():
+        return stats
+    for line in status.read_text().splitlines():
+        if line.startswith("Threads:"):
+            stats["threads"] = int(line.split()[1])
+        elif line.startswith("VmRSS:"):
+            stats["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    return stats
+
+
+def start_server(mode: str, port: int, workdir: str, env: Dict[str, str]) -> subprocess.Popen:
+    if mode == "flask":
+        code = (
+            "import assistant_api; "
+            f"assistant_api.init_app().run(host='127.0.0.1', port={port}, threaded=True, debug=False)"
+        )
+        cmd = [sys.executable, "-c", code]
+    else:
+        cmd = [
+            sys.executable, "-m", "uvicorn", "assistant_asgi:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning", "--backlog", "4096",
+        ]
+    return subprocess.Popen(
+        cmd, cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+# ==================== Нагрузка ====================
+
+async def run_load(base_url: str, concurrency: int, query: str, run_id: str, pid: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    answered_by: Counter = Counter()
+    errors: int = 0
+    peak: Dict[str, Any] = {}
+    done = asyncio.Event()
+
+    async def sample_process():
+        while not done.is_set():
+            for key, value in process_stats(pid).items():
+                peak[key] = max(peak.get(key, 0), value)
+            await asyncio.sleep(0.2)
+
+    async def one(session: aiohttp.ClientSession, i: int):
+        nonlocal errors
+        # Уникальные хвосты: вопрос не совпадает с задачей и с другими вопросами
+        message = f"{query} {run_id} {i} {i * 7919}"
+        start = time.perf_counter()
+        try:
+            async with session.post(
+                f"{base_url}/api/chat",
+                json={"message": message},
+                headers={"X-Session-ID": f"bench-{run_id}-{i}"},
+            ) as response:
+                data = await response.json()
+                if response.status != 200:
+                    errors += 1
+                    return
+            answered_by[(data.get("search_result") or {}).get("answered_by", data.get("type"))] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            errors += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=300.0)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        sampler = asyncio.create_task(sample_process())
+        started = time.perf_counter()
+        await asyncio.gather(*(one(session, i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await sampler
+
+    latencies.sort()
+
+    def pct(p: float) -> Optional[float]:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+    return {
+        "requests": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "wall_s": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_s": pct(0.50),
+        "p95_s": pct(0.95),
+        "p99_s": pct(0.99),
+        "mean_s": round(statistics.mean(latencies), 3) if latencies else None,
+        "answered_by": dict(answered_by),
+        **{f"peak_{k}": v for k, v in peak.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark threaded Flask vs ASGI serving of /api/chat")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000], help="Concurrent chats per round")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="Simulated provider latency, seconds")
+    parser.add_argument("--modes", nargs="+", choices=["flask", "asgi"], default=["flask", "asgi"])
+    parser.add_argument("--db", default=str(SRC_DIR / "ai_assistant.db"), help="Database copied for each server")
+    parser.add_argument("--query", default="как оформить заказ", help="Question prefix that retrieval can match")
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--fake-provider-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fake_provider_port:
+        run_fake_provider(args.fake_provider_port, args.llm_latency)
+        return
+
+    provider_port = free_port()
+    provider = subprocess.Popen(
+        [sys.executable, __file__, "--fake-provider-port", str(provider_port), "--llm-latency", str(args.llm_latency)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    results: List[Dict[str, Any]] = []
+
+    try:
+        max_concurrency = max(args.concurrency)
+        env = dict(
+            os.environ,
+            PYTHONPATH=str(SRC_DIR),
+            OPENROUTER_API_KEY=os.getenv("OPENROUTER_API_KEY", "bench"),
+            CHAT_LLM_API_URL=f"http://127.0.0.1:{provider_port}/v1/chat/completions",
+            # Сравниваем модели обслуживания, а не лимиты: допуск и пул не должны ограничивать
+            LLM_MAX_CONCURRENCY=str(max_concurrency),
+            LLM_QUEUE_SIZE=str(max_concurrency),
+            LLM_POOL_SIZE=str(max_concurrency),
+            INSTRUCTIONS_RELOAD_INTERVAL="0",
+        )
+        wait_ready(f"http://127.0.0.1:{provider_port}/")
+
+        for mode in args.modes:
+            with tempfile.TemporaryDirectory() as workdir:
+                shutil.copy(args.db, Path(workdir) / "ai_assistant.db")
+                port = free_port()
+                server = start_server(mode, port, workdir, env)
+                try:
+                    base_url = f"http://127.0.0.1:{port}"
+                    wait_ready(f"{base_url}/api/health")
+                    for concurrency in args.concurrency:
+                        stats = asyncio.run(run_load(base_url, concurrency, args.query, f"{mode}{concurrency}", server.pid))
+                        stats["mode"] = mode
+                        results.append(stats)
+                        print(json.dumps(stats, ensure_ascii=False), flush=True)
+                finally:
+                    server.terminate()
+                    server.wait(timeout=30)
+    finally:
+        provider.terminate()
+        provider.wait(timeout=30)
+
+    print()
+    print(f"{'mode':<6} {'conc':>6} {'ok':>6} {'err':>5} {'rps':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'threads':>8} {'rss_mb':>8}")
+    for r in results:
+        print(
+            f"{r['mode']:<6} {r['requests']:>6} {r['ok']:>6} {r['errors']:>5} {r['rps']:>8} "
+            f"{r['p50_s'] or '-':>7} {r['p95_s'] or '-':>7} {r['p99_s'] or '-':>7} "
+            f"{r.get('peak_threads', '-'):>8} {r.get('peak_rss_mb', '-'):>8}"
+        )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
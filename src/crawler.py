@@ -0,0 +1,439 @@
+# crawler.py - Параллельный обход сайта для анализатора (вместо download_html.py)
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urldefrag, urlencode, urljoin, urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from page_store import PageStore, Snapshot
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация по умолчанию (переопределяется переменными окружения и флагами analyzer.py)
+CRAWL_MAX_PAGES: int = int(os.getenv("CRAWL_MAX_PAGES", "2000"))
+CRAWL_MAX_DEPTH: int = int(os.getenv("CRAWL_MAX_DEPTH", "3"))
+CRAWL_CONCURRENCY: int = int(os.getenv("CRAWL_CONCURRENCY", "16"))
+CRAWL_PER_HOST_LIMIT: int = int(os.getenv("CRAWL_PER_HOST_LIMIT", "8"))
+CRAWL_TIMEOUT: float = float(os.getenv("CRAWL_TIMEOUT", "30"))
+CRAWL_USER_AGENT: str = os.getenv("CRAWL_USER_AGENT", "SiteAnalyzer/1.0 (+instruction assistant)")
+
+# Параметры запроса, которые не меняют содержимое страницы
+_TRACKING_PARAMS: Tuple[str, ...] = ("utm_", "gclid", "fbclid", "yclid", "_openstat")
+
+# Ссылки на файлы, которые не являются страницами
+_SKIP_EXTENSIONS: Tuple[str, ...] = (
+    ".jpg", ".jpeg", ".png", ".gif", ".svg", ".webp", ".ico", ".css", ".js", ".json",
+    ".pdf", ".zip", ".gz", ".mp4", ".mp3", ".woff", ".woff2", ".ttf", ".xml",
+)
+
+# Ответы, после которых страница считается удалённой (остальные ошибки — временные)
+GONE_STATUSES: Tuple[int, ...] = (404, 410)
+
+
+@dataclass
+class Page:
+    """Скачанная страница сайта"""
+    url: str                  # канонический URL (ключ дедупликации)
+    final_url: str            # адрес после редиректов
+    status: int
+    content_type: str
+    text: str
+    depth: int
+    links: List[str] = field(default_factory=list)
+    elapsed_ms: float = 0.0
+    content_hash: str = ""    # sha256 тела (если обход идёт с хранилищем снимков)
+    changed: bool = True      # тело отличается от базовой версии в хранилище
+    from_cache: bool = False  # сервер ответил 304, тело взято из хранилища
+
+
+# ==================== Канонизация URL ====================
+
+def canonical_url(url: str) -> str:
+    """
+    Канонический вид URL для дедупликации
+
+    Схема и хост в нижнем регистре, без порта по умолчанию, фрагмента и
+    трекинговых параметров; параметры запроса отсортированы.
+    """
+    url, _ = urldefrag(url.strip())
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(_TRACKING_PARAMS)
+    ))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def site_of(url: str) -> str:
+    """Сайт URL: хост без www. (поддомены считаются тем же сайтом)"""
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def is_same_site(url: str, site: str) -> bool:
+    host = site_of(url)
+    return host == site or host.endswith("." + site)
+
+
+class _LinkParser(HTMLParser):
+    """Собирает href ссылок и <base href> страницы"""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.base: Optional[str] = None
+        self.hrefs: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag not in ("a", "area", "base"):
+            return
+        attributes = dict(attrs)
+        href = attributes.get("href")
+        if not href:
+            return
+        if tag == "base":
+            self.base = self.base or href
+        elif "nofollow" not in (attributes.get("rel") or "").lower():
+            self.hrefs.append(href)
+
+
+def extract_links(html: str, page_url: str) -> List[str]:
+    """
+    Абсолютные канонические http(s)-ссылки страницы без повторов
+
+    Args:
+        html: Тело страницы (str)
+        page_url: Адрес страницы после редиректов (str)
+    """
+    parser = _LinkParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:  # битая разметка не должна останавливать обход
+        logger.debug(f"Link extraction stopped early for {page_url}: {e}")
+
+    base = urljoin(page_url, parser.base) if parser.base else page_url
+    links: List[str] = []
+    seen: Set[str] = set()
+    for href in parser.hrefs:
+        href = href.strip()
+        if href.startswith(("mailto:", "tel:", "javascript:", "#")):
+            continue
+        url = canonical_url(urljoin(base, href))
+        if not url.startswith(("http://", "https://")) or url in seen:
+            continue
+        if urlsplit(url).path.lower().endswith(_SKIP_EXTENSIONS):
+            continue
+        seen.add(url)
+        links.append(url)
+    return links
+
+
+# ==================== Обход ====================
+
+class SiteCrawler:
+    """
+    Обход сайта в несколько потоков.
+
+    Страницы скачиваются параллельно через общий keep-alive пул с лимитом
+    одновременных запросов на хост, ссылки того же сайта обходятся в ширину
+    до max_depth, пока не исчерпан бюджет max_pages. Каждый канонический URL
+    скачивается один раз. crawl() отдаёт страницы по мере скачивания.
+
+    С хранилищем снимков (store) запросы условные: на 304 тело берётся
+    из хранилища, а Page.changed показывает, изменилась ли страница.
+
+    Пример использования:
+        crawler = SiteCrawler(max_pages=500, max_depth=2)
+        for page in crawler.crawl(["http://localhost:8000/index.html"]):
+            process(page.url, page.text)
+    """
+
+    def __init__(
+        self,
+        max_pages: int = CRAWL_MAX_PAGES,
+        max_depth: int = CRAWL_MAX_DEPTH,
+        concurrency: int = CRAWL_CONCURRENCY,
+        per_host_limit: int = CRAWL_PER_HOST_LIMIT,
+        timeout: float = CRAWL_TIMEOUT,
+        same_site: bool = True,
+        respect_robots: bool = True,
+        user_agent: str = CRAWL_USER_AGENT,
+        store: Optional[PageStore] = None,
+    ) -> None:
+        """
+        Args:
+            max_pages: Максимум скачиваемых страниц за обход (int)
+            max_depth: Глубина перехода по ссылкам от стартовых URL, 0 — только они (int)
+            concurrency: Одновременные загрузки (int)
+            per_host_limit: Одновременные загрузки с одного хоста (int)
+            timeout: Таймаут соединения и чтения, сек (float)
+            same_site: Переходить только по ссылкам сайтов стартовых URL (bool)
+            respect_robots: Учитывать robots.txt (bool)
+            user_agent: Заголовок User-Agent (str)
+            store: Хранилище снимков для условных запросов (Optional[PageStore])
+        """
+        self.max_pages: int = max_pages
+        self.max_depth: int = max_depth
+        self.concurrency: int = max(1, concurrency)
+        self.per_host_limit: int = max(1, per_host_limit)
+        self.timeout: float = timeout
+        self.same_site: bool = same_site
+        self.respect_robots: bool = respect_robots
+        self.user_agent: str = user_agent
+        self.store: Optional[PageStore] = store
+
+        self.session: requests.Session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._robots: Dict[str, Optional[RobotFileParser]] = {}
+
+        # Статистика последнего обхода
+        self.fetched: int = 0
+        self.failed: int = 0
+        self.skipped: int = 0
+        self.not_modified: int = 0
+        self.changed: int = 0
+        self.bytes: int = 0
+        self.truncated: bool = False  # лимит max_pages отбросил найденные ссылки
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return slot
+
+    def _allowed(self, url: str) -> bool:
+        """Разрешён ли URL robots.txt его хоста (robots.txt загружается один раз)"""
+        if not self.respect_robots:
+            return True
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            known = origin in self._robots
+            robots = self._robots.get(origin)
+        if not known:
+            robots = None
+            try:
+                response = self.session.get(f"{origin}/robots.txt", timeout=self.timeout)
+                if response.status_code == 200:
+                    robots = RobotFileParser()
+                    robots.parse(response.text.splitlines())
+            except requests.exceptions.RequestException:
+                pass
+            with self._lock:
+                self._robots[origin] = robots
+        return robots is None or robots.can_fetch(self.user_agent, url)
+
+    def _fetch(self, url: str, depth: int) -> Optional[Page]:
+        """Скачивает одну страницу; None — не HTML, запрещено robots.txt или ошибка"""
+        if not self._allowed(url):
+            logger.info(f"Skipped by robots.txt: {url}")
+            with self._lock:
+                self.skipped += 1
+            return None
+
+        started = time.time()
+        headers: Dict[str, str] = self.store.conditional_headers(url) if self.store else {}
+        try:
+            with self._host_slot(url):
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+                if response.status_code == 304:
+                    cached = self.store.revalidate(url, response.headers) if self.store else None
+                    if cached is not None:
+                        return self._cached_page(url, depth, cached, started)
+                    # Снимок пропал из хранилища — скачиваем тело заново
+                    response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"⚠️ Failed to fetch {url}: {e}")
+            with self._lock:
+                self.failed += 1
+            # 404/410 — страницы нет; остальное (сеть, таймаут, 5xx, 429) — временная ошибка
+            status = e.response.status_code if e.response is not None else None
+            if self.store and status not in GONE_STATUSES:
+                self.store.mark_failed(url)
+            return None
+
+        content_type = response.headers.get("Content-Type", "")
+        if "html" not in content_type.lower():
+            with self._lock:
+                self.skipped += 1
+            return None
+
+        # Без charset в заголовке requests берёт ISO-8859-1; сайты отдают UTF-8
+        if "charset" not in content_type.lower():
+            response.encoding = "utf-8"
+        text = response.text
+
+        content_hash: str = ""
+        changed: bool = True
+        if self.store:
+            snapshot, changed = self.store.save(
+                url, text, response.url, content_type,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+            content_hash = snapshot.content_hash
+
+        with self._lock:
+            self.fetched += 1
+            self.changed += changed
+            self.bytes += len(response.content)
+        return Page(
+            url=url,
+            final_url=response.url,
+            status=response.status_code,
+            content_type=content_type,
+            text=text,
+            depth=depth,
+            links=extract_links(text, response.url),
+            elapsed_ms=(time.time() - started) * 1000,
+            content_hash=content_hash,
+            changed=changed,
+        )
+
+    def _cached_page(self, url: str, depth: int, cached: Tuple[Snapshot, bool], started: float) -> Page:
+        """Страница из хранилища снимков после ответа 304"""
+        snapshot, changed = cached
+        with self._lock:
+            self.fetched += 1
+            self.not_modified += 1
+            self.changed += changed
+        return Page(
+            url=url,
+            final_url=snapshot.final_url,
+            status=304,
+            content_type=snapshot.content_type,
+            text=snapshot.text,
+            depth=depth,
+            links=extract_links(snapshot.text, snapshot.final_url),
+            elapsed_ms=(time.time() - started) * 1000,
+            content_hash=snapshot.content_hash,
+            changed=changed,
+            from_cache=True,
+        )
+
+    # ---------- Публичные методы ----------
+
+    def crawl(self, seeds: Iterable[str]) -> Iterator[Page]:
+        """
+        Обходит сайт от стартовых URL
+
+        Args:
+            seeds: Стартовые URL (список страниц или один корень сайта)
+
+        Yields:
+            Page по мере скачивания (порядок — порядок завершения загрузок)
+        """
+        self.fetched = self.failed = self.skipped = self.bytes = 0
+        self.not_modified = self.changed = 0
+        self.truncated = False
+        if self.store:
+            self.store.begin_run()
+        started = time.time()
+
+        seen: Set[str] = set()
+        frontier: Deque[Tuple[str, int]] = deque()
+        for seed in seeds:
+            url = canonical_url(seed)
+            if url in seen:
+                continue
+            if len(seen) >= self.max_pages:
+                self.truncated = True
+                break
+            seen.add(url)
+            frontier.append((url, 0))
+        sites: Set[str] = {site_of(url) for url, _ in frontier}
+
+        logger.info(
+            f"🕷️ Crawling {len(frontier)} seed URL(s): max_pages={self.max_pages}, "
+            f"max_depth={self.max_depth}, concurrency={self.concurrency}, per_host={self.per_host_limit}"
+        )
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="crawler") as executor:
+            pending: Dict[Future, Tuple[str, int]] = {}
+            while frontier or pending:
+                while frontier and len(pending) < self.concurrency:
+                    url, depth = frontier.popleft()
+                    pending[executor.submit(self._fetch, url, depth)] = (url, depth)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, depth = pending.pop(future)
+                    page = future.result()
+                    if page is None:
+                        continue
+
+                    # Редирект на уже известную страницу — дубль
+                    final = canonical_url(page.final_url)
+                    if final != url:
+                        if final in seen:
+                            continue
+                        seen.add(final)
+
+                    if depth < self.max_depth:
+                        for link in page.links:
+                            if link in seen or (self.same_site and not any(is_same_site(link, s) for s in sites)):
+                                continue
+                            if len(seen) >= self.max_pages:
+                                self.truncated = True
+                                break
+                            seen.add(link)
+                            frontier.append((link, depth + 1))
+
+                    yield page
+
+        if self.truncated and self.store:
+            self.store.mark_truncated()
+
+        elapsed = time.time() - started
+        logger.info(
+            f"✅ Crawl finished: {self.fetched} pages ({self.not_modified} not modified, "
+            f"{self.changed} changed), {self.failed} failed, {self.skipped} skipped, "
+            f"{self.bytes / 1024:.0f} KiB in {elapsed:.1f}s"
+        )
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика последнего обхода
+
+        Returns:
+            Счётчики скачанных, неудачных и пропущенных страниц (Dict[str, Any])
+        """
+        return {
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "not_modified": self.not_modified,
+            "changed": self.changed,
+            "bytes": self.bytes,
+            "truncated": self.truncated,
+        }
+
+    def close(self) -> None:
+        """Закрывает соединения пула"""
+        self.session.close()
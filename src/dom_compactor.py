@@ -0,0 +1,420 @@
+# dom_compactor.py - Сжатие dom_analysis перед генерацией дерева задач
+#
+# Полное дерево DOM раздувает промпт: у каждого контейнера повторяется
+# textContent потомков, сотни одинаковых карточек товаров идут подряд,
+# шапка и подвал повторяются на каждой странице. Компактор оставляет
+# интерактивные элементы и их контекст (заголовки, подписи), сворачивает
+# повторяющиеся структуры в шаблоны со счётчиками, общие блоки страниц —
+# в ссылки, а страницы одинаковой структуры — в одну группу.
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from dom_extractor import INTERACTIVE_TAGS
+
+logger = logging.getLogger(__name__)
+
+# Сколько одинаковых соседних элементов сворачивать в шаблон
+COMPACT_REPEAT_MIN: int = int(os.getenv("COMPACT_REPEAT_MIN", "3"))
+# Максимальная длина текста элемента в сжатом дереве
+COMPACT_TEXT_LIMIT: int = int(os.getenv("COMPACT_TEXT_LIMIT", "80"))
+# Сколько примеров текста сохранять для шаблона и группы страниц
+COMPACT_EXAMPLES: int = int(os.getenv("COMPACT_EXAMPLES", "3"))
+# Одинаковые элементы с одним действием внутри (пункты меню li>a, группы
+# формы label+input) сворачиваются, только если их больше: каждый — отдельное действие
+COMPACT_LEAF_RUN_MAX: int = int(os.getenv("COMPACT_LEAF_RUN_MAX", "12"))
+# Минимальный размер (узлов) блока, выносимого в shared
+COMPACT_SHARED_MIN_NODES: int = int(os.getenv("COMPACT_SHARED_MIN_NODES", "3"))
+
+# Не несут действий и контекста
+DROP_TAGS = frozenset({
+    "head", "script", "style", "noscript", "template", "svg", "canvas", "meta", "link",
+    "br", "hr", "img", "picture", "source", "iframe",
+})
+# Неинтерактивные элементы, текст которых — контекст для действий
+CONTEXT_TAGS = frozenset({
+    "h1", "h2", "h3", "h4", "h5", "h6", "label", "legend", "caption", "th", "summary",
+    "dt", "figcaption",
+})
+# Интерактивные элементы, вложенные элементы которых не нужны (текст уже в них)
+LEAF_INTERACTIVE = frozenset({"a", "button", "label", "option", "summary", "textarea"})
+INTERACTIVE_ATTRS = frozenset({"onclick", "role", "tabindex", "contenteditable"})
+KEEP_ATTRS = frozenset({
+    "id", "class", "href", "type", "name", "placeholder", "value", "for", "action",
+    "method", "role", "aria-label", "title", "alt",
+})
+
+LEGEND: str = (
+    "Сжатое дерево DOM: tag/attrs/text/children. "
+    "{template, count, examples} — элемент из templates, повторяется count раз подряд "
+    "(examples — тексты первых экземпляров); {shared} — блок из shared, одинаковый на нескольких "
+    "страницах; группа pages с count > 1 — страницы одинаковой структуры (files и titles — примеры)."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора модели
+
+    Латиница и JSON-разметка — около 4 символов на токен, кириллица и
+    прочие символы вне ASCII — около 2.
+    """
+    ascii_chars: int = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+
+def _short(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+class DOMCompactor:
+    """
+    Сжатие dom_analysis для промпта генерации дерева задач.
+
+    Исходный dom_analysis не меняется (полная версия сохраняется как
+    контекст инструкций), compact() возвращает новую структуру и запоминает
+    отчёт о сокращении промпта.
+
+    Пример использования:
+        compactor = DOMCompactor()
+        prompt_input = compactor.compact(dom_analysis)
+        logger.info(compactor.get_info())
+    """
+
+    def __init__(
+        self,
+        repeat_min: int = COMPACT_REPEAT_MIN,
+        text_limit: int = COMPACT_TEXT_LIMIT,
+        examples: int = COMPACT_EXAMPLES,
+        shared_min_nodes: int = COMPACT_SHARED_MIN_NODES,
+        leaf_run_max: int = COMPACT_LEAF_RUN_MAX,
+    ) -> None:
+        """
+        Args:
+            repeat_min: Сколько одинаковых соседей сворачивать в шаблон (int)
+            text_limit: Максимальная длина текста элемента (int)
+            examples: Примеров текста на шаблон и группу страниц (int)
+            shared_min_nodes: Минимальный размер общего блока страниц, узлов (int)
+            leaf_run_max: Сколько одинаковых элементов с одним действием подряд оставлять как есть (int)
+        """
+        self.repeat_min: int = max(2, repeat_min)
+        self.text_limit: int = text_limit
+        self.examples: int = examples
+        self.shared_min_nodes: int = shared_min_nodes
+        self.leaf_run_max: int = leaf_run_max
+        self.report: Dict[str, Any] = {}
+
+        self._templates: Dict[Any, str] = {}
+        self._template_nodes: Dict[str, Dict[str, Any]] = {}
+
+    # ---------- Отбор элементов ----------
+
+    @staticmethod
+    def _attributes(attributes: Dict[str, str]) -> Dict[str, str]:
+        kept: Dict[str, str] = {}
+        for name, value in attributes.items():
+            if name in KEEP_ATTRS or name.startswith("data-"):
+                if name == "href" and (not value or value == "#" or value.startswith("javascript:")):
+                    continue
+                kept[name] = value
+        return kept
+
+    @staticmethod
+    def _is_interactive(node: Dict[str, Any]) -> bool:
+        return node["tagName"] in INTERACTIVE_TAGS or any(a in node["attributes"] for a in INTERACTIVE_ATTRS)
+
+    def _compact_node(self, node: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Интерактивные элементы, их контейнеры и контекст; остальное отбрасывается"""
+        tag: str = node["tagName"]
+        if tag in DROP_TAGS:
+            return None
+
+        attrs = self._attributes(node["attributes"])
+        text: str = _short(node["textContent"], self.text_limit)
+        interactive: bool = self._is_interactive(node)
+
+        if interactive and tag == "select":
+            out: Dict[str, Any] = {"tag": tag}
+            if attrs:
+                out["attrs"] = attrs
+            out["options"] = [
+                _short(child["textContent"], self.text_limit)
+                for child in node["children"] if child["tagName"] == "option"
+            ]
+            return out
+
+        if interactive and tag in LEAF_INTERACTIVE:
+            out = {"tag": tag}
+            if attrs:
+                out["attrs"] = attrs
+            if text:
+                out["text"] = text
+            return out
+
+        children: List[Dict[str, Any]] = []
+        for child in node["children"]:
+            compacted = self._compact_node(child)
+            if compacted is not None:
+                children.append(compacted)
+
+        if interactive:
+            out = {"tag": tag}
+            if attrs:
+                out["attrs"] = attrs
+            if children:
+                out["children"] = children
+            elif text:
+                out["text"] = text
+            return out
+
+        # Контейнер нужен, только если внутри есть действия (не одни заголовки)
+        has_interactive: bool = any(child.get("tag") not in CONTEXT_TAGS for child in children)
+        if has_interactive:
+            # Контейнер без атрибутов с одним потомком — лишний уровень
+            if not attrs and len(children) == 1:
+                return children[0]
+            out = {"tag": tag}
+            if attrs:
+                out["attrs"] = attrs
+            out["children"] = children
+            return out
+
+        if tag in CONTEXT_TAGS and text:
+            return {"tag": tag, "text": text}
+        return None
+
+    # ---------- Шаблоны повторяющихся элементов ----------
+
+    def _shape(self, node: Dict[str, Any]) -> Any:
+        """Структура узла без текстов и значений: (tag, class, структуры потомков)"""
+        if "template" in node:
+            return ("template", node["template"])
+        if "shared" in node:
+            return ("shared", node["shared"])
+        return (
+            node.get("tag"),
+            node.get("attrs", {}).get("class", ""),
+            tuple(self._shape(child) for child in node.get("children", ())),
+        )
+
+    @staticmethod
+    def _texts(node: Dict[str, Any]) -> str:
+        parts: List[str] = []
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.get("text"):
+                parts.append(current["text"])
+            stack.extend(reversed(current.get("children", ())))
+        return " / ".join(parts)
+
+    def _actions(self, node: Dict[str, Any]) -> int:
+        """Число действий в сжатом узле: листья, кроме контекста (заголовков и подписей)"""
+        if "template" in node or "shared" in node:
+            return 2
+        children = node.get("children")
+        if not children:
+            return 0 if node.get("tag") in CONTEXT_TAGS else 1
+        return sum(self._actions(child) for child in children)
+
+    def _fold_repeats(self, node: Dict[str, Any]) -> Dict[str, Any]:
+        """Сворачивает одинаковые по структуре соседние элементы в ссылку на шаблон"""
+        children = node.get("children")
+        if not children:
+            return node
+        children = [self._fold_repeats(child) for child in children]
+
+        folded: List[Dict[str, Any]] = []
+        index = 0
+        while index < len(children):
+            shape = self._shape(children[index])
+            end = index + 1
+            while end < len(children) and self._shape(children[end]) == shape:
+                end += 1
+            run = children[index:end]
+            # Элементы с одним действием (меню, поля формы) — каждый в промпте, пока их немного
+            limit: int = self.leaf_run_max + 1 if self._actions(run[0]) <= 1 else self.repeat_min
+            if len(run) >= max(self.repeat_min, limit) and "template" not in run[0] and "shared" not in run[0]:
+                template_id = self._templates.get(shape)
+                if template_id is None:
+                    template_id = f"t{len(self._templates) + 1}"
+                    self._templates[shape] = template_id
+                    self._template_nodes[template_id] = run[0]
+                examples: List[str] = []
+                for item in run:
+                    text = self._texts(item)
+                    if text and text not in examples:
+                        examples.append(_short(text, self.text_limit))
+                    if len(examples) >= self.examples:
+                        break
+                ref: Dict[str, Any] = {"template": template_id, "count": len(run)}
+                if examples:
+                    ref["examples"] = examples
+                folded.append(ref)
+            else:
+                folded.extend(run)
+            index = end
+
+        node = dict(node)
+        node["children"] = folded
+        return node
+
+    # ---------- Общие блоки страниц ----------
+
+    def _digest(self, node: Dict[str, Any], memo: Dict[int, Tuple[str, int]]) -> Tuple[str, int]:
+        """Хэш содержимого и размер поддерева (снизу вверх, каждый узел — один раз)"""
+        cached = memo.get(id(node))
+        if cached is not None:
+            return cached
+        children = [self._digest(child, memo) for child in node.get("children", ())]
+        own = {key: value for key, value in node.items() if key != "children"}
+        payload = json.dumps(own, ensure_ascii=False, sort_keys=True) + "".join(d for d, _ in children)
+        result = (hashlib.sha1(payload.encode("utf-8")).hexdigest(), 1 + sum(n for _, n in children))
+        memo[id(node)] = result
+        return result
+
+    def _collect_blocks(
+        self,
+        node: Dict[str, Any],
+        page: int,
+        seen: Dict[str, set],
+        memo: Dict[int, Tuple[str, int]],
+    ) -> None:
+        digest, size = self._digest(node, memo)
+        if size < self.shared_min_nodes:
+            return
+        seen.setdefault(digest, set()).add(page)
+        for child in node.get("children", ()):
+            self._collect_blocks(child, page, seen, memo)
+
+    def _extract_shared(
+        self,
+        node: Dict[str, Any],
+        common: Dict[str, int],
+        shared: Dict[str, Dict[str, Any]],
+        ids: Dict[str, str],
+        memo: Dict[int, Tuple[str, int]],
+        root: bool = False,
+    ) -> Dict[str, Any]:
+        """Заменяет блоки, общие для нескольких страниц, ссылками на shared (сверху вниз)"""
+        if not root:
+            digest, size = self._digest(node, memo)
+            if size >= self.shared_min_nodes and digest in common:
+                if digest not in ids:
+                    ids[digest] = f"s{len(ids) + 1}"
+                    shared[ids[digest]] = node
+                return {"shared": ids[digest]}
+        if not node.get("children"):
+            return node
+        node = dict(node)
+        node["children"] = [
+            self._extract_shared(child, common, shared, ids, memo) for child in node["children"]
+        ]
+        return node
+
+    # ---------- Публичные методы ----------
+
+    def compact(self, dom_analysis: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Сжатое представление dom_analysis для промпта
+
+        Args:
+            dom_analysis: Результат DOMAnalyzer.download_and_analyze (Dict[str, Any])
+
+        Returns:
+            Словарь legend/summary/shared/templates/pages (Dict[str, Any])
+        """
+        self._templates = {}
+        self._template_nodes = {}
+
+        # 1. Отбор элементов и шаблоны повторов внутри страниц
+        pages: List[Tuple[str, str, Dict[str, Any]]] = []
+        nodes_before: int = 0
+        for result in dom_analysis.get("results", []):
+            tree: Dict[str, Any] = result["domTree"]
+            nodes_before += tree.get("elementCount", 0) + 1
+            title: str = ""
+            body: Optional[Dict[str, Any]] = None
+            for child in tree.get("children", []):
+                if child["tagName"] == "head":
+                    title = next(
+                        (c["textContent"] for c in child["children"] if c["tagName"] == "title"), ""
+                    )
+                elif child["tagName"] == "body":
+                    body = child
+            compacted = self._compact_node(body) if body is not None else None
+            compacted = self._fold_repeats(compacted) if compacted else {"tag": "body"}
+            pages.append((result.get("file", ""), title, compacted))
+
+        # 2. Блоки, одинаковые на нескольких страницах (шапка, меню, подвал)
+        shared: Dict[str, Dict[str, Any]] = {}
+        if len(pages) > 1:
+            seen: Dict[str, set] = {}
+            memo: Dict[int, Tuple[str, int]] = {}
+            for index, (_, _, tree) in enumerate(pages):
+                for child in tree.get("children", ()):
+                    self._collect_blocks(child, index, seen, memo)
+            common = {digest: len(owners) for digest, owners in seen.items() if len(owners) > 1}
+            ids: Dict[str, str] = {}
+            pages = [
+                (file, title, self._extract_shared(tree, common, shared, ids, memo, root=True))
+                for file, title, tree in pages
+            ]
+
+        # 3. Страницы одинаковой структуры — одна группа
+        groups: Dict[Any, Dict[str, Any]] = {}
+        for file, title, tree in pages:
+            shape = self._shape(tree)
+            group = groups.get(shape)
+            if group is None:
+                groups[shape] = {"files": [file], "count": 1, "titles": [title] if title else [], "tree": tree}
+                continue
+            group["count"] += 1
+            if len(group["files"]) < self.examples:
+                group["files"].append(file)
+            if title and title not in group["titles"] and len(group["titles"]) < self.examples:
+                group["titles"].append(title)
+
+        compacted: Dict[str, Any] = {
+            "legend": LEGEND,
+            "analyzedAt": dom_analysis.get("analyzedAt"),
+            "summary": dom_analysis.get("summary", {}),
+            "shared": shared,
+            "templates": self._template_nodes,
+            "pages": list(groups.values()),
+        }
+
+        before: str = json.dumps(dom_analysis, ensure_ascii=False)
+        after: str = json.dumps(compacted, ensure_ascii=False)
+        tokens_before: int = estimate_tokens(before)
+        tokens_after: int = estimate_tokens(after)
+        self.report = {
+            "pages": len(pages),
+            "page_groups": len(groups),
+            "templates": len(self._template_nodes),
+            "shared_blocks": len(shared),
+            "nodes_before": nodes_before,
+            "chars_before": len(before),
+            "chars_after": len(after),
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "reduction": round(tokens_before / tokens_after, 1) if tokens_after else 0.0,
+        }
+        logger.info(
+            f"🗜️ DOM compacted: ~{tokens_before} -> ~{tokens_after} tokens "
+            f"(x{self.report['reduction']}), {len(groups)} page groups, "
+            f"{len(self._template_nodes)} templates, {len(shared)} shared blocks"
+        )
+        return compacted
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Отчёт о последнем сжатии
+
+        Returns:
+            Размеры до/после в символах и оценочных токенах (Dict[str, Any])
+        """
+        return dict(self.report)
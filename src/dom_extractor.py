@@ -0,0 +1,382 @@
+# dom_extractor.py - Разбор DOM скачанных страниц в процессе анализатора (вместо node dom_parser.js)
+#
+# Строит ту же структуру dom_analysis, что и dom_parser.js на jsdom: дерево
+# элементов с атрибутами, нормализованным textContent (до 200 символов) и
+# числом потомков, плюс сводку по страницам. HTML разбирается потоковым
+# html.parser без построения полного документа; страницы разбираются
+# в пуле процессов, результат возвращается в памяти.
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+import multiprocessing
+from typing import Any, Dict, Iterable, List, Optional, Sized, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Процессы разбора DOM (1 — разбирать в текущем процессе)
+DOM_EXTRACT_WORKERS: int = int(os.getenv("DOM_EXTRACT_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# Длина textContent в UTF-16 единицах, как у String.prototype.substring в dom_parser.js
+TEXT_LIMIT: int = 200
+
+# Элементы, которые dom_parser.js считает интерактивными
+INTERACTIVE_TAGS = frozenset({"a", "button", "input", "select", "textarea", "form"})
+
+VOID_TAGS = frozenset({
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+    "link", "meta", "param", "source", "track", "wbr",
+})
+HEAD_TAGS = frozenset({"base", "link", "meta", "noscript", "script", "style", "template", "title"})
+
+# Открытие этих элементов закрывает незакрытый <p> (правила HTML5)
+CLOSES_P = frozenset({
+    "address", "article", "aside", "blockquote", "details", "dialog", "div", "dl",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5",
+    "h6", "header", "hgroup", "hr", "main", "menu", "nav", "ol", "p", "pre", "section",
+    "table", "ul",
+})
+HEADINGS = frozenset({"h1", "h2", "h3", "h4", "h5", "h6"})
+SCOPE_TAGS = frozenset({"html", "body", "table", "td", "th", "button", "caption", "template"})
+
+# Неявные закрытия: открываемый тег -> (что закрыть, где остановить поиск)
+IMPLIED_END: Dict[str, Tuple[frozenset, frozenset]] = {
+    "li": (frozenset({"li"}), frozenset({"ul", "ol"}) | SCOPE_TAGS),
+    "dt": (frozenset({"dt", "dd"}), frozenset({"dl"}) | SCOPE_TAGS),
+    "dd": (frozenset({"dt", "dd"}), frozenset({"dl"}) | SCOPE_TAGS),
+    "option": (frozenset({"option"}), frozenset({"select", "datalist", "optgroup"}) | SCOPE_TAGS),
+    "optgroup": (frozenset({"option", "optgroup"}), frozenset({"select"}) | SCOPE_TAGS),
+    "tr": (frozenset({"tr", "td", "th"}), frozenset({"table", "thead", "tbody", "tfoot"})),
+    "td": (frozenset({"td", "th"}), frozenset({"tr", "table"})),
+    "th": (frozenset({"td", "th"}), frozenset({"tr", "table"})),
+    "thead": (frozenset({"thead", "tbody", "tfoot", "tr", "td", "th"}), frozenset({"table"})),
+    "tbody": (frozenset({"thead", "tbody", "tfoot", "tr", "td", "th"}), frozenset({"table"})),
+    "tfoot": (frozenset({"thead", "tbody", "tfoot", "tr", "td", "th"}), frozenset({"table"})),
+}
+
+
+# ==================== Построение дерева ====================
+
+class _Element:
+    """Открытый элемент: итоговый узел и начало его текста/потомков в общих счётчиках"""
+
+    __slots__ = ("node", "text_start", "count_start")
+
+    def __init__(self, tag: str, attributes: Dict[str, str], text_start: int, count_start: int) -> None:
+        self.node: Dict[str, Any] = {
+            "tagName": tag,
+            "attributes": attributes,
+            "children": [],
+            "textContent": "",
+            "elementCount": 0,
+        }
+        self.text_start: int = text_start
+        self.count_start: int = count_start
+
+    @property
+    def tag(self) -> str:
+        return self.node["tagName"]
+
+
+def _js_substring(text: str, limit: int) -> str:
+    """Первые limit единиц UTF-16 (символы вне BMP занимают две)"""
+    if len(text) <= limit // 2 or len(text.encode("utf-16-le")) <= 2 * limit:
+        return text[:limit]
+    units = 0
+    for index, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            return text[:index]
+    return text
+
+
+class DOMTreeBuilder(HTMLParser):
+    """
+    Потоковый построитель дерева в формате dom_parser.js
+
+    Повторяет то, что делает HTML5-парсер jsdom с обычной разметкой: неявные
+    html/head/body, пустые элементы, неявные закрытия p/li/option/строк
+    таблиц и неявный tbody. textContent — весь текст потомков (включая
+    script/style, как в DOM), пробелы схлопнуты, длина ограничена TEXT_LIMIT.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self._chunks: List[str] = []   # текстовые узлы документа по порядку
+        self._visible: List[int] = []  # непробельных символов в каждом из них
+        self._elements: int = 0        # элементы, открытые с начала документа
+        self.html: _Element = _Element("html", {}, 0, 0)
+        self.head: Optional[_Element] = None
+        self.body: Optional[_Element] = None
+        self._stack: List[_Element] = [self.html]
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    @staticmethod
+    def _attributes(attrs: List[Tuple[str, Optional[str]]]) -> Dict[str, str]:
+        attributes: Dict[str, str] = {}
+        for name, value in attrs:
+            # Повторный атрибут игнорируется, атрибут без значения — пустая строка
+            attributes.setdefault(name, value if value is not None else "")
+        return attributes
+
+    def _text_content(self, start: int) -> str:
+        """Нормализованный текст начиная с chunks[start]; читает не больше, чем нужно для TEXT_LIMIT"""
+        parts: List[str] = []
+        visible: int = 0
+        for index in range(start, len(self._chunks)):
+            parts.append(self._chunks[index])
+            visible += self._visible[index]
+            if visible > TEXT_LIMIT:
+                break
+        return _js_substring(" ".join("".join(parts).split()), TEXT_LIMIT)
+
+    def _open(self, tag: str, attributes: Dict[str, str]) -> _Element:
+        element = _Element(tag, attributes, len(self._chunks), self._elements + 1)
+        self._elements += 1
+        self._stack[-1].node["children"].append(element.node)
+        self._stack.append(element)
+        return element
+
+    def _close_top(self) -> None:
+        element = self._stack.pop()
+        element.node["textContent"] = self._text_content(element.text_start)
+        element.node["elementCount"] = self._elements - element.count_start
+
+    def _close_to(self, index: int) -> None:
+        while len(self._stack) > index:
+            self._close_top()
+
+    def _find(self, tags: frozenset, stop: frozenset) -> int:
+        """Индекс ближайшего открытого элемента из tags до границы stop, иначе -1"""
+        for index in range(len(self._stack) - 1, 0, -1):
+            tag = self._stack[index].tag
+            if tag in tags:
+                return index
+            if tag in stop:
+                break
+        return -1
+
+    def _ensure_head(self) -> _Element:
+        if self.head is None:
+            self.head = self._open("head", {})
+        return self.head
+
+    def _ensure_body(self) -> _Element:
+        if self.body is None:
+            self._ensure_head()
+            if self.head in self._stack:
+                self._close_to(self._stack.index(self.head))
+            self.body = self._open("body", {})
+        return self.body
+
+    # ---------- Обработчики HTMLParser ----------
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        attributes = self._attributes(attrs)
+
+        if tag == "html":
+            for name, value in attributes.items():
+                self.html.node["attributes"].setdefault(name, value)
+            return
+        if tag == "head":
+            if self.head is None and self.body is None:
+                self._ensure_head()
+            return
+        if tag == "body":
+            if self.body is None:
+                self._ensure_body()
+                self.body.node["attributes"].update(attributes)
+            else:
+                for name, value in attributes.items():
+                    self.body.node["attributes"].setdefault(name, value)
+            return
+
+        if self.body is None:
+            if tag in HEAD_TAGS:
+                head = self._ensure_head()
+                if head not in self._stack:
+                    self._stack.append(head)
+            else:
+                self._ensure_body()
+
+        if tag in CLOSES_P:
+            index = self._find(frozenset({"p"}), SCOPE_TAGS)
+            if index > 0:
+                self._close_to(index)
+        if tag in HEADINGS and self._stack[-1].tag in HEADINGS:
+            self._close_top()
+        implied = IMPLIED_END.get(tag)
+        if implied:
+            index = self._find(*implied)
+            if index > 0:
+                self._close_to(index)
+        if tag == "tr" and self._stack[-1].tag == "table":
+            self._open("tbody", {})
+
+        self._open(tag, attributes)
+        if tag in VOID_TAGS:
+            self._close_top()
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        # В HTML «/>» у непустых элементов ничего не значит
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in VOID_TAGS or tag in ("html", "body"):
+            return
+        if tag == "head":
+            if self.head in self._stack:
+                self._close_to(self._stack.index(self.head))
+            return
+        for index in range(len(self._stack) - 1, 0, -1):
+            if self._stack[index].tag == tag:
+                self._close_to(index)
+                return
+
+    def handle_data(self, data: str) -> None:
+        # Непробельный текст вне элементов head открывает body
+        if self.body is None and data.strip() and self._stack[-1] in (self.html, self.head):
+            self._ensure_body()
+        self._chunks.append(data)
+        self._visible.append(len(data) - sum(map(str.isspace, data)))
+
+    # ---------- Публичные методы ----------
+
+    def build(self, html: str) -> Dict[str, Any]:
+        """
+        Разбирает документ
+
+        Args:
+            html: Текст страницы (str)
+
+        Returns:
+            Корневой узел html в формате dom_parser.js (Dict[str, Any])
+        """
+        self.feed(html)
+        self.close()
+        self._close_to(1)
+        if self.head is None:
+            self.head = self._open("head", {})
+            self._close_top()
+            # head всегда первый потомок html
+            children = self.html.node["children"]
+            children.insert(0, children.pop())
+        self._ensure_body()
+        self._close_to(0)
+        return self.html.node
+
+
+# ==================== Извлечение ====================
+
+def count_interactive(node: Dict[str, Any]) -> int:
+    """Число интерактивных элементов в поддереве (включая корень)"""
+    count = 0
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current["tagName"] in INTERACTIVE_TAGS:
+            count += 1
+        stack.extend(current["children"])
+    return count
+
+
+def extract_page(file: str, html: str) -> Dict[str, Any]:
+    """
+    Результат разбора одной страницы
+
+    Args:
+        file: Имя страницы в результате — URL или путь к файлу (str)
+        html: Текст страницы (str)
+
+    Returns:
+        {"file", "domTree", "stats"} как элемент results в dom_analysis.json (Dict[str, Any])
+    """
+    tree: Dict[str, Any] = DOMTreeBuilder().build(html)
+    return {
+        "file": file,
+        "domTree": tree,
+        "stats": {
+            "totalElements": tree["elementCount"],
+            "interactiveElements": count_interactive(tree),
+        },
+    }
+
+
+def _extract_item(item: Tuple[str, str]) -> Dict[str, Any]:
+    return extract_page(*item)
+
+
+def build_analysis(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Сводка по страницам в формате dom_analysis.json"""
+    return {
+        "analyzedAt": datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+        "summary": {
+            "totalPages": len(results),
+            "totalElements": sum(r["stats"]["totalElements"] for r in results),
+            "elementsByType": {},
+            "interactiveElements": sum(r["stats"]["interactiveElements"] for r in results),
+        },
+        "results": results,
+    }
+
+
+class DOMExtractor:
+    """
+    Разбор страниц в пуле процессов.
+
+    Страницы можно передавать генератором (например, прямо из
+    SiteCrawler.crawl): каждая отправляется в пул сразу, поэтому разбор идёт
+    параллельно со скачиванием. Порядок results — порядок поступления страниц.
+
+    Пример использования:
+        extractor = DOMExtractor(workers=4)
+        dom_analysis = extractor.extract((page.url, page.text) for page in crawler.crawl(urls))
+    """
+
+    def __init__(self, workers: int = DOM_EXTRACT_WORKERS) -> None:
+        """
+        Args:
+            workers: Процессы разбора, 1 — в текущем процессе (int)
+        """
+        self.workers: int = max(1, workers)
+        self.pages: int = 0
+        self.elements: int = 0
+
+    def extract(self, pages: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+        """
+        Разбирает страницы
+
+        Args:
+            pages: Пары (имя страницы, HTML)
+
+        Returns:
+            Структура dom_analysis (Dict[str, Any])
+        """
+        # Одну страницу быстрее разобрать здесь, чем запускать пул
+        if self.workers == 1 or (isinstance(pages, Sized) and len(pages) < 2):
+            results = [extract_page(file, html) for file, html in pages]
+        else:
+            # spawn: к моменту запуска пула в процессе уже работают потоки обходчика,
+            # fork из многопоточного процесса небезопасен
+            context = multiprocessing.get_context("spawn")
+            # Пачки по несколько страниц: меньше пересылок между процессами
+            chunksize: int = max(1, len(pages) // (self.workers * 4)) if isinstance(pages, Sized) else 1
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+                results = list(executor.map(_extract_item, pages, chunksize=chunksize))
+
+        analysis = build_analysis(results)
+        self.pages = analysis["summary"]["totalPages"]
+        self.elements = analysis["summary"]["totalElements"]
+        return analysis
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика последнего разбора
+
+        Returns:
+            Число процессов, страниц и элементов (Dict[str, Any])
+        """
+        return {"workers": self.workers, "pages": self.pages, "elements": self.elements}
@@ -1,33 +1,28 @@
-# download_html.py - Обновленная версия для интеграции с бэкендом
-import requests
+# download_html.py - Скачивание страниц в html_files/ (анализатор использует crawler.py напрямую)
 import os
 import json
-import subprocess
 import sys
 
-def download_urls(urls, html_dir="html_files"):
-    """Функция для скачивания URL-ов (можно импортировать)"""
+from crawler import SiteCrawler
+
+def download_urls(urls, html_dir="html_files", max_depth=0):
+    """Функция для скачивания URL-ов (можно импортировать); страницы качаются параллельно"""
     os.makedirs(html_dir, exist_ok=True)
     downloaded_files = []
     
-    for i, url in enumerate(urls):
-        try:
-            # Устанавливаем кодировку для requests
-            response = requests.get(url)
-            response.encoding = 'utf-8'  # Явно указываем кодировку
-            response.raise_for_status()
-            
-            filename = f"page_{i+1}.html"
+    crawler = SiteCrawler(max_depth=max_depth)
+    try:
+        for page in crawler.crawl(urls):
+            filename = f"page_{len(downloaded_files) + 1}.html"
             filepath = os.path.join(html_dir, filename)
             
             # Сохраняем с явным указанием кодировки UTF-8
             with open(filepath, "w", encoding="utf-8") as f:
-                f.write(response.text)
+                f.write(page.text)
             downloaded_files.append(filepath)
-            print(f"Downloaded: {url} -> {filepath}")
-            
-        except Exception as e:
-            print(f"Error downloading {url}: {str(e)}")
+            print(f"Downloaded: {page.url} -> {filepath}")
+    finally:
+        crawler.close()
     
     return downloaded_files
 
@@ -36,9 +31,9 @@ if __name__ == "__main__":
     if sys.platform.startswith('win'):
         os.system('chcp 65001 > nul')  # Для Windows меняем кодировку консоли на UTF-8
     
-    # Список URL для скачивания
-    urls = [
-        "http://localhost:8000/index.html" #захардкожено
+    # Список URL для скачивания (аргументы командной строки)
+    urls = sys.argv[1:] or [
+        "http://localhost:8000/index.html"
     ]
     
     html_files = download_urls(urls)
@@ -1,11 +1,20 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple, Iterator, AsyncIterator
 from dataclasses import dataclass, asdict
+from collections import Counter, OrderedDict
 from enum import Enum
 import json
 import logging
+import math
+import re
+import threading
+import time
 import requests
 from pathlib import Path
 
+from llm_resilience import LLMCallError
+from llm_transport import get_async_transport, get_transport
+from metrics import track_llm_call
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -23,6 +32,7 @@ class SearchResult:
     status: str  
     search_time_ms: float = 0.0
     error_message: Optional[str] = None
+    answered_by: str = "llm"  # "llm", "fast_path", "retrieval" или "cache"
     
     def to_dict(self) -> Dict[str, Any]:
         """Преобразует в словарь"""
@@ -32,12 +42,16 @@ class SearchResult:
             "user_query": self.user_query,
             "status": self.status,
             "search_time_ms": round(self.search_time_ms, 2),
-            "error_message": self.error_message
+            "error_message": self.error_message,
+            "answered_by": self.answered_by
         }
 
 
 # ==================== API Client ====================
 
+DEFAULT_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
 class LLMClient:
     """Клиент для взаимодействия с LLM API"""
     
@@ -45,38 +59,45 @@ class LLMClient:
         self,
         api_key: str,
         model: str = "tngtech/deepseek-r1t2-chimera:free",
-        base_url: str = "https://openrouter.ai/api/v1/chat/completions",
-        timeout: int = 120
+        base_url: str = DEFAULT_API_URL,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None
     ):
+        """
+        Args:
+            timeout: Таймаут чтения ответа, сек (None — из настроек транспорта)
+            connect_timeout: Таймаут соединения, сек (None — из настроек транспорта)
+        """
         self.api_key: str = api_key
         self.base_url: str = base_url
         self.model: str = model
-        self.timeout: int = timeout
-            
-    def call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        """Низкоуровневый вызов API"""
-        
-        payload: Dict[str, Any] = {
+        self.timeout: Optional[float] = timeout
+        self.connect_timeout: Optional[float] = connect_timeout
+    
+    def _payload(self, messages: List[Dict[str, str]], temperature: float) -> Dict[str, Any]:
+        return {
             "model": self.model,
             "messages": messages,
             "temperature": temperature,
         }
-        
-        headers: Dict[str, str] = {
+    
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
+            
+    def call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+        """Низкоуровневый вызов API"""
         
         try:
-            response: requests.Response = requests.post(
+            data: Dict[str, Any] = get_transport().post_json(
                 self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=self.timeout,
+                headers=self._headers(),
+                payload=self._payload(messages, temperature),
+                connect_timeout=self.connect_timeout,
+                read_timeout=self.timeout,
             )
-            response.raise_for_status()
-            
-            data = response.json()
             return data["choices"][0]["message"]["content"].strip()
         
         except requests.exceptions.Timeout:
@@ -87,18 +108,611 @@ class LLMClient:
             logger.error(f"❌ HTTP Error: {e.response.status_code}")
             raise RuntimeError(f"HTTP Error: {e.response.status_code}")
         
+        except LLMCallError as e:
+            logger.error(f"❌ API error: {e}")
+            raise
+        
         except Exception as e:
             logger.error(f"❌ API error: {e}")
             raise RuntimeError(f"API error: {str(e)}")
 
+    def stream_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> Iterator[str]:
+        """Потоковый вызов API: отдаёт фрагменты текста по мере генерации (SSE)"""
+        
+        payload: Dict[str, Any] = self._payload(messages, temperature)
+        payload["stream"] = True
+        
+        headers: Dict[str, str] = self._headers()
+        headers["Accept"] = "text/event-stream"
+        
+        try:
+            with track_llm_call(self.model) as call:
+                response: requests.Response = get_transport().post(
+                    self.base_url,
+                    headers=headers,
+                    payload=payload,
+                    connect_timeout=self.connect_timeout,
+                    read_timeout=self.timeout,
+                    stream=True,
+                )
+                with response:
+                    response.raise_for_status()
+                    response.encoding = "utf-8"
+                    
+                    for line in response.iter_lines(decode_unicode=True):
+                        done, content, usage = parse_stream_line(line)
+                        if usage:
+                            call["usage"] = usage
+                        if done:
+                            break
+                        if content:
+                            yield content
+        
+        except requests.exceptions.Timeout:
+            logger.error("❌ API stream timed out")
+            raise RuntimeError("API request timed out")
+        
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"❌ HTTP Error: {e.response.status_code}")
+            raise RuntimeError(f"HTTP Error: {e.response.status_code}")
+        
+        except RuntimeError:
+            raise
+        
+        except Exception as e:
+            logger.error(f"❌ API stream error: {e}")
+            raise RuntimeError(f"API error: {str(e)}")
+
+
+def parse_stream_line(line: str) -> Tuple[bool, Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Разбирает строку SSE-потока провайдера
+    
+    Returns:
+        (поток завершён, фрагмент текста или None, usage из последнего чанка или None)
+    
+    Raises:
+        RuntimeError: Если провайдер прислал ошибку в потоке
+    """
+    # Пустые строки разделяют события, ":" — комментарии-keepalive
+    if not line or not line.startswith("data:"):
+        return False, None, None
+    data_str = line[len("data:"):].strip()
+    if data_str == "[DONE]":
+        return True, None, None
+    
+    chunk = json.loads(data_str)
+    if "error" in chunk:
+        raise RuntimeError(chunk["error"].get("message", "stream error"))
+    choices = chunk.get("choices") or []
+    if not choices:
+        return False, None, chunk.get("usage")
+    return False, (choices[0].get("delta") or {}).get("content"), chunk.get("usage")
+
+
+class AsyncLLMClient(LLMClient):
+    """
+    Асинхронный клиент LLM API (ASGI-режим): те же запросы, что у LLMClient,
+    но через общий AsyncLLMTransport — ожидание ответа не занимает поток
+    """
+    
+    async def call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+        """Низкоуровневый асинхронный вызов API"""
+        
+        try:
+            data: Dict[str, Any] = await get_async_transport().post_json(
+                self.base_url,
+                headers=self._headers(),
+                payload=self._payload(messages, temperature),
+                connect_timeout=self.connect_timeout,
+                read_timeout=self.timeout,
+            )
+            return data["choices"][0]["message"]["content"].strip()
+        
+        except LLMCallError as e:
+            logger.error(f"❌ API error: {e}")
+            raise
+        
+        except Exception as e:
+            logger.error(f"❌ API error: {e}")
+            raise RuntimeError(f"API error: {str(e)}")
+    
+    async def stream_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> AsyncIterator[str]:
+        """Асинхронный потоковый вызов API: фрагменты текста по мере генерации (SSE)"""
+        
+        headers = self._headers()
+        headers["Accept"] = "text/event-stream"
+        payload = self._payload(messages, temperature)
+        payload["stream"] = True
+        
+        try:
+            with track_llm_call(self.model) as call:
+                async with get_async_transport().stream_lines(
+                    self.base_url,
+                    headers=headers,
+                    payload=payload,
+                    connect_timeout=self.connect_timeout,
+                    read_timeout=self.timeout,
+                ) as lines:
+                    async for line in lines:
+                        done, content, usage = parse_stream_line(line)
+                        if usage:
+                            call["usage"] = usage
+                        if done:
+                            break
+                        if content:
+                            yield content
+        
+        except RuntimeError:
+            raise
+        
+        except Exception as e:
+            logger.error(f"❌ API stream error: {e}")
+            raise RuntimeError(f"API error: {str(e)}")
+
+
+# ==================== Streaming ====================
+
+class JSONStringFieldExtractor:
+    """
+    Инкрементально извлекает значение строкового поля из неполного JSON.
+
+    Модель печатает JSON по кусочкам; feed() принимает очередной фрагмент
+    и возвращает только новые раскодированные символы значения поля.
+    """
+
+    _ESCAPES: Dict[str, str] = {
+        '"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+    }
+
+    def __init__(self, field: str):
+        self.field_re = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self.buffer: str = ""
+        self.pos: int = 0
+        self.state: str = "seek"  # seek -> value -> done
+
+    def feed(self, chunk: str) -> str:
+        """Добавляет фрагмент ответа и возвращает новые символы значения"""
+        self.buffer += chunk
+        if self.state == "seek":
+            match = self.field_re.search(self.buffer)
+            if not match:
+                return ""
+            self.pos = match.end()
+            self.state = "value"
+        if self.state != "value":
+            return ""
+        
+        out: List[str] = []
+        buf = self.buffer
+        while self.pos < len(buf):
+            ch = buf[self.pos]
+            if ch == '"':
+                self.state = "done"
+                break
+            if ch != "\\":
+                out.append(ch)
+                self.pos += 1
+                continue
+            # Escape-последовательность: ждём, пока она придёт целиком
+            if self.pos + 1 >= len(buf):
+                break
+            code = buf[self.pos + 1]
+            if code != "u":
+                out.append(self._ESCAPES.get(code, code))
+                self.pos += 2
+                continue
+            if self.pos + 6 > len(buf):
+                break
+            codepoint = int(buf[self.pos + 2:self.pos + 6], 16)
+            if 0xD800 <= codepoint < 0xDC00:
+                # Суррогатная пара: нужен второй \uXXXX
+                if self.pos + 12 > len(buf):
+                    break
+                low = int(buf[self.pos + 8:self.pos + 12], 16)
+                codepoint = 0x10000 + ((codepoint - 0xD800) << 10) + (low - 0xDC00)
+                self.pos += 6
+            out.append(chr(codepoint))
+            self.pos += 6
+        return "".join(out)
+
+
+# ==================== Local Retrieval ====================
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Служебные слова, которые не несут смысла для поиска
+_STOP_WORDS = frozenset({
+    "а", "в", "во", "и", "к", "ко", "о", "об", "с", "со", "у", "я",
+    "на", "по", "за", "из", "от", "до", "не", "ни", "ли", "же", "бы",
+    "для", "как", "где", "что", "это", "мне", "мой", "моя", "мои",
+    "хочу", "можно", "нужно", "надо", "есть", "или", "при", "про",
+})
+
+# Грубый стемминг: русские словоформы различаются в основном окончаниями,
+# поэтому префикса фиксированной длины достаточно для лексического поиска
+STEM_LENGTH = 5
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на нормализованные токены (нижний регистр, стемминг)"""
+    tokens: List[str] = []
+    for word in _TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        if word in _STOP_WORDS or (len(word) < 2 and not word.isdigit()):
+            continue
+        tokens.append(word[:STEM_LENGTH])
+    return tokens
+
+
+# Слова, которые не меняют смысл вопроса: при поиске перефразов не учитываются
+_PARAPHRASE_FILLER = frozenset(tokenize(
+    "пожалуйста подскажите подскажи скажите скажи помогите помоги объясните "
+    "сайте сайт здесь тут вашем ваш ваше вашей можете могу мог бы быстро сейчас"
+))
+
+# Синонимы действий приводятся к одной основе до сравнения перефразов
+_PARAPHRASE_SYNONYMS = {
+    stem: canonical
+    for canonical, words in {
+        "удали": "убрать убери уберите",
+        "купит": "покупка купить приобрести",
+        "оплат": "оплата заплатить",
+        "найти": "найди поиск искать",
+    }.items()
+    for stem in tokenize(words)
+}
+
+
+# Окончания инфинитива и повелительного наклонения: такие слова — действие вопроса.
+# "добавить товар в корзину" и "удалить товар из корзины" совпадают на 3/5 токенов,
+# но отличаются действием — это разные вопросы при любом сходстве
+_ACTION_RE = re.compile(r"\w+(?:ть|ться|ти|чь|ите|йте)$")
+
+
+def paraphrase_tokens(text: str) -> Tuple[frozenset, frozenset]:
+    """
+    Токены вопроса для поиска перефразов
+
+    Returns:
+        Значимые токены без слов-паразитов и основы действий, синонимы сведены
+        к одной основе (Tuple[frozenset, frozenset])
+    """
+    tokens, actions = set(), set()
+    for word in _TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        for token in tokenize(word):
+            token = _PARAPHRASE_SYNONYMS.get(token, token)
+            if token in _PARAPHRASE_FILLER:
+                continue
+            tokens.add(token)
+            if _ACTION_RE.fullmatch(word):
+                actions.add(token)
+    return frozenset(tokens), frozenset(actions)
+
+
+def normalize_query(text: str) -> str:
+    """Нормализует вопрос для точного сравнения: регистр, ё, пробелы, концевая пунктуация"""
+    text = re.sub(r"\s+", " ", text.lower().replace("ё", "е"))
+    return text.strip(" ?!.,;:")
+
+
+class InstructionIndex:
+    """
+    Лексический BM25-индекс по инструкциям.
+
+    Строится один раз при загрузке инструкций и отбирает top_k кандидатов,
+    которые затем уходят на оценку в LLM.
+    """
+
+    # Вес поля = сколько раз его токены учитываются в документе
+    FIELD_WEIGHTS: Dict[str, int] = {
+        "task_name": 3,
+        "aliases": 2,
+        "full_path": 1,
+        "instruction": 1,
+    }
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1: float = k1
+        self.b: float = b
+        self.documents: List[Dict[str, Any]] = []
+        self.term_freqs: List[Counter] = []
+        self.doc_lengths: List[int] = []
+        self.avg_doc_length: float = 0.0
+        self.idf: Dict[str, float] = {}
+        self.postings: Dict[str, List[int]] = {}
+        self.title_token_sets: List[List[frozenset]] = []
+
+    def _document_tokens(self, instr: Dict[str, Any]) -> List[str]:
+        """Собирает взвешенные токены документа из полей инструкции"""
+        tokens: List[str] = []
+        for field, weight in self.FIELD_WEIGHTS.items():
+            value = instr.get(field) or ""
+            if isinstance(value, list):
+                value = " ".join(str(v) for v in value)
+            tokens.extend(tokenize(str(value)) * weight)
+        return tokens
+
+    @staticmethod
+    def _title_token_sets(instr: Dict[str, Any]) -> List[frozenset]:
+        """Наборы токенов «заголовков» инструкции: название, алиасы, путь"""
+        titles = [instr.get("task_name") or "", instr.get("full_path") or ""]
+        titles.extend(str(alias) for alias in instr.get("aliases") or [])
+        return [token_set for token_set in (frozenset(tokenize(t)) for t in titles) if token_set]
+
+    def build(self, instructions: List[Dict[str, Any]]) -> None:
+        """Строит индекс по списку инструкций"""
+        self.documents = list(instructions)
+        self.term_freqs = []
+        self.doc_lengths = []
+        self.postings = {}
+        self.title_token_sets = []
+
+        for doc_id, instr in enumerate(self.documents):
+            self.title_token_sets.append(self._title_token_sets(instr))
+            tf = Counter(self._document_tokens(instr))
+            self.term_freqs.append(tf)
+            self.doc_lengths.append(sum(tf.values()))
+            for term in tf:
+                self.postings.setdefault(term, []).append(doc_id)
+
+        total_docs = len(self.documents)
+        self.avg_doc_length = (sum(self.doc_lengths) / total_docs) if total_docs else 0.0
+        self.idf = {
+            term: math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+        logger.info(f"🗂️ Retrieval index built: {total_docs} documents, {len(self.postings)} terms")
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        Возвращает top_k инструкций, наиболее близких к запросу
+
+        Returns:
+            Список пар (bm25_score, инструкция), по убыванию score
+        """
+        scores: Dict[int, float] = {}
+
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id in self.postings[term]:
+                tf = self.term_freqs[doc_id][term]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [(score, self.documents[doc_id]) for doc_id, score in ranked]
+
+    def match_title(self, query: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """
+        Детерминированно сопоставляет запрос с названиями, алиасами и путями задач
+
+        Сходство — коэффициент Дайса между множествами токенов (0-1).
+        Если лучшее совпадение не единственное, результата нет.
+
+        Returns:
+            Пара (score, инструкция) или None
+        """
+        query_tokens = frozenset(tokenize(query))
+        if not query_tokens:
+            return None
+
+        best_score, second_score, best_doc = 0.0, 0.0, None
+        for doc_id, token_sets in enumerate(self.title_token_sets):
+            score = max(
+                (2 * len(query_tokens & ts) / (len(query_tokens) + len(ts)) for ts in token_sets),
+                default=0.0
+            )
+            if score > best_score:
+                best_score, second_score, best_doc = score, best_score, doc_id
+            elif score > second_score:
+                second_score = score
+
+        if best_doc is None or best_score == second_score:
+            return None
+        return best_score, self.documents[best_doc]
+
+
+# ==================== Answer Cache ====================
+
+class AnswerCache:
+    """
+    Кэш готовых ответов чата в памяти процесса.
+
+    Поиск: сначала точное совпадение нормализованного вопроса, затем
+    ближайший перефраз по коэффициенту Жаккара множеств токенов
+    ("как оформить заказ" ~ "оформление заказа"); слова-паразиты не
+    учитываются, синонимы действий совпадают. Вопрос с другим действием
+    ("удалить" вместо "добавить") — промах при любом сходстве. Кандидаты для сравнения
+    берутся из обратного индекса токен -> ключи, поэтому поиск не
+    перебирает весь кэш. Записи вытесняются по LRU и TTL и сбрасываются
+    целиком при смене версии набора инструкций.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: Optional[float] = 3600,
+        similarity_threshold: float = 0.8
+    ):
+        """
+        Args:
+            max_entries: Максимум ответов в кэше
+            ttl_seconds: Время жизни ответа в секундах, None — бессрочно
+            similarity_threshold: Минимальный коэффициент Жаккара для перефраза (0-1),
+                значение больше 1 отключает поиск перефразов
+        """
+        self.max_entries: int = max_entries
+        self.ttl_seconds: Optional[float] = ttl_seconds
+        self.similarity_threshold: float = similarity_threshold
+        self.version: Any = None
+
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._postings: Dict[str, set] = {}
+        self._bytes: int = 0
+        self._lock = threading.Lock()
+
+        self.exact_hits: int = 0
+        self.similar_hits: int = 0
+        self.misses: int = 0
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        for token in entry["tokens"]:
+            keys = self._postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[token]
+
+    def _expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.ttl_seconds is not None and now - entry["created_at"] > self.ttl_seconds
+
+    def _find_similar(self, tokens: frozenset, actions: frozenset, now: float) -> Optional[str]:
+        """Ключ ближайшего перефраза или None (при равенстве лучших — None)"""
+        candidates = set()
+        for token in tokens:
+            candidates.update(self._postings.get(token, ()))
+
+        best_key, best_score, tie = None, 0.0, False
+        for key in candidates:
+            entry = self._entries[key]
+            if self._expired(entry, now):
+                continue
+            if (tokens ^ entry["tokens"]) & (actions | entry["actions"]):
+                continue
+            score = len(tokens & entry["tokens"]) / len(tokens | entry["tokens"])
+            if score > best_score:
+                best_key, best_score, tie = key, score, False
+            elif score == best_score:
+                tie = True
+
+        if best_key is None or tie or best_score < self.similarity_threshold:
+            return None
+        return best_key
+
+    # ---------- Публичные методы ----------
+
+    def set_version(self, version: Any) -> None:
+        """Привязывает кэш к версии инструкций; при смене версии кэш очищается"""
+        with self._lock:
+            if version is None or version != self.version:
+                self._entries.clear()
+                self._postings.clear()
+                self._bytes = 0
+            self.version = version
+
+    def get(self, user_query: str, version: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает копию сохранённого ответа или None
+
+        Args:
+            user_query: Вопрос пользователя
+            version: Версия инструкций вызывающего; при несовпадении с версией
+                кэша (ассистент уже заменён) — промах
+
+        Returns:
+            Словарь результата с answered_by="cache" (Optional[Dict[str, Any]])
+        """
+        key = normalize_query(user_query)
+        tokens, actions = paraphrase_tokens(user_query)
+        now = time.time()
+
+        with self._lock:
+            if version is not None and version != self.version:
+                self.misses += 1
+                return None
+
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._remove(key)
+                entry = None
+
+            if entry is not None:
+                self.exact_hits += 1
+            elif tokens:
+                similar_key = self._find_similar(tokens, actions, now)
+                if similar_key is not None:
+                    key, entry = similar_key, self._entries[similar_key]
+                    self.similar_hits += 1
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            result = dict(entry["result"])
+
+        logger.info(f"💾 Answer cache hit: '{user_query}' -> '{key}'")
+        result.update(user_query=user_query, search_time_ms=0.0, answered_by="cache")
+        return result
+
+    def put(self, user_query: str, result: Dict[str, Any], version: Any = None) -> None:
+        """
+        Сохраняет успешный ответ LLM (остальные ответы не кэшируются)
+
+        Ответ, полученный на устаревшей версии инструкций, отбрасывается.
+        """
+        if result.get("status") != "success" or result.get("answered_by") != "llm":
+            return
+
+        key = normalize_query(user_query)
+        tokens, actions = paraphrase_tokens(user_query)
+        entry = {
+            "result": dict(result),
+            "tokens": tokens,
+            "actions": actions,
+            "created_at": time.time(),
+            "size": len(json.dumps(result, ensure_ascii=False).encode("utf-8")),
+        }
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry["size"]
+            for token in entry["tokens"]:
+                self._postings.setdefault(token, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика кэша для подбора размера
+
+        Returns:
+            Количество записей, объём ответов в байтах и доли попаданий
+        """
+        with self._lock:
+            hits = self.exact_hits + self.similar_hits
+            lookups = hits + self.misses
+            return {
+                "version": self.version,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "exact_hits": self.exact_hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            }
+
 
 # ==================== Instruction Search Engine ====================
 
 class InstructionSearchEngine:
     """Поисковый движок для инструкций"""
     
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, async_llm_client: Optional[AsyncLLMClient] = None):
         self.llm_client: LLMClient = llm_client
+        self.async_llm_client: Optional[AsyncLLMClient] = async_llm_client
     
     def _extract_relevance_score(self, response_text: str) -> float:
         """Извлекает оценку релевантности из ответа LLM"""
@@ -126,19 +740,9 @@ class InstructionSearchEngine:
         return 0.5  # Дефолтное значение
     
 
-    def evaluate_instruction_relevance(
-        self,
-        user_query: str,
-        instruction: str,
-    ) -> tuple[float, str]:
-        """
-        Оценивает релевантность инструкции к запросу пользователя
-        
-        Returns:
-            instruction: str
-        """
-
-        prompt = f"""Ты — эксперт по анализу инструкции. Оцени, к какой инструкции из предложенных соответствует запросу пользователя.
+    def _build_relevance_prompt(self, user_query: str, instruction: str) -> str:
+        """Промпт для выбора инструкции из кандидатов"""
+        return f"""Ты — эксперт по анализу инструкции. Оцени, к какой инструкции из предложенных соответствует запросу пользователя.
 
 Запрос пользователя: "{user_query}"
 
@@ -158,6 +762,43 @@ class InstructionSearchEngine:
 }}
 
 Ответ (только JSON, без других текстов):"""
+
+    def _parse_relevance_response(self, response: str) -> Tuple[float, str, Optional[str], Optional[str]]:
+        """Разбирает JSON-ответ модели в (score, reasoning, instruction, description)"""
+        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        
+        if json_match:
+            try:
+                data = json.loads(json_match.group())
+                score = float(data.get("relevance_score", 0.5))
+                found_instruction = str(data.get("instruction", None))
+                description = str(data.get("description", None))
+                reasoning = str(data.get("reasoning", "Нет объяснения"))
+                # Нормализуем score
+                score = max(0.0, min(1.0, score))
+                
+                logger.info(f"  ✓ Score: {score:.2f}, Reasoning: {reasoning[:50]}...")
+                return score, reasoning, found_instruction, description
+            
+            except json.JSONDecodeError:
+                logger.warning(f"  ⚠️ Failed to parse JSON from response")
+                return 0.0, "Ошибка парсинга ответа API", None, None
+        else:
+            logger.warning(f"  ⚠️ No JSON found in response")
+            return 0.0, "API вернул неправильный формат", None, None
+
+    def evaluate_instruction_relevance(
+        self,
+        user_query: str,
+        instruction: str,
+    ) -> Tuple[float, str, Optional[str], Optional[str]]:
+        """
+        Оценивает релевантность инструкции к запросу пользователя
+        
+        Returns:
+            (score, reasoning, instruction, description)
+        """
+        prompt = self._build_relevance_prompt(user_query, instruction)
         
         try:
             logger.info(f"Recognition query: '{user_query}'")
@@ -166,35 +807,46 @@ class InstructionSearchEngine:
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.3
             )
-            # Парсим JSON из ответа
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
+            return self._parse_relevance_response(response)
+        
+        except Exception as e:
+            logger.error(f"  ❌ Error evaluating relevance: {e}")
+            return 0.0, f"Ошибка: {str(e)}", None, None
+
+    def evaluate_instruction_relevance_stream(
+        self,
+        user_query: str,
+        instruction: str,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Потоковая версия evaluate_instruction_relevance
+        
+        Yields:
+            ("token", фрагмент ответа), ("description", новые символы описания),
+            в конце ("evaluation", (score, reasoning, instruction, description))
+        """
+        prompt = self._build_relevance_prompt(user_query, instruction)
+        extractor = JSONStringFieldExtractor("description")
+        parts: List[str] = []
+        
+        try:
+            logger.info(f"Recognition query (stream): '{user_query}'")
             
-            if json_match:
-                try:
-                    data = json.loads(json_match.group())
-                    score = float(data.get("relevance_score", 0.5))
-                    found_instruction = str(data.get("instruction", None))
-                    description = str(data.get("description", None))
-                    reasoning = str(data.get("reasoning", "Нет объяснения"))
-                    if found_instruction == None or score <0.2:
-                        return score, reasoning, "Не смог найти сорян"
-                    # Нормализуем score
-                    score = max(0.0, min(1.0, score))
-                    
-                    logger.info(f"  ✓ Score: {score:.2f}, Reasoning: {reasoning[:50]}...")
-                    return score, reasoning, found_instruction, description
-                
-                except json.JSONDecodeError:
-                    logger.warning(f"  ⚠️ Failed to parse JSON from response")
-                    return 0.5, "Ошибка парсинга ответа API"
-            else:
-                logger.warning(f"  ⚠️ No JSON found in response")
-                return 0.5, "API вернул неправильный формат"
+            for token in self.llm_client.stream_api(
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3
+            ):
+                parts.append(token)
+                yield "token", token
+                description_delta = extractor.feed(token)
+                if description_delta:
+                    yield "description", description_delta
+            
+            yield "evaluation", self._parse_relevance_response("".join(parts).strip())
         
         except Exception as e:
             logger.error(f"  ❌ Error evaluating relevance: {e}")
-            return 0.0, f"Ошибка: {str(e)}"
+            yield "evaluation", (0.0, f"Ошибка: {str(e)}", None, None)
 
     def instructions_to_str(self, instructions: List[Dict[str, Any]]) -> str:
         """
@@ -225,19 +877,60 @@ class InstructionSearchEngine:
 
         return "\n".join(parts)
 
+    def _no_candidates_result(self, user_query: str, start_time: float) -> SearchResult:
+        """Результат без вызова LLM, когда локальный индекс ничего не нашёл"""
+        import time
+        logger.warning("❌ No candidates for query, skipping LLM call")
+        return SearchResult(
+            description=None,
+            instruction=None,
+            user_query=user_query,
+            status="no_matches",
+            search_time_ms=(time.time() - start_time) * 1000,
+            answered_by="retrieval"
+        )
+
+    def _build_search_result(
+        self,
+        user_query: str,
+        evaluation: Tuple[float, str, Optional[str], Optional[str]],
+        min_relevance: float,
+        start_time: float
+    ) -> SearchResult:
+        """Собирает SearchResult из оценки LLM"""
+        import time
+        score, reasoning, found_instruction, description = evaluation
+        
+        search_time = (time.time() - start_time) * 1000  # в миллисекундах
+        
+        if found_instruction is None or score < min_relevance:
+            logger.warning("❌ No relevant instructions found")
+            status = "no_matches"
+        else:
+            logger.info(f"✅ Search completed: found {found_instruction}")
+            status = "success"
+        
+        return SearchResult(
+            instruction = found_instruction,
+            description = description,
+            user_query=user_query,
+            status=status,
+            search_time_ms=search_time
+        )
+
     def search(
         self,
         user_query: str,
         instructions: List[Dict[str, Any]],
+        min_relevance: float = 0.2,
     ) -> SearchResult:
         """
         Ищет релевантные инструкции по запросу пользователя
         
         Args:
             user_query: Запрос пользователя
-            instructions: Список инструкций из процесса генерации
+            instructions: Кандидаты, отобранные локальным индексом
             min_relevance: Минимальная релевантность (0-1)
-            top_k: Количество топ результатов
         
         Returns:
             SearchResult с найденными инструкциями
@@ -248,28 +941,138 @@ class InstructionSearchEngine:
         logger.info(f"🔍 Starting search for query: '{user_query}'")
         logger.info(f"📊 Searching through {len(instructions)} instructions...")
         
+        if not instructions:
+            return self._no_candidates_result(user_query, start_time)
+        
         instructions_str = self.instructions_to_str(instructions)
-        score, reasoning, found_instruction, description = self.evaluate_instruction_relevance(user_query, instructions_str)
+        evaluation = self.evaluate_instruction_relevance(user_query, instructions_str)
+        
+        return self._build_search_result(user_query, evaluation, min_relevance, start_time)
 
+    def search_stream(
+        self,
+        user_query: str,
+        instructions: List[Dict[str, Any]],
+        min_relevance: float = 0.2,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Потоковая версия search
         
-        search_time = (time.time() - start_time) * 1000  # в миллисекундах
+        Yields:
+            ("token", str), ("description", str), в конце ("result", SearchResult)
+        """
+        import time
+        start_time = time.time()
         
-        if score < 0.2:
-            logger.warning("❌ No relevant instructions found")
-            status = "no_matches"
-        else:
-            logger.info(f"✅ Search completed: found {found_instruction}")
-            status = "success"
+        logger.info(f"🔍 Starting streaming search for query: '{user_query}'")
         
-        result = SearchResult(
-            instruction = found_instruction,
-            description = description,
-            user_query=user_query,
-            status=status,
-            search_time_ms=search_time
-        )
+        if not instructions:
+            yield "result", self._no_candidates_result(user_query, start_time)
+            return
         
-        return result
+        instructions_str = self.instructions_to_str(instructions)
+        for event, data in self.evaluate_instruction_relevance_stream(user_query, instructions_str):
+            if event == "evaluation":
+                yield "result", self._build_search_result(user_query, data, min_relevance, start_time)
+            else:
+                yield event, data
+
+    # ---------- Асинхронные версии (ASGI-режим) ----------
+
+    async def aevaluate_instruction_relevance(
+        self,
+        user_query: str,
+        instruction: str,
+    ) -> Tuple[float, str, Optional[str], Optional[str]]:
+        """Асинхронная версия evaluate_instruction_relevance"""
+        prompt = self._build_relevance_prompt(user_query, instruction)
+        
+        try:
+            logger.info(f"Recognition query (async): '{user_query}'")
+            
+            response = await self.async_llm_client.call_api(
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3
+            )
+            return self._parse_relevance_response(response)
+        
+        except Exception as e:
+            logger.error(f"  ❌ Error evaluating relevance: {e}")
+            return 0.0, f"Ошибка: {str(e)}", None, None
+
+    async def aevaluate_instruction_relevance_stream(
+        self,
+        user_query: str,
+        instruction: str,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Асинхронная версия evaluate_instruction_relevance_stream"""
+        prompt = self._build_relevance_prompt(user_query, instruction)
+        extractor = JSONStringFieldExtractor("description")
+        parts: List[str] = []
+        
+        try:
+            logger.info(f"Recognition query (async stream): '{user_query}'")
+            
+            async for token in self.async_llm_client.stream_api(
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3
+            ):
+                parts.append(token)
+                yield "token", token
+                description_delta = extractor.feed(token)
+                if description_delta:
+                    yield "description", description_delta
+            
+            evaluation = self._parse_relevance_response("".join(parts).strip())
+        
+        except Exception as e:
+            logger.error(f"  ❌ Error evaluating relevance: {e}")
+            evaluation = (0.0, f"Ошибка: {str(e)}", None, None)
+        
+        yield "evaluation", evaluation
+
+    async def asearch(
+        self,
+        user_query: str,
+        instructions: List[Dict[str, Any]],
+        min_relevance: float = 0.2,
+    ) -> SearchResult:
+        """Асинхронная версия search"""
+        import time
+        start_time = time.time()
+        
+        logger.info(f"🔍 Starting async search for query: '{user_query}'")
+        
+        if not instructions:
+            return self._no_candidates_result(user_query, start_time)
+        
+        instructions_str = self.instructions_to_str(instructions)
+        evaluation = await self.aevaluate_instruction_relevance(user_query, instructions_str)
+        
+        return self._build_search_result(user_query, evaluation, min_relevance, start_time)
+
+    async def asearch_stream(
+        self,
+        user_query: str,
+        instructions: List[Dict[str, Any]],
+        min_relevance: float = 0.2,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Асинхронная версия search_stream"""
+        import time
+        start_time = time.time()
+        
+        logger.info(f"🔍 Starting async streaming search for query: '{user_query}'")
+        
+        if not instructions:
+            yield "result", self._no_candidates_result(user_query, start_time)
+            return
+        
+        instructions_str = self.instructions_to_str(instructions)
+        async for event, data in self.aevaluate_instruction_relevance_stream(user_query, instructions_str):
+            if event == "evaluation":
+                yield "result", self._build_search_result(user_query, data, min_relevance, start_time)
+            else:
+                yield event, data
 
 
 # ==================== Question Processor ====================
@@ -338,31 +1141,81 @@ class QuestionProcessor:
 class InstructionAssistant:
     """Главный интерфейс ассистента по инструкциям"""
     
-    def __init__(self, api_key: str):
-        self.llm_client = LLMClient(api_key=api_key)
-        self.search_engine = InstructionSearchEngine(llm_client=self.llm_client)
+    def __init__(
+        self,
+        api_key: str,
+        fast_path_threshold: float = 0.75,
+        answer_cache: Optional[AnswerCache] = None,
+        base_url: str = DEFAULT_API_URL
+    ):
+        """
+        Args:
+            api_key: API ключ для LLM
+            fast_path_threshold: Порог совпадения с названием задачи (0-1),
+                начиная с которого ответ выдаётся без вызова LLM
+            answer_cache: Кэш ответов; передайте общий экземпляр, чтобы
+                статистика переживала перезагрузку инструкций
+            base_url: URL chat completions API
+        """
+        self.fast_path_threshold: float = fast_path_threshold
+        self.answer_cache: AnswerCache = answer_cache if answer_cache is not None else AnswerCache()
+        self.llm_client = LLMClient(api_key=api_key, base_url=base_url)
+        self.async_llm_client = AsyncLLMClient(api_key=api_key, base_url=base_url)
+        self.search_engine = InstructionSearchEngine(
+            llm_client=self.llm_client,
+            async_llm_client=self.async_llm_client
+        )
         self.question_processor = QuestionProcessor(
             llm_client=self.llm_client,
             search_engine=self.search_engine
         )
         self.current_instructions: List[Dict[str, Any]] = []
+        self.version: Any = None
+        self.index = InstructionIndex()
     
-    def load_instructions(self, instructions: List[Dict[str, Any]]) -> None:
+    def load_instructions(self, instructions: List[Dict[str, Any]], version: Any = None) -> None:
         """
         Загружает инструкции из результата process_instructions_pipeline
+        и строит по ним локальный поисковый индекс
         
         Args:
             instructions: Список инструкций
+            version: Версия набора инструкций; кэш ответов сбрасывается при её
+                смене (None — сбрасывается всегда)
         """
         self.current_instructions = instructions
+        self.index.build(instructions)
+        self.version = version
+        self.answer_cache.set_version(version)
         logger.info(f"✅ Loaded {len(instructions)} instructions")
     
+    def _answer_fast_path(self, user_query: str) -> Optional[SearchResult]:
+        """Отвечает без LLM, если запрос почти дословно совпадает с задачей"""
+        import time
+        start_time = time.time()
+        
+        match = self.index.match_title(user_query)
+        if match is None or match[0] < self.fast_path_threshold:
+            return None
+        
+        score, instr = match
+        logger.info(f"⚡ Fast path: '{instr.get('task_name')}' (score {score:.2f})")
+        return SearchResult(
+            description=instr.get("instruction"),
+            instruction=instr.get("instruction"),
+            user_query=user_query,
+            status="success",
+            search_time_ms=(time.time() - start_time) * 1000,
+            answered_by="fast_path"
+        )
+    
     def answer_question(
         self,
         user_query: str,
         min_relevance: float = 0.3,
         top_k: int = 3,
-        include_recommendation: bool = True
+        include_recommendation: bool = True,
+        local_first: bool = True
     ) -> Dict[str, Any]:
         """
         Отвечает на вопрос пользователя
@@ -372,30 +1225,153 @@ class InstructionAssistant:
             min_relevance: Минимальная релевантность результатов
             top_k: Количество топ результатов
             include_recommendation: Генерировать ли рекомендацию
+            local_first: Сначала пробовать answer_locally (False — вызывающий
+                уже сделал это сам)
         
         Returns:
             Словарь с результатами
         """
         
         if not self.current_instructions:
-            return {
-                "status": "error",
-                "error_message": "Инструкции не загружены. Используйте load_instructions()."
-            }
+            return self._not_loaded_result()
         
         logger.info(f"\n{'='*60}")
         logger.info(f"💬 User question: '{user_query}'")
         logger.info(f"{'='*60}")
         
+        local_result = self.answer_locally(user_query) if local_first else None
+        if local_result is not None:
+            return local_result
+        
         # Поиск релевантных инструкций
         search_result = self.search_engine.search(
             user_query=user_query,
-            instructions=self.current_instructions,
+            instructions=self._retrieve_candidates(user_query, top_k),
+            min_relevance=min_relevance,
         )
         
         result_dict = search_result.to_dict()
+        self.answer_cache.put(user_query, result_dict, self.version)
 
         logger.info(f"✅ Question processing complete")
         
         return result_dict
-
+    
+    def answer_question_stream(
+        self,
+        user_query: str,
+        min_relevance: float = 0.3,
+        top_k: int = 3,
+        local_first: bool = True
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Потоковая версия answer_question
+        
+        Yields:
+            ("token", str), ("description", str), в конце ("result", словарь результата)
+        """
+        if not self.current_instructions:
+            yield "result", self._not_loaded_result()
+            return
+        
+        logger.info(f"💬 User question (stream): '{user_query}'")
+        
+        local_result = self.answer_locally(user_query) if local_first else None
+        if local_result is not None:
+            yield "result", local_result
+            return
+        
+        for event, data in self.search_engine.search_stream(
+            user_query=user_query,
+            instructions=self._retrieve_candidates(user_query, top_k),
+            min_relevance=min_relevance,
+        ):
+            if event == "result":
+                data = data.to_dict()
+                self.answer_cache.put(user_query, data, self.version)
+            yield event, data
+    
+    async def aanswer_question(
+        self,
+        user_query: str,
+        min_relevance: float = 0.3,
+        top_k: int = 3,
+        local_first: bool = True
+    ) -> Dict[str, Any]:
+        """Асинхронная версия answer_question (ожидание LLM не занимает поток)"""
+        if not self.current_instructions:
+            return self._not_loaded_result()
+        
+        logger.info(f"💬 User question (async): '{user_query}'")
+        
+        local_result = self.answer_locally(user_query) if local_first else None
+        if local_result is not None:
+            return local_result
+        
+        search_result = await self.search_engine.asearch(
+            user_query=user_query,
+            instructions=self._retrieve_candidates(user_query, top_k),
+            min_relevance=min_relevance,
+        )
+        
+        result_dict = search_result.to_dict()
+        self.answer_cache.put(user_query, result_dict, self.version)
+        return result_dict
+    
+    async def aanswer_question_stream(
+        self,
+        user_query: str,
+        min_relevance: float = 0.3,
+        top_k: int = 3,
+        local_first: bool = True
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Асинхронная версия answer_question_stream"""
+        if not self.current_instructions:
+            yield "result", self._not_loaded_result()
+            return
+        
+        logger.info(f"💬 User question (async stream): '{user_query}'")
+        
+        local_result = self.answer_locally(user_query) if local_first else None
+        if local_result is not None:
+            yield "result", local_result
+            return
+        
+        async for event, data in self.search_engine.asearch_stream(
+            user_query=user_query,
+            instructions=self._retrieve_candidates(user_query, top_k),
+            min_relevance=min_relevance,
+        ):
+            if event == "result":
+                data = data.to_dict()
+                self.answer_cache.put(user_query, data, self.version)
+            yield event, data
+    
+    def answer_locally(self, user_query: str) -> Optional[Dict[str, Any]]:
+        """
+        Ответ без вызова LLM: совпадение с названием задачи или кэш ответов
+        
+        Returns:
+            Словарь результата или None, если нужен вызов LLM
+        """
+        if not self.current_instructions:
+            return None
+        
+        fast_result = self._answer_fast_path(user_query)
+        if fast_result is not None:
+            return fast_result.to_dict()
+        
+        return self.answer_cache.get(user_query, self.version)
+    
+    def _retrieve_candidates(self, user_query: str, top_k: int) -> List[Dict[str, Any]]:
+        """Локальный отбор кандидатов, в LLM уходят только они"""
+        candidates = [instr for _, instr in self.index.search(user_query, top_k=top_k)]
+        logger.info(f"🗂️ Retrieved {len(candidates)} of {len(self.current_instructions)} instructions")
+        return candidates
+    
+    @staticmethod
+    def _not_loaded_result() -> Dict[str, Any]:
+        return {
+            "status": "error",
+            "error_message": "Инструкции не загружены. Используйте load_instructions()."
+        }
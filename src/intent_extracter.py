@@ -1,11 +1,18 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from urllib.parse import urlparse
 import json
 import logging
+import threading
 import requests
 from pathlib import Path
 
+from llm_cache import LLMResponseCache
+from llm_resilience import LLMCallError
+from llm_transport import get_transport
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -23,6 +30,10 @@ class ActionType(str, Enum):
     SUBMIT = "submit"
 
 
+# Начало текста инструкции листа, для которого LLM не ответил
+INSTRUCTION_ERROR_PREFIX = "[ОШИБКА]"
+
+
 # ==================== Data Models ====================
 
 @dataclass
@@ -91,6 +102,7 @@ class ProcessingResult:
     instructions_generated: int
     instructions: List[InstructionResult]
     error_message: Optional[str] = None
+    failed_instructions: int = 0  # листья с INSTRUCTION_ERROR_PREFIX вместо инструкции
     
     def to_dict(self) -> Dict[str, Any]:
         """Преобразует в словарь"""
@@ -100,12 +112,28 @@ class ProcessingResult:
             "leaf_tasks": self.leaf_tasks,
             "instructions_generated": self.instructions_generated,
             "instructions": [instr.to_dict() for instr in self.instructions],
-            "error_message": self.error_message
+            "error_message": self.error_message,
+            "failed_instructions": self.failed_instructions
         }
 
 
 # ==================== API Client ====================
 
+# Ограничители одновременных запросов к провайдеру (по хосту API),
+# общие для всех клиентов процесса
+_provider_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_provider_semaphores_lock = threading.Lock()
+
+
+def get_provider_semaphore(base_url: str, max_concurrency: int) -> threading.BoundedSemaphore:
+    """Возвращает общий семафор провайдера; лимит задаёт первый запросивший клиент"""
+    provider: str = urlparse(base_url).netloc or base_url
+    with _provider_semaphores_lock:
+        if provider not in _provider_semaphores:
+            _provider_semaphores[provider] = threading.BoundedSemaphore(max(1, max_concurrency))
+        return _provider_semaphores[provider]
+
+
 class LLMClient:
     """Клиент для взаимодействия с LLM API"""
     
@@ -114,12 +142,25 @@ class LLMClient:
         api_key: str,
         model: str = "tngtech/deepseek-r1t2-chimera:free",
         base_url: str = "https://openrouter.ai/api/v1/chat/completions",
-        timeout: int = 120
+        timeout: Optional[float] = None,
+        max_concurrency: int = 4,
+        cache: Optional[LLMResponseCache] = None,
+        connect_timeout: Optional[float] = None
     ):
+        """
+        Args:
+            timeout: Таймаут чтения ответа, сек (None — из настроек транспорта)
+            max_concurrency: Максимум одновременных запросов к провайдеру
+            cache: Кэш ответов LLM (повторные промпты не отправляются в API)
+            connect_timeout: Таймаут соединения, сек (None — из настроек транспорта)
+        """
+        self.cache: Optional[LLMResponseCache] = cache
         self.api_key: str = api_key
         self.base_url: str = base_url
         self.model: str = model
-        self.timeout: int = timeout
+        self.timeout: Optional[float] = timeout
+        self.connect_timeout: Optional[float] = connect_timeout
+        self.semaphore: threading.BoundedSemaphore = get_provider_semaphore(base_url, max_concurrency)
     
     def generate_instruction(self, prompt: str) -> str:
         """Генерирует инструкцию через API"""
@@ -127,11 +168,17 @@ class LLMClient:
         messages: List[Dict[str, str]] = [
             {"role": "user", "content": prompt}
         ]
+        temperature: float = 0.7
+        
+        if self.cache:
+            cached: Optional[str] = self.cache.get(self.model, temperature, messages)
+            if cached is not None:
+                return cached
         
         payload: Dict[str, Any] = {
             "model": self.model,
             "messages": messages,
-            "temperature": 0.7,
+            "temperature": temperature,
         }
         
         headers: Dict[str, str] = {
@@ -142,17 +189,19 @@ class LLMClient:
         try:
             logger.info(f"Sending request to {self.base_url} (model: {self.model})")
             
-            response: requests.Response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=self.timeout,
-            )
-            response.raise_for_status()
-            
-            data = response.json()
+            with self.semaphore:
+                data: Dict[str, Any] = get_transport().post_json(
+                    self.base_url,
+                    headers=headers,
+                    payload=payload,
+                    connect_timeout=self.connect_timeout,
+                    read_timeout=self.timeout,
+                )
             instruction_text = data["choices"][0]["message"]["content"].strip()
             
+            if self.cache:
+                self.cache.put(self.model, temperature, messages, instruction_text)
+            
             logger.info("✅ Instruction generated successfully")
             return instruction_text
         
@@ -167,6 +216,10 @@ class LLMClient:
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ API request failed: {e}")
             raise RuntimeError(f"API request failed: {str(e)}")
+        
+        except LLMCallError as e:
+            logger.error(f"❌ API error: {e}")
+            raise
 
 
 # ==================== Task Tree Processor ====================
@@ -174,8 +227,14 @@ class LLMClient:
 class TaskTreeProcessor:
     """Обработчик дерева задач"""
     
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, max_workers: int = 1):
+        """
+        Args:
+            llm_client: Клиент LLM
+            max_workers: Количество параллельных генераций листьев (1 — последовательно)
+        """
         self.llm_client: LLMClient = llm_client
+        self.max_workers: int = max_workers
         self.total_tasks: int = 0
         self.leaf_tasks: int = 0
     
@@ -204,27 +263,48 @@ class TaskTreeProcessor:
         
         return total, leaves
     
-    def generate_instructions_recursive(
+    def collect_leaves(
         self,
         node: TaskNode,
         parent_path: str = "",
         parent_task_id: Optional[str] = None,
         depth: int = 0
-    ) -> List[InstructionResult]:
-        """Рекурсивно генерирует инструкции для листьев дерева"""
-        instructions: List[InstructionResult] = []
-        
+    ) -> List[Tuple[TaskNode, str, str, Optional[str], int]]:
+        """
+        Собирает листья дерева в порядке обхода в глубину
+
+        Returns:
+            Список (узел, путь родителя, полный путь, id родителя, глубина)
+        """
         full_path: str = f"{parent_path} > {node.task_name}" if parent_path else node.task_name
         
-        is_leaf = len(node.children) == 0
+        if not node.children:
+            return [(node, parent_path, full_path, parent_task_id, depth)]
         
-        if is_leaf:  # Это лист - генерируем инструкцию
-            logger.info(f"📝 Generating instruction for leaf: {full_path}")
-            
-            # Строим контекст из действий
-            actions_context = self._format_actions(node.actions)
-            
-            prompt: str = f"""Ты — инструктор для пользователей онлайн-сайта. Напиши чёткую пошаговую инструкцию.
+        logger.info(f"→ Traversing non-leaf node: {node.task_name} ({len(node.children)} children)")
+        
+        leaves: List[Tuple[TaskNode, str, str, Optional[str], int]] = []
+        for child in node.children:
+            leaves.extend(self.collect_leaves(
+                child,
+                full_path,
+                parent_task_id=node.task_id,
+                depth=depth + 1
+            ))
+        return leaves
+    
+    def generate_leaf_instruction(
+        self,
+        leaf: Tuple[TaskNode, str, str, Optional[str], int]
+    ) -> InstructionResult:
+        """Генерирует инструкцию для одного листа; ошибка не прерывает обработку"""
+        node, parent_path, full_path, parent_task_id, depth = leaf
+        logger.info(f"📝 Generating instruction for leaf: {full_path}")
+        
+        # Строим контекст из действий
+        actions_context = self._format_actions(node.actions)
+        
+        prompt: str = f"""Ты — инструктор для пользователей онлайн-сайта. Напиши чёткую пошаговую инструкцию.
 
 Название задачи: "{node.task_name}"
 Контекст: {parent_path or 'Главная страница'}
@@ -240,49 +320,47 @@ class TaskTreeProcessor:
 
 Ответ (только шаги, без нумерации и пояснений):
 """
-            
-            try:
-                instruction_text: str = self.llm_client.generate_instruction(prompt)
-                
-                result = InstructionResult(
-                    task_id=node.task_id,
-                    task_name=node.task_name,
-                    full_path=full_path,
-                    depth=depth,
-                    instruction=instruction_text,
-                    is_leaf=True,
-                    parent_task_id=parent_task_id
-                )
-                instructions.append(result)
-                logger.info(f"✅ Instruction generated for: {node.task_id}")
-            
-            except Exception as e:
-                logger.error(f"❌ Failed to generate instruction for {node.task_id}: {e}")
-                # Всё равно добавляем результат с ошибкой
-                result = InstructionResult(
-                    task_id=node.task_id,
-                    task_name=node.task_name,
-                    full_path=full_path,
-                    depth=depth,
-                    instruction=f"[ОШИБКА] Не удалось сгенерировать инструкцию: {str(e)}",
-                    is_leaf=True,
-                    parent_task_id=parent_task_id
-                )
-                instructions.append(result)
         
-        else:  # Рекурсивно обрабатываем детей
-            logger.info(f"→ Traversing non-leaf node: {node.task_name} ({len(node.children)} children)")
-            
-            for child in node.children:
-                child_instructions = self.generate_instructions_recursive(
-                    child,
-                    full_path,
-                    parent_task_id=node.task_id,
-                    depth=depth + 1
-                )
-                instructions.extend(child_instructions)
+        try:
+            instruction_text: str = self.llm_client.generate_instruction(prompt)
+            logger.info(f"✅ Instruction generated for: {node.task_id}")
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to generate instruction for {node.task_id}: {e}")
+            # Всё равно добавляем результат с ошибкой
+            instruction_text = f"{INSTRUCTION_ERROR_PREFIX} Не удалось сгенерировать инструкцию: {str(e)}"
         
-        return instructions
+        return InstructionResult(
+            task_id=node.task_id,
+            task_name=node.task_name,
+            full_path=full_path,
+            depth=depth,
+            instruction=instruction_text,
+            is_leaf=True,
+            parent_task_id=parent_task_id
+        )
+    
+    def generate_instructions_recursive(
+        self,
+        node: TaskNode,
+        parent_path: str = "",
+        parent_task_id: Optional[str] = None,
+        depth: int = 0
+    ) -> List[InstructionResult]:
+        """
+        Генерирует инструкции для листьев дерева.
+
+        При max_workers > 1 листья обрабатываются параллельно; порядок
+        результатов совпадает с порядком обхода дерева.
+        """
+        leaves = self.collect_leaves(node, parent_path, parent_task_id, depth)
+        
+        if self.max_workers <= 1 or len(leaves) <= 1:
+            return [self.generate_leaf_instruction(leaf) for leaf in leaves]
+        
+        logger.info(f"⚙️ Generating {len(leaves)} instructions with {self.max_workers} workers")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.generate_leaf_instruction, leaves))
     
     @staticmethod
     def _format_actions(actions: List[Action]) -> str:
@@ -322,14 +400,18 @@ class TaskTreeProcessor:
             # Генерация инструкций
             instructions = self.generate_instructions_recursive(root_node)
             
+            failed = sum(1 for instr in instructions if instr.instruction.startswith(INSTRUCTION_ERROR_PREFIX))
             logger.info(f"✅ Processing completed: {len(instructions)} instructions generated")
+            if failed:
+                logger.warning(f"⚠️ {failed} of {len(instructions)} instructions failed")
             
             return ProcessingResult(
                 status="success",
                 total_tasks=self.total_tasks,
                 leaf_tasks=self.leaf_tasks,
                 instructions_generated=len(instructions),
-                instructions=instructions
+                instructions=instructions,
+                failed_instructions=failed
             )
         
         except Exception as e:
@@ -349,9 +431,15 @@ class TaskTreeProcessor:
 class InstructionGenerator:
     """Основной интерфейс для генерации инструкций"""
     
-    def __init__(self, api_key: str):
-        self.llm_client = LLMClient(api_key=api_key)
-        self.processor = TaskTreeProcessor(llm_client=self.llm_client)
+    def __init__(
+        self,
+        api_key: str,
+        max_workers: int = 1,
+        max_concurrency: int = 4,
+        cache: Optional[LLMResponseCache] = None
+    ):
+        self.llm_client = LLMClient(api_key=api_key, max_concurrency=max_concurrency, cache=cache)
+        self.processor = TaskTreeProcessor(llm_client=self.llm_client, max_workers=max_workers)
     
     def generate_from_dict(self, tree_dict: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -373,7 +461,10 @@ class InstructionGenerator:
 
 def process_instructions_pipeline(
     tree_dict: Optional[Dict[str, Any]] = None,
-    api_key: Optional[str] = None
+    api_key: Optional[str] = None,
+    max_workers: int = 1,
+    max_concurrency: int = 4,
+    cache: Optional[LLMResponseCache] = None
 ) -> Dict[str, Any]:
     """
     Основная функция для обработки дерева задач
@@ -383,6 +474,9 @@ def process_instructions_pipeline(
         input_file: Путь к JSON-файлу с деревом (если tree_dict не передан)
         output_file: Путь к выходному JSON-файлу с результатом
         api_key: API ключ для LLM (если не передан, читается из окружения)
+        max_workers: Количество параллельных генераций листьев
+        max_concurrency: Лимит одновременных запросов к провайдеру LLM
+        cache: Персистентный кэш ответов LLM
     
     Returns:
         Словарь с результатом обработки
@@ -401,7 +495,12 @@ def process_instructions_pipeline(
         if not api_key:
             raise ValueError("API key must be provided or set in OPENAI_API_KEY env var")
     
-    generator = InstructionGenerator(api_key=api_key)
+    generator = InstructionGenerator(
+        api_key=api_key,
+        max_workers=max_workers,
+        max_concurrency=max_concurrency,
+        cache=cache
+    )
     
     if tree_dict is not None:
         logger.info("Using provided tree dictionary")
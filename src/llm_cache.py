@@ -0,0 +1,239 @@
+# llm_cache.py - Дисковый кэш ответов LLM по хэшу промпта
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from peewee import Model, SqliteDatabase, TextField, IntegerField, FloatField, fn
+
+logger = logging.getLogger(__name__)
+
+# Предельный суммарный размер ответов в кэше, байт; при превышении давно
+# не использованные записи вытесняются до LLM_CACHE_EVICT_TARGET от предела
+LLM_CACHE_MAX_BYTES: int = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+LLM_CACHE_EVICT_TARGET: float = 0.9
+
+# БД кэша инициализируется отложенно — путь задаёт LLMResponseCache
+cache_db = SqliteDatabase(None)
+
+
+class LLMCacheEntry(Model):
+    key = TextField(primary_key=True)  # sha256 от (model, temperature, messages)
+    model = TextField()
+    response = TextField()
+    size = IntegerField()                  # байт ответа в UTF-8
+    created_at = FloatField()
+    last_access = FloatField()
+
+    class Meta:
+        database = cache_db
+        table_name = "llm_cache"
+
+
+class LLMResponseCache:
+    """
+    Персистентный кэш ответов LLM в SQLite.
+
+    Ключ — хэш (модель, temperature, нормализованные сообщения), поэтому
+    одинаковые промпты при повторном запуске анализатора отдаются локально,
+    а упавший прогон продолжается без повторной оплаты завершённых вызовов.
+
+    Пример использования:
+        cache = LLMResponseCache("llm_cache.db", ttl_seconds=86400)
+        text = cache.get(model, 0.7, messages)
+        if text is None:
+            text = call_llm(...)
+            cache.put(model, 0.7, messages, text)
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        ttl_seconds: Optional[float] = 7 * 24 * 3600,
+        max_bytes: int = LLM_CACHE_MAX_BYTES,
+    ) -> None:
+        """
+        Args:
+            db_path: Путь к файлу кэша (str)
+            ttl_seconds: Время жизни записи в секундах, None — бессрочно (Optional[float])
+            max_bytes: Предельный размер ответов в байтах; сверх него записи
+                вытесняются по давности обращения (int)
+        """
+        self.db_path: str = db_path
+        self.ttl_seconds: Optional[float] = ttl_seconds
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evicted: int = 0
+        self._stats_lock = threading.Lock()
+
+        cache_db.init(db_path, pragmas={"journal_mode": "wal", "busy_timeout": 5000})
+        cache_db.connect(reuse_if_open=True)
+        cache_db.create_tables([LLMCacheEntry], safe=True)
+        cache_db.execute_sql(
+            "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)"
+        )
+        self.purge_expired()
+
+        # Оценка сверху суммарного размера: put прибавляет, точная сумма
+        # пересчитывается только при превышении предела (не на каждую запись)
+        self._tracked_bytes: int = self._total_bytes()
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    @staticmethod
+    def _normalize_content(content: Any) -> Any:
+        """Убирает незначащие различия: концевые пробелы и переводы строк"""
+        if not isinstance(content, str):
+            return content
+        return "\n".join(line.rstrip() for line in content.strip().splitlines())
+
+    @classmethod
+    def make_key(cls, model: str, temperature: Optional[float], messages: List[Dict[str, Any]]) -> str:
+        """
+        Ключ кэша для запроса
+
+        Returns:
+            sha256 канонического JSON запроса (str)
+        """
+        normalized = [
+            {"role": m.get("role"), "content": cls._normalize_content(m.get("content"))}
+            for m in messages
+        ]
+        payload: str = json.dumps(
+            {"model": model, "temperature": temperature, "messages": normalized},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _total_bytes() -> int:
+        return LLMCacheEntry.select(fn.SUM(LLMCacheEntry.size)).scalar() or 0
+
+    def _count(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # ---------- Публичные методы ----------
+
+    def get(self, model: str, temperature: Optional[float], messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Возвращает сохранённый ответ или None
+
+        Args:
+            model: Название модели (str)
+            temperature: Температура запроса (Optional[float])
+            messages: Сообщения запроса (List[Dict[str, Any]])
+        """
+        key: str = self.make_key(model, temperature, messages)
+        entry = LLMCacheEntry.get_or_none(LLMCacheEntry.key == key)
+        now: float = time.time()
+
+        if entry is None:
+            self._count(hit=False)
+            return None
+
+        if self.ttl_seconds is not None and now - entry.created_at > self.ttl_seconds:
+            LLMCacheEntry.delete().where(LLMCacheEntry.key == key).execute()
+            self._count(hit=False)
+            return None
+
+        LLMCacheEntry.update(last_access=now).where(LLMCacheEntry.key == key).execute()
+        self._count(hit=True)
+        logger.info(f"💾 LLM cache hit ({model})")
+        return entry.response
+
+    def put(
+        self,
+        model: str,
+        temperature: Optional[float],
+        messages: List[Dict[str, Any]],
+        response: str,
+    ) -> None:
+        """Сохраняет ответ; при превышении предела размера вытесняет старые записи"""
+        now: float = time.time()
+        size: int = len(response.encode("utf-8"))
+        LLMCacheEntry.replace(
+            key=self.make_key(model, temperature, messages),
+            model=model,
+            response=response,
+            size=size,
+            created_at=now,
+            last_access=now,
+        ).execute()
+        with self._stats_lock:
+            self._tracked_bytes += size
+            over_limit: bool = self._tracked_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Удаляет самые давно использованные записи, пока размер кэша больше
+        LLM_CACHE_EVICT_TARGET от max_bytes
+
+        Returns:
+            Количество удалённых записей (int)
+        """
+        total: int = self._total_bytes()
+        excess: int = total - int(self.max_bytes * LLM_CACHE_EVICT_TARGET) if total > self.max_bytes else 0
+        keys: List[str] = []
+        freed: int = 0
+        if excess > 0:
+            oldest = (
+                LLMCacheEntry
+                .select(LLMCacheEntry.key, LLMCacheEntry.size)
+                .order_by(LLMCacheEntry.last_access)
+                .tuples()
+            )
+            for key, size in oldest.iterator():
+                keys.append(key)
+                freed += size
+                if freed >= excess:
+                    break
+            with cache_db.atomic():
+                for start in range(0, len(keys), 500):
+                    LLMCacheEntry.delete().where(LLMCacheEntry.key.in_(keys[start:start + 500])).execute()
+            logger.info(f"LLM cache: evicted {len(keys)} entries ({freed / 1024:.0f} KiB)")
+
+        with self._stats_lock:
+            self._tracked_bytes = total - freed
+            self.evicted += len(keys)
+        return len(keys)
+
+    def purge_expired(self) -> int:
+        """Удаляет записи старше TTL"""
+        if self.ttl_seconds is None:
+            return 0
+        deadline: float = time.time() - self.ttl_seconds
+        removed: int = LLMCacheEntry.delete().where(LLMCacheEntry.created_at < deadline).execute()
+        if removed:
+            logger.info(f"LLM cache: purged {removed} expired entries")
+        return removed
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика кэша
+
+        Returns:
+            Словарь с количеством записей, размером и попаданиями (Dict[str, Any])
+        """
+        lookups: int = self.hits + self.misses
+        return {
+            "path": self.db_path,
+            "entries": LLMCacheEntry.select().count(),
+            "bytes": self._total_bytes(),
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,468 @@
+# llm_resilience.py - Повторы с backoff, бюджет повторов и circuit breaker для LLM-вызовов
+
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+from urllib.parse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Конфигурация по умолчанию (переопределяется переменными окружения)
+LLM_MAX_RETRIES: int = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE: float = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX: float = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+LLM_RETRY_DEADLINE: float = float(os.getenv("LLM_RETRY_DEADLINE", "300"))
+LLM_RETRY_BUDGET_RATIO: float = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.2"))
+LLM_BREAKER_THRESHOLD: int = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET: float = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Коды, при которых повтор имеет смысл: rate limit и временные ошибки провайдера
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504, 520, 522, 524})
+
+
+class LLMCallError(RuntimeError):
+    """Ошибка вызова LLM с признаком, можно ли повторить запрос"""
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable: bool = retryable
+        self.retry_after: Optional[float] = retry_after
+
+
+class CircuitOpenError(LLMCallError):
+    """Провайдер считается деградировавшим — вызов отклонён без обращения к сети"""
+
+
+# ---------- Разбор ответов провайдера ----------
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Значение Retry-After в секундах (число или HTTP-дата), None если не задано"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def check_response(response: requests.Response) -> None:
+    """
+    Проверяет HTTP-статус ответа
+
+    Raises:
+        LLMCallError: Временная ошибка (429, 5xx), retryable=True
+        requests.exceptions.HTTPError: Прочие HTTP-ошибки
+    """
+    if response.status_code in RETRYABLE_STATUS:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        response.close()
+        raise LLMCallError(
+            f"HTTP Error: {response.status_code}",
+            retryable=True,
+            retry_after=retry_after,
+        )
+    response.raise_for_status()
+
+
+def check_payload(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Проверяет JSON-ответ на поле error (OpenRouter отдаёт ошибки провайдера с HTTP 200)
+
+    Raises:
+        LLMCallError: Если в ответе есть error
+    """
+    error = data.get("error") if isinstance(data, dict) else None
+    if not error:
+        return data
+
+    if not isinstance(error, dict):
+        raise LLMCallError(f"OpenRouter API error: {error}")
+
+    metadata = error.get("metadata") or {}
+    message: str = metadata.get("raw") or error.get("message", "Unknown error")
+    try:
+        code: int = int(error.get("code") or 0)
+    except (TypeError, ValueError):
+        code = 0
+    raise LLMCallError(
+        f"OpenRouter API error (код {code}): {message}",
+        retryable=code in RETRYABLE_STATUS,
+        retry_after=parse_retry_after(str(metadata.get("retry_after") or "")),
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """Временная ли ошибка: сеть, таймаут, 429/5xx или retryable-ответ провайдера"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, LLMCallError):
+        return error.retryable
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+# ---------- Примитивы ----------
+
+class RetryBudget:
+    """
+    Бюджет повторов (token bucket).
+
+    Каждый первичный запрос пополняет бюджет на ratio, каждый повтор
+    расходует единицу. Так повторы не превышают ~ratio от трафика и не
+    умножают нагрузку на провайдера, который уже ограничивает нас.
+    """
+
+    def __init__(self, ratio: float = 0.2, capacity: float = 10.0):
+        self.ratio: float = ratio
+        self.capacity: float = capacity
+        self._tokens: float = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Забирает единицу бюджета; False — бюджет исчерпан"""
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker провайдера: closed -> open -> half_open -> closed.
+
+    После failure_threshold временных ошибок подряд вызовы отклоняются
+    (CircuitOpenError) в течение reset_timeout секунд, затем пропускается
+    один пробный вызов: успех замыкает цепь, ошибка снова её размыкает.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name: str = name
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.state: str = self.CLOSED
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+        self._probe_in_flight: bool = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """
+        Raises:
+            CircuitOpenError: Цепь разомкнута или пробный вызов уже выполняется
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            raise CircuitOpenError(
+                f"Circuit open for {self.name}, retry in {retry_in:.0f}s",
+                retry_after=retry_in,
+            )
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"🟢 Circuit closed for {self.name}")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"🔴 Circuit opened for {self.name} after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Снимает пробный вызов, завершившийся невременной ошибкой"""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+# ---------- Политика повторов ----------
+
+class LLMResilience:
+    """
+    Повторы LLM-вызовов с экспоненциальной задержкой и полным jitter.
+
+    Задержка: случайная в [0, min(backoff_max, backoff_base * 2^n)], но не
+    меньше Retry-After провайдера. Повторы ограничены числом попыток,
+    общим сроком (deadline) и бюджетом повторов хоста; каждый хост
+    имеет свой circuit breaker.
+
+    По умолчанию разомкнутая цепь сразу отклоняет вызов: пользователь
+    чата получает fallback, а не ожидание. Пакетным вызовам (анализатор)
+    отказ дороже ожидания — с wait_for_circuit=True вызов ждёт пробного
+    вызова и замыкания цепи в пределах deadline, не тратя попыток.
+
+    Каждая попытка получает остаток deadline и ограничивает им свой
+    таймаут: одна медленная попытка не может пережить общий срок вызова.
+
+    Пример использования:
+        resilience = LLMResilience(max_retries=3)
+        data = resilience.call(url, lambda remaining: do_request(timeout=remaining))
+    """
+
+    def __init__(
+        self,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX,
+        deadline: float = LLM_RETRY_DEADLINE,
+        budget_ratio: float = LLM_RETRY_BUDGET_RATIO,
+        breaker_threshold: int = LLM_BREAKER_THRESHOLD,
+        breaker_reset: float = LLM_BREAKER_RESET,
+        wait_for_circuit: bool = False,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """
+        Args:
+            max_retries: Максимум повторов после первой попытки (int)
+            backoff_base: Базовая задержка, сек (float)
+            backoff_max: Потолок задержки, сек (float)
+            deadline: Предельное общее время вызова с повторами, сек (float)
+            budget_ratio: Доля повторов от числа запросов к хосту (float)
+            breaker_threshold: Ошибок подряд до размыкания цепи (int)
+            breaker_reset: Время до пробного вызова, сек (float)
+            wait_for_circuit: Ждать замыкания цепи в пределах deadline вместо отказа (bool)
+            sleep: Функция ожидания перед повтором
+        """
+        self.max_retries: int = max_retries
+        self.backoff_base: float = backoff_base
+        self.backoff_max: float = backoff_max
+        self.deadline: float = deadline
+        self.budget_ratio: float = budget_ratio
+        self.breaker_threshold: int = breaker_threshold
+        self.breaker_reset: float = breaker_reset
+        self.wait_for_circuit: bool = wait_for_circuit
+        self._sleep = sleep
+
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._budgets: Dict[str, RetryBudget] = {}
+        self._lock = threading.Lock()
+        self.retries: int = 0
+        self.budget_exhausted: int = 0
+        self.circuit_waits: int = 0
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    def _host_state(self, url: str):
+        host: str = urlparse(url).netloc or url
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host, self.breaker_threshold, self.breaker_reset)
+                self._budgets[host] = RetryBudget(self.budget_ratio)
+            return self._breakers[host], self._budgets[host]
+
+    def _retry_delay(
+        self,
+        error: Exception,
+        attempt: int,
+        started: float,
+        breaker: CircuitBreaker,
+        budget: RetryBudget,
+    ) -> Optional[float]:
+        """
+        Учитывает ошибку попытки и решает, повторять ли вызов
+
+        Returns:
+            Задержка перед повтором в секундах или None, если ошибку нужно пробросить
+        """
+        if not is_retryable(error):
+            breaker.release_probe()
+            return None
+        breaker.record_failure()
+
+        delay: float = self.backoff(attempt, getattr(error, "retry_after", None))
+        if attempt >= self.max_retries:
+            return None
+        if breaker.state == CircuitBreaker.OPEN and not self.wait_for_circuit:
+            return None
+        if time.monotonic() - started + delay > self.deadline:
+            logger.warning(f"⏱️ LLM retry deadline reached for {breaker.name}")
+            return None
+        if not budget.withdraw():
+            self.budget_exhausted += 1
+            logger.warning(f"💸 LLM retry budget exhausted for {breaker.name}")
+            return None
+
+        self.retries += 1
+        logger.warning(
+            f"🔁 LLM call failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s"
+        )
+        return delay
+
+    def _remaining(self, started: float, breaker: CircuitBreaker) -> float:
+        """
+        Остаток deadline перед очередной попыткой
+
+        Raises:
+            LLMCallError: Срок вызова исчерпан (например, ожиданием цепи)
+        """
+        remaining: float = self.deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            # Невременная ошибка: _retry_delay снимет пробный вызов и не тронет счётчик ошибок
+            raise LLMCallError(f"LLM call deadline of {self.deadline:.0f}s exceeded for {breaker.name}")
+        return remaining
+
+    def _circuit_delay(self, error: CircuitOpenError, started: float) -> Optional[float]:
+        """
+        Решает, ждать ли замыкания цепи
+
+        Returns:
+            Задержка до следующей проверки цепи или None, если ошибку нужно пробросить
+        """
+        remaining: float = self.deadline - (time.monotonic() - started)
+        if not self.wait_for_circuit or remaining <= 0:
+            return None
+        # Пока идёт пробный вызов, retry_after равен нулю — опрашиваем не чаще backoff_base
+        delay: float = min(max(error.retry_after or 0.0, self.backoff_base), remaining)
+        with self._lock:
+            self.circuit_waits += 1
+        logger.info(f"⏸️ {error}, waiting {delay:.1f}s")
+        return delay
+
+    # ---------- Публичные методы ----------
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Задержка перед повтором номер attempt (с нуля)"""
+        ceiling: float = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay: float = random.uniform(0, ceiling)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, url: str, attempt_fn: Callable[[float], T]) -> T:
+        """
+        Выполняет attempt_fn с повторами временных ошибок
+
+        Args:
+            url: URL провайдера (хост определяет breaker и бюджет)
+            attempt_fn: Одна попытка вызова; получает остаток deadline в секундах
+                (верхняя граница таймаута попытки) и бросает исключение при ошибке
+
+        Returns:
+            Результат attempt_fn
+
+        Raises:
+            CircuitOpenError: Цепь провайдера разомкнута (с wait_for_circuit — дольше deadline)
+            LLMCallError: Срок вызова исчерпан до очередной попытки
+            Exception: Последняя ошибка attempt_fn, если повторы не помогли
+        """
+        breaker, budget = self._host_state(url)
+        budget.deposit()
+        started: float = time.monotonic()
+        attempt: int = 0
+
+        while True:
+            try:
+                breaker.allow()
+            except CircuitOpenError as e:
+                delay = self._circuit_delay(e, started)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                continue
+            try:
+                result = attempt_fn(self._remaining(started, breaker))
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, breaker, budget)
+                if delay is None:
+                    raise
+                attempt += 1
+                self._sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+
+    async def acall(self, url: str, attempt_fn: Callable[[float], Awaitable[T]]) -> T:
+        """
+        Асинхронная версия call: attempt_fn возвращает корутину,
+        ожидание между попытками не блокирует event loop
+        """
+        breaker, budget = self._host_state(url)
+        budget.deposit()
+        started: float = time.monotonic()
+        attempt: int = 0
+
+        while True:
+            try:
+                breaker.allow()
+            except CircuitOpenError as e:
+                delay = self._circuit_delay(e, started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            try:
+                result = await attempt_fn(self._remaining(started, breaker))
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, breaker, budget)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Состояние повторов и цепей по хостам
+
+        Returns:
+            Словарь со счётчиками и состоянием breaker'ов (Dict[str, Any])
+        """
+        with self._lock:
+            hosts = {
+                host: {
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "retry_tokens": round(self._budgets[host].tokens, 2),
+                }
+                for host, breaker in self._breakers.items()
+            }
+        return {
+            "max_retries": self.max_retries,
+            "retries": self.retries,
+            "budget_exhausted": self.budget_exhausted,
+            "circuit_waits": self.circuit_waits,
+            "hosts": hosts,
+        }
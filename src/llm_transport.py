@@ -0,0 +1,385 @@
+# llm_transport.py - Общий HTTP-транспорт с пулом соединений для всех LLM-клиентов
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llm_resilience import (
+    LLMCallError,
+    LLMResilience,
+    RETRYABLE_STATUS,
+    check_payload,
+    check_response,
+    parse_retry_after,
+)
+from metrics import track_llm_call
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация по умолчанию (переопределяется переменными окружения)
+LLM_POOL_SIZE: int = int(os.getenv("LLM_POOL_SIZE", "32"))
+LLM_CONNECT_TIMEOUT: float = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT: float = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+
+
+class LLMTransport:
+    """
+    Keep-alive сессия requests с пулом соединений.
+
+    Один экземпляр разделяется ActionTreeGenerator и обоими LLMClient,
+    поэтому TCP+TLS рукопожатие выполняется один раз на соединение пула,
+    а не на каждый вызов модели.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = LLM_POOL_SIZE,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        resilience: Optional[LLMResilience] = None,
+    ) -> None:
+        """
+        Args:
+            pool_size: Максимум keep-alive соединений на хост (int)
+            connect_timeout: Таймаут установки соединения, сек (float)
+            read_timeout: Таймаут ожидания ответа, сек (float)
+            resilience: Политика повторов и circuit breaker (None — из переменных окружения)
+        """
+        self.pool_size: int = pool_size
+        self.connect_timeout: float = connect_timeout
+        self.read_timeout: float = read_timeout
+        self.resilience: LLMResilience = resilience if resilience is not None else LLMResilience()
+
+        self.session: requests.Session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def timeouts(
+        self,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        remaining: Optional[float] = None,
+    ) -> Tuple[float, float]:
+        """
+        Пара (connect, read) с подстановкой значений транспорта по умолчанию
+
+        Args:
+            remaining: Остаток deadline вызова, сек — верхняя граница обоих таймаутов
+        """
+        connect: float = connect_timeout if connect_timeout is not None else self.connect_timeout
+        read: float = read_timeout if read_timeout is not None else self.read_timeout
+        if remaining is not None:
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    def _send(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float],
+        read_timeout: Optional[float],
+        stream: bool,
+        remaining: Optional[float] = None,
+    ) -> requests.Response:
+        """Одна попытка POST с проверкой на временные HTTP-ошибки"""
+        response: requests.Response = self.session.post(
+            url,
+            headers=headers,
+            json=payload,
+            timeout=self.timeouts(connect_timeout, read_timeout, remaining),
+            stream=stream,
+        )
+        check_response(response)
+        return response
+
+    def post(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """
+        POST JSON через общий пул соединений
+
+        Сетевые ошибки, таймауты, 429 и 5xx повторяются с backoff (для
+        потокового ответа — до получения первого байта тела). Таймауты
+        каждой попытки не превышают остатка deadline политики повторов.
+
+        Raises:
+            llm_resilience.LLMCallError: Временная ошибка не прошла после повторов
+            llm_resilience.CircuitOpenError: Провайдер деградировал, вызов не выполнялся
+            requests.exceptions.RequestException: При сетевой ошибке, таймауте или HTTP-ошибке
+        """
+        return self.resilience.call(
+            url,
+            lambda remaining: self._send(url, headers, payload, connect_timeout, read_timeout, stream, remaining),
+        )
+
+    def post_json(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        POST JSON и разбор ответа; поле error в теле тоже считается ошибкой
+        и повторяется, если провайдер сообщает о временной проблеме
+
+        Returns:
+            Разобранный JSON ответа (Dict[str, Any])
+
+        Raises:
+            llm_resilience.LLMCallError: Ошибка провайдера в ответе или после повторов
+            requests.exceptions.RequestException: При сетевой ошибке, таймауте или HTTP-ошибке
+        """
+        def attempt(remaining: float) -> Dict[str, Any]:
+            response = self._send(url, headers, payload, connect_timeout, read_timeout, False, remaining)
+            return check_payload(response.json())
+
+        with track_llm_call(payload.get("model", "")) as call:
+            data: Dict[str, Any] = self.resilience.call(url, attempt)
+            call["usage"] = data.get("usage")
+        return data
+
+    def close(self) -> None:
+        """Закрывает все соединения пула"""
+        self.session.close()
+
+
+_transport: Optional[LLMTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> LLMTransport:
+    """Общий транспорт процесса (создаётся при первом обращении)"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = LLMTransport()
+    return _transport
+
+
+def configure_transport(
+    pool_size: Optional[int] = None,
+    connect_timeout: Optional[float] = None,
+    read_timeout: Optional[float] = None,
+    resilience: Optional[LLMResilience] = None,
+) -> LLMTransport:
+    """
+    Пересоздаёт общий транспорт с новыми настройками
+
+    Клиенты берут транспорт при каждом вызове, поэтому настройки
+    применяются ко всем уже созданным клиентам. Вызывайте при старте
+    процесса: соединения старого пула закрываются.
+    """
+    global _transport
+    with _transport_lock:
+        old: Optional[LLMTransport] = _transport
+        _transport = LLMTransport(
+            pool_size=pool_size if pool_size is not None else LLM_POOL_SIZE,
+            connect_timeout=connect_timeout if connect_timeout is not None else LLM_CONNECT_TIMEOUT,
+            read_timeout=read_timeout if read_timeout is not None else LLM_READ_TIMEOUT,
+            resilience=resilience,
+        )
+    if old is not None:
+        old.close()
+    logger.info(
+        f"LLM transport configured: pool={_transport.pool_size}, "
+        f"connect={_transport.connect_timeout}s, read={_transport.read_timeout}s, "
+        f"retries={_transport.resilience.max_retries}"
+    )
+    return _transport
+
+
+class AsyncLLMTransport:
+    """
+    Асинхронный аналог LLMTransport на aiohttp.
+
+    Используется в ASGI-режиме API: ожидание ответа провайдера не занимает
+    поток, поэтому тысячи чатов могут ждать LLM в одном процессе. Повторы
+    и circuit breaker общие с синхронным транспортом, если передан тот же
+    объект resilience.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = LLM_POOL_SIZE,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        resilience: Optional[LLMResilience] = None,
+    ) -> None:
+        """
+        Создаётся внутри работающего event loop.
+
+        Args:
+            pool_size: Максимум одновременных соединений с провайдером (int)
+            connect_timeout: Таймаут установки соединения, сек (float)
+            read_timeout: Таймаут ожидания ответа, сек (float)
+            resilience: Политика повторов и circuit breaker (None — из переменных окружения)
+        """
+        import aiohttp  # pip install aiohttp — нужен только для ASGI-режима
+
+        self._aiohttp = aiohttp
+        self.pool_size: int = pool_size
+        self.connect_timeout: float = connect_timeout
+        self.read_timeout: float = read_timeout
+        self.resilience: LLMResilience = resilience if resilience is not None else LLMResilience()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size),
+        )
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    def _timeout(
+        self,
+        connect_timeout: Optional[float],
+        read_timeout: Optional[float],
+        remaining: Optional[float] = None,
+    ):
+        connect: float = connect_timeout if connect_timeout is not None else self.connect_timeout
+        read: float = read_timeout if read_timeout is not None else self.read_timeout
+        if remaining is not None:
+            connect, read = min(connect, remaining), min(read, remaining)
+        return self._aiohttp.ClientTimeout(total=None, connect=connect, sock_read=read)
+
+    async def _send(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float],
+        read_timeout: Optional[float],
+        remaining: Optional[float] = None,
+    ):
+        """Одна попытка POST; сетевые и временные HTTP-ошибки -> LLMCallError"""
+        try:
+            response = await self.session.post(
+                url,
+                headers=headers,
+                json=payload,
+                timeout=self._timeout(connect_timeout, read_timeout, remaining),
+            )
+        except asyncio.TimeoutError:
+            raise LLMCallError("API request timed out", retryable=True)
+        except self._aiohttp.ClientError as e:
+            raise LLMCallError(f"API request failed: {e}", retryable=True)
+
+        if response.status >= 400:
+            response.release()
+            raise LLMCallError(
+                f"HTTP Error: {response.status}",
+                retryable=response.status in RETRYABLE_STATUS,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
+        return response
+
+    # ---------- Публичные методы ----------
+
+    async def post_json(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Асинхронный POST JSON с разбором ответа (см. LLMTransport.post_json)
+
+        Raises:
+            llm_resilience.LLMCallError: Ошибка сети, HTTP или провайдера после повторов
+        """
+        async def attempt(remaining: float) -> Dict[str, Any]:
+            response = await self._send(url, headers, payload, connect_timeout, read_timeout, remaining)
+            try:
+                async with response:
+                    return check_payload(json.loads(await response.read()))
+            except asyncio.TimeoutError:
+                raise LLMCallError("API request timed out", retryable=True)
+            except self._aiohttp.ClientError as e:
+                raise LLMCallError(f"API request failed: {e}", retryable=True)
+            except json.JSONDecodeError as e:
+                raise LLMCallError(f"API returned invalid JSON: {e}")
+
+        with track_llm_call(payload.get("model", "")) as call:
+            data: Dict[str, Any] = await self.resilience.acall(url, attempt)
+            call["usage"] = data.get("usage")
+        return data
+
+    @asynccontextmanager
+    async def stream_lines(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ) -> AsyncIterator[AsyncIterator[str]]:
+        """
+        Потоковый POST: повторы выполняются до получения первого байта тела
+
+        Yields:
+            Асинхронный итератор строк тела ответа (без перевода строки)
+        """
+        response = await self.resilience.acall(
+            url,
+            lambda remaining: self._send(url, headers, payload, connect_timeout, read_timeout, remaining),
+        )
+
+        async def lines() -> AsyncIterator[str]:
+            async for raw in response.content:
+                yield raw.decode("utf-8").rstrip("\r\n")
+
+        try:
+            yield lines()
+        finally:
+            response.release()
+
+    async def close(self) -> None:
+        """Закрывает все соединения пула"""
+        await self.session.close()
+
+
+_async_transport: Optional[AsyncLLMTransport] = None
+
+
+def get_async_transport() -> AsyncLLMTransport:
+    """
+    Общий асинхронный транспорт процесса
+
+    Создаётся при первом обращении внутри работающего event loop и
+    разделяет политику повторов с синхронным транспортом.
+    """
+    global _async_transport
+    if _async_transport is None:
+        sync_transport: LLMTransport = get_transport()
+        _async_transport = AsyncLLMTransport(
+            pool_size=sync_transport.pool_size,
+            connect_timeout=sync_transport.connect_timeout,
+            read_timeout=sync_transport.read_timeout,
+            resilience=sync_transport.resilience,
+        )
+    return _async_transport
+
+
+async def close_async_transport() -> None:
+    """Закрывает асинхронный транспорт (вызывается при остановке ASGI-приложения)"""
+    global _async_transport
+    if _async_transport is not None:
+        await _async_transport.close()
+        _async_transport = None
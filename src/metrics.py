@@ -0,0 +1,345 @@
+# metrics.py - Метрики процесса в текстовом формате Prometheus
+#
+# Без внешних зависимостей: счётчики, gauge и гистограммы с метками,
+# а также метрики, значения которых читаются в момент выгрузки
+# (глубина очередей, статистика кэшей). Выгружаются через GET /metrics.
+
+import asyncio
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llm_resilience import CircuitOpenError
+
+# Границы корзин по умолчанию, сек: от быстрых ответов API до долгих вызовов LLM
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+DB_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+)
+LLM_BUCKETS: Tuple[float, ...] = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+# ==================== Метрики ====================
+
+class Metric:
+    """Базовый класс: имя, описание и имена меток"""
+
+    type_name: str = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name: str = name
+        self.help: str = help_text
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """Список (имя, имена меток, значения меток, значение)"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        for name, labelnames, values, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счётчик"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, self.labelnames, key, value) for key, value in items]
+
+
+class Gauge(Metric):
+    """Значение, которое может расти и уменьшаться"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, self.labelnames, key, value) for key, value in items]
+
+
+class Histogram(Metric):
+    """Гистограмма с накопительными корзинами, суммой и количеством наблюдений"""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self._values: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Замеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1])) for key, state in self._values.items())
+        names = self.labelnames + ("le",)
+        result = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                result.append((f"{self.name}_bucket", names, key + (_format_value(bound),), cumulative))
+            result.append((f"{self.name}_sum", self.labelnames, key, total))
+            result.append((f"{self.name}_count", self.labelnames, key, cumulative))
+        return result
+
+
+class CallbackMetric(Metric):
+    """
+    Метрика, значение которой вычисляется при выгрузке
+
+    func возвращает число или словарь {кортеж значений меток: число}.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        func: Callable[[], Any],
+        type_name: str = "gauge",
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.type_name = type_name
+        self.func = func
+
+    def samples(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            return [(self.name, (), (), float(value))]
+        return [
+            (self.name, self.labelnames, tuple(str(v) for v in key), float(val))
+            for key, val in sorted(value.items())
+        ]
+
+
+# ==================== Реестр ====================
+
+class Registry:
+    """Набор метрик процесса с выгрузкой в текстовом формате Prometheus"""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Добавляет метрику; повторная регистрация имени заменяет прежнюю"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback(
+        self,
+        name: str,
+        help_text: str,
+        func: Callable[[], Any],
+        type_name: str = "gauge",
+        labelnames: Sequence[str] = (),
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, func, type_name, labelnames))
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате экспозиции Prometheus 0.0.4"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # Сломанный callback не должен ломать выгрузку остальных метрик
+                blocks.append(f"# {metric.name} collection failed: {_escape(str(e))}")
+        return "\n".join(blocks) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ==================== Метрики приложения ====================
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"),
+)
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route (streaming responses: until the stream starts)",
+    ("route", "method"),
+)
+LLM_REQUEST_DURATION = REGISTRY.histogram(
+    "llm_request_duration_seconds",
+    "LLM call latency including retries, by model and outcome",
+    ("model", "outcome"),
+    buckets=LLM_BUCKETS,
+)
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "Tokens reported by the provider, by model and kind", ("model", "kind"),
+)
+DB_QUERY_DURATION = REGISTRY.histogram(
+    "db_query_duration_seconds",
+    "SQLite statement execution time by operation and table",
+    ("operation", "table"),
+    buckets=DB_BUCKETS,
+)
+CHAT_ANSWERS = REGISTRY.counter(
+    "chat_answers_total", "Chat answers by source and status", ("answered_by", "status"),
+)
+
+
+def observe_http_request(route: str, method: str, status: int, seconds: float) -> None:
+    """Учитывает один HTTP-запрос"""
+    HTTP_REQUESTS.inc(route=route, method=method, status=status)
+    HTTP_REQUEST_DURATION.observe(seconds, route=route, method=method)
+
+
+def llm_outcome(error: Optional[BaseException]) -> str:
+    """Метка исхода вызова LLM"""
+    if error is None:
+        return "success"
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+        return "cancelled"
+    return "error"
+
+
+def record_llm_usage(model: str, usage: Optional[Dict[str, Any]]) -> None:
+    """Токены из поля usage ответа провайдера (если провайдер его прислал)"""
+    if not usage:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            LLM_TOKENS.inc(tokens, model=model, kind=kind)
+
+
+@contextmanager
+def track_llm_call(model: str) -> Iterator[Dict[str, Any]]:
+    """
+    Замеряет вызов LLM от запроса до последнего байта ответа
+
+    Yields:
+        Словарь, в который вызывающий кладёт "usage" из ответа провайдера
+    """
+    call: Dict[str, Any] = {"usage": None}
+    error: Optional[BaseException] = None
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        LLM_REQUEST_DURATION.observe(time.perf_counter() - started, model=model, outcome=llm_outcome(error))
+        record_llm_usage(model, call["usage"])
+
+
+_SQL_TABLE = re.compile(
+    r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?'
+    r'(?:["`\[]?\w+["`\]]?\.)?["`\[]?(\w+)',
+    re.IGNORECASE,
+)
+
+
+def observe_db_query(sql: str, seconds: float) -> None:
+    """Учитывает один SQL-запрос (операция — первое слово, таблица — первая в запросе)"""
+    head = sql.lstrip()
+    operation = head.split(None, 1)[0].upper() if head else "UNKNOWN"
+    match = _SQL_TABLE.search(head)
+    DB_QUERY_DURATION.observe(seconds, operation=operation, table=match.group(1) if match else "")
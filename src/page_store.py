@@ -0,0 +1,371 @@
+# page_store.py - Хранилище снимков скачанных страниц для условных запросов
+
+import hashlib
+import logging
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from peewee import BlobField, FloatField, IntegerField, Model, SqliteDatabase, TextField, fn
+
+logger = logging.getLogger(__name__)
+
+# БД снимков инициализируется отложенно — путь задаёт PageStore
+store_db = SqliteDatabase(None)
+
+
+class PageBlob(Model):
+    hash = TextField(primary_key=True)  # sha256 тела страницы (UTF-8)
+    data = BlobField()                  # тело, сжатое zlib
+    size = IntegerField()
+    compressed_size = IntegerField()
+    created_at = FloatField()
+
+    class Meta:
+        database = store_db
+        table_name = "page_blobs"
+
+
+class PageSnapshot(Model):
+    url = TextField(primary_key=True)             # канонический URL
+    final_url = TextField()
+    content_type = TextField()
+    content_hash = TextField()                    # последнее скачанное тело
+    baseline_hash = TextField(null=True)          # тело, учтённое последним анализом
+    etag = TextField(null=True)
+    last_modified = TextField(null=True)
+    fetched_at = FloatField()                     # последняя загрузка тела (200)
+    checked_at = FloatField()                     # последняя проверка (200 или 304)
+
+    class Meta:
+        database = store_db
+        table_name = "page_snapshots"
+
+
+@dataclass
+class Snapshot:
+    """Сохранённая версия страницы"""
+    url: str
+    final_url: str
+    content_type: str
+    content_hash: str
+    text: str
+
+
+class PageStore:
+    """
+    Персистентное хранилище снимков страниц в SQLite.
+
+    Тела хранятся сжатыми и адресуются sha256 содержимого, поэтому одинаковые
+    страницы занимают место один раз. Для каждого URL запоминаются ETag и
+    Last-Modified: повторный обход отправляет If-None-Match/If-Modified-Since
+    и на 304 берёт тело из хранилища.
+
+    Изменения считаются относительно базовой версии — снимков, которые учёл
+    последний успешный анализ (commit_baseline), а не предыдущего обхода:
+    упавший анализ не «съедает» изменения следующего запуска. Страница,
+    которую не удалось скачать (mark_failed), и страницы обхода, обрезанного
+    лимитом (mark_truncated), удалёнными не считаются.
+
+    Пример использования:
+        store = PageStore("page_snapshots.db")
+        store.begin_run()
+        ...  # SiteCrawler(store=store).crawl(...)
+        report = store.changes()
+        if report["changed"] or report["new"] or report["removed"]:
+            analyze(...)
+            store.commit_baseline()
+    """
+
+    def __init__(self, db_path: str, compress_level: int = 6) -> None:
+        """
+        Args:
+            db_path: Путь к файлу хранилища (str)
+            compress_level: Уровень сжатия zlib 1-9 (int)
+        """
+        self.db_path: str = db_path
+        self.compress_level: int = compress_level
+        self._lock = threading.Lock()
+        # Потоки обходчика пишут в одну БД: транзакция «прочитать и записать»
+        # из нескольких потоков упирается в SQLITE_BUSY, поэтому записи идут по очереди
+        self._write_lock = threading.Lock()
+
+        # Итоги текущего обхода: URL -> "new" | "changed" | "unchanged"
+        self._run: Dict[str, str] = {}
+        # URL с временной ошибкой загрузки и признак обхода, обрезанного лимитом страниц
+        self._failed: Set[str] = set()
+        self._truncated: bool = False
+        self.not_modified: int = 0
+
+        store_db.init(db_path, pragmas={"journal_mode": "wal", "busy_timeout": 5000})
+        store_db.connect(reuse_if_open=True)
+        store_db.create_tables([PageBlob, PageSnapshot], safe=True)
+
+    # ---------- Вспомогательные методы (приватные) ----------
+
+    @staticmethod
+    def _hash(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urlsplit(url).netloc.lower()
+
+    def _read_blob(self, content_hash: str) -> Optional[str]:
+        blob = PageBlob.get_or_none(PageBlob.hash == content_hash)
+        if blob is None:
+            return None
+        return zlib.decompress(bytes(blob.data)).decode("utf-8")
+
+    def _record(self, url: str, content_hash: str, baseline_hash: Optional[str]) -> bool:
+        """Отмечает URL в итогах обхода; True — тело отличается от базовой версии"""
+        if baseline_hash is None:
+            state = "new"
+        elif baseline_hash != content_hash:
+            state = "changed"
+        else:
+            state = "unchanged"
+        with self._lock:
+            self._run[url] = state
+        return state != "unchanged"
+
+    # ---------- Публичные методы ----------
+
+    def begin_run(self) -> None:
+        """Начинает новый обход: сбрасывает итоги предыдущего"""
+        with self._lock:
+            self._run = {}
+            self._failed = set()
+            self._truncated = False
+            self.not_modified = 0
+
+    def mark_failed(self, url: str) -> None:
+        """Отмечает временную ошибку загрузки URL (сеть, 5xx): страница не считается удалённой"""
+        with self._lock:
+            self._failed.add(url)
+
+    def mark_truncated(self) -> None:
+        """Отмечает, что обход остановлен лимитом страниц: пропавшие страницы не считаются удалёнными"""
+        with self._lock:
+            self._truncated = True
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """
+        Заголовки условного запроса для URL
+
+        Returns:
+            If-None-Match / If-Modified-Since, если страница уже сохранена (Dict[str, str])
+        """
+        snapshot = PageSnapshot.get_or_none(PageSnapshot.url == url)
+        if snapshot is None:
+            return {}
+        headers: Dict[str, str] = {}
+        if snapshot.etag:
+            headers["If-None-Match"] = snapshot.etag
+        if snapshot.last_modified:
+            headers["If-Modified-Since"] = snapshot.last_modified
+        return headers
+
+    def save(
+        self,
+        url: str,
+        text: str,
+        final_url: str,
+        content_type: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Tuple[Snapshot, bool]:
+        """
+        Сохраняет скачанное тело страницы (ответ 200)
+
+        Args:
+            url: Канонический URL (str)
+            text: Тело страницы (str)
+            final_url: Адрес после редиректов (str)
+            content_type: Заголовок Content-Type (str)
+            etag: Заголовок ETag (Optional[str])
+            last_modified: Заголовок Last-Modified (Optional[str])
+
+        Returns:
+            Снимок и признак изменения относительно базовой версии (Tuple[Snapshot, bool])
+        """
+        body: bytes = text.encode("utf-8")
+        content_hash: str = self._hash(body)
+        now: float = time.time()
+
+        with self._write_lock, store_db.atomic():
+            if not PageBlob.select().where(PageBlob.hash == content_hash).exists():
+                data: bytes = zlib.compress(body, self.compress_level)
+                PageBlob.insert(
+                    hash=content_hash,
+                    data=data,
+                    size=len(body),
+                    compressed_size=len(data),
+                    created_at=now,
+                ).on_conflict_ignore().execute()
+
+            previous = PageSnapshot.get_or_none(PageSnapshot.url == url)
+            baseline_hash: Optional[str] = previous.baseline_hash if previous else None
+            PageSnapshot.replace(
+                url=url,
+                final_url=final_url,
+                content_type=content_type,
+                content_hash=content_hash,
+                baseline_hash=baseline_hash,
+                etag=etag,
+                last_modified=last_modified,
+                fetched_at=now,
+                checked_at=now,
+            ).execute()
+
+        changed: bool = self._record(url, content_hash, baseline_hash)
+        return Snapshot(url, final_url, content_type, content_hash, text), changed
+
+    def revalidate(self, url: str, headers: Optional[Mapping[str, str]] = None) -> Optional[Tuple[Snapshot, bool]]:
+        """
+        Отдаёт сохранённое тело для ответа 304 Not Modified
+
+        Args:
+            url: Канонический URL (str)
+            headers: Заголовки ответа 304 — могут обновить ETag/Last-Modified (Optional[Mapping[str, str]])
+
+        Returns:
+            Снимок и признак изменения относительно базовой версии
+            или None, если снимка нет (Optional[Tuple[Snapshot, bool]])
+        """
+        snapshot = PageSnapshot.get_or_none(PageSnapshot.url == url)
+        text: Optional[str] = self._read_blob(snapshot.content_hash) if snapshot else None
+        if snapshot is None or text is None:
+            return None
+
+        headers = headers or {}
+        with self._write_lock:
+            PageSnapshot.update(
+                etag=headers.get("ETag") or snapshot.etag,
+                last_modified=headers.get("Last-Modified") or snapshot.last_modified,
+                checked_at=time.time(),
+            ).where(PageSnapshot.url == url).execute()
+
+        with self._lock:
+            self.not_modified += 1
+        changed: bool = self._record(url, snapshot.content_hash, snapshot.baseline_hash)
+        result = Snapshot(url, snapshot.final_url, snapshot.content_type, snapshot.content_hash, text)
+        return result, changed
+
+    def load(self, url: str) -> Optional[Snapshot]:
+        """Последний сохранённый снимок URL или None"""
+        snapshot = PageSnapshot.get_or_none(PageSnapshot.url == url)
+        text: Optional[str] = self._read_blob(snapshot.content_hash) if snapshot else None
+        if text is None:
+            return None
+        return Snapshot(url, snapshot.final_url, snapshot.content_type, snapshot.content_hash, text)
+
+    def changes(self) -> Dict[str, List[str]]:
+        """
+        Итоги текущего обхода относительно базовой версии
+
+        removed — страницы базовой версии с тех же хостов, которых не было
+        в этом обходе (удалены с сайта, 404, запрещены robots.txt). Если обход
+        обрезан лимитом страниц, набор страниц зависит от порядка загрузок,
+        и removed пуст. unreachable — страницы базовой версии с временной
+        ошибкой загрузки.
+
+        Returns:
+            Списки URL по ключам new, changed, unchanged, removed, unreachable (Dict[str, List[str]])
+        """
+        with self._lock:
+            run: Dict[str, str] = dict(self._run)
+            failed: Set[str] = set(self._failed)
+            truncated: bool = self._truncated
+
+        report: Dict[str, List[str]] = {"new": [], "changed": [], "unchanged": [], "removed": [], "unreachable": []}
+        for url, state in sorted(run.items()):
+            report[state].append(url)
+
+        hosts: Set[str] = {self._host(url) for url in run} | {self._host(url) for url in failed}
+        baseline = PageSnapshot.select(PageSnapshot.url).where(PageSnapshot.baseline_hash.is_null(False))
+        for snapshot in baseline:
+            if snapshot.url in run or self._host(snapshot.url) not in hosts:
+                continue
+            if snapshot.url in failed:
+                report["unreachable"].append(snapshot.url)
+            elif not truncated:
+                report["removed"].append(snapshot.url)
+        report["removed"].sort()
+        report["unreachable"].sort()
+        return report
+
+    def has_changes(self) -> bool:
+        """Есть ли в текущем обходе новые, изменённые или пропавшие страницы"""
+        report = self.changes()
+        return bool(report["new"] or report["changed"] or report["removed"])
+
+    def commit_baseline(self, urls: Optional[Iterable[str]] = None) -> None:
+        """
+        Фиксирует снимки текущего обхода как базовую версию (после успешного анализа)
+
+        Пропавшие страницы удаляются, тела, на которые больше никто
+        не ссылается, вычищаются. Недоступные страницы не вошли в анализ:
+        их снимки остаются, но выходят из базовой версии — когда страница
+        снова скачается, она будет новой и вызовет повторный анализ.
+
+        Args:
+            urls: URL для фиксации, по умолчанию — все страницы обхода (Optional[Iterable[str]])
+        """
+        report = self.changes()
+        if urls is None:
+            urls = report["new"] + report["changed"] + report["unchanged"]
+        urls = list(urls)
+
+        with self._write_lock, store_db.atomic():
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                PageSnapshot.update(baseline_hash=PageSnapshot.content_hash).where(
+                    PageSnapshot.url.in_(chunk)
+                ).execute()
+            for start in range(0, len(report["removed"]), 500):
+                chunk = report["removed"][start:start + 500]
+                PageSnapshot.delete().where(PageSnapshot.url.in_(chunk)).execute()
+            for start in range(0, len(report["unreachable"]), 500):
+                chunk = report["unreachable"][start:start + 500]
+                PageSnapshot.update(baseline_hash=None).where(PageSnapshot.url.in_(chunk)).execute()
+        self.prune()
+
+    def prune(self) -> int:
+        """
+        Удаляет тела, на которые не ссылается ни один снимок
+
+        Returns:
+            Количество удалённых тел (int)
+        """
+        referenced = PageSnapshot.select(PageSnapshot.content_hash)
+        with self._write_lock:
+            removed: int = PageBlob.delete().where(PageBlob.hash.not_in(referenced)).execute()
+        if removed:
+            logger.info(f"Page store: pruned {removed} unreferenced bodies")
+        return removed
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика хранилища и текущего обхода
+
+        Returns:
+            Словарь с количеством снимков, размерами и итогами обхода (Dict[str, Any])
+        """
+        report = self.changes()
+        bodies, raw, compressed = PageBlob.select(
+            fn.COUNT(PageBlob.hash), fn.SUM(PageBlob.size), fn.SUM(PageBlob.compressed_size)
+        ).tuples().get()
+        return {
+            "path": self.db_path,
+            "snapshots": PageSnapshot.select().count(),
+            "bodies": bodies,
+            "raw_bytes": raw or 0,
+            "stored_bytes": compressed or 0,
+            "not_modified": self.not_modified,
+            "truncated": self._truncated,
+            **{state: len(urls) for state, urls in report.items()},
+        }
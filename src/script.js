@@ -511,9 +511,11 @@ async function sendMessage() {
     addMessageToChat(message, 'user');
     chatInput.value = '';
 
-    // Send to server
+    // Send to server: ответ приходит потоком (Server-Sent Events)
+    const botParagraph = addMessageToChat('...', 'bot');
+    let streamed = '';
     try {
-        const response = await fetch('http://localhost:5000/api/chat', {
+        const response = await fetch('http://localhost:5000/api/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -525,11 +527,44 @@ async function sendMessage() {
             throw new Error(`HTTP ${response.status}`);
         }
 
-        const data = await response.json();
-        addMessageToChat(data.message || 'Не получен ответ', 'bot');
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // События SSE разделены пустой строкой
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                let dataLine = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) eventName = line.slice(7);
+                    if (line.startsWith('data: ')) dataLine += line.slice(6);
+                });
+                if (!dataLine) continue;
+                const data = JSON.parse(dataLine);
+
+                if (eventName === 'description') {
+                    streamed += data.text;
+                    botParagraph.textContent = streamed;
+                } else if (eventName === 'result') {
+                    botParagraph.textContent = data.message || 'Не получен ответ';
+                } else if (eventName === 'error') {
+                    throw new Error(data.error);
+                }
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
+        }
     } catch (error) {
         console.error('Chat error:', error);
-        addMessageToChat(data.message || 'Не получен ответ', 'bot');
+        botParagraph.textContent = streamed || 'Не получен ответ';
     }
 }
 
@@ -539,6 +574,7 @@ function addMessageToChat(text, sender) {
     messageDiv.innerHTML = `<p>${escapeHtml(text)}</p>`;
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv.querySelector('p');
 }
 
 function escapeHtml(text) {
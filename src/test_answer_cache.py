@@ -0,0 +1,60 @@
+# test_answer_cache.py - Поиск перефразов в AnswerCache не путает противоположные действия
+#
+# Запуск: python -m pytest -q test_answer_cache.py
+
+from instruction_finder import AnswerCache
+
+
+def _answer(task):
+    return {"status": "success", "answered_by": "llm", "task": task}
+
+
+def _cache(*pairs):
+    cache = AnswerCache(max_entries=100, ttl_seconds=None)
+    for query, task in pairs:
+        cache.put(query, _answer(task))
+    return cache
+
+
+def test_add_and_remove_are_not_paraphrases():
+    cache = _cache(("как добавить красный товар в корзину", "Добавить в корзину"))
+
+    assert cache.get("как удалить красный товар из корзины") is None
+    assert cache.get("как убрать красный товар из корзины") is None
+
+
+def test_cancel_and_pay_are_not_paraphrases():
+    cache = _cache(("как отменить заказ", "Отменить заказ"))
+
+    assert cache.get("как оплатить заказ") is None
+    assert cache.get("подскажите, как отменить заказ")["task"] == "Отменить заказ"
+
+
+def test_different_verb_misses_even_with_high_similarity():
+    cache = _cache(("как добавить красный товар в корзину на главной странице", "Добавить в корзину"))
+
+    assert cache.get("как удалить красный товар из корзины на главной странице") is None
+
+
+def test_different_object_below_threshold_misses():
+    cache = _cache(("как добавить красный товар в корзину", "Добавить в корзину"))
+
+    assert cache.get("как добавить синий товар в корзину") is None
+
+
+def test_paraphrase_with_filler_words_hits():
+    cache = _cache(
+        ("как оформить заказ", "Оформить заказ"),
+        ("как добавить товар в корзину", "Добавить в корзину"),
+    )
+
+    assert cache.get("оформление заказа")["task"] == "Оформить заказ"
+    hit = cache.get("подскажите пожалуйста, как добавить товар в корзину?")
+    assert hit["task"] == "Добавить в корзину" and hit["answered_by"] == "cache"
+    assert cache.similar_hits == 2
+
+
+def test_synonym_verbs_hit():
+    cache = _cache(("как удалить товар из корзины", "Удалить из корзины"))
+
+    assert cache.get("как убрать товар из корзины")["task"] == "Удалить из корзины"
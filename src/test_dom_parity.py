@@ -0,0 +1,58 @@
+# test_dom_parity.py - Совпадение dom_extractor.py с выводом node dom_parser.js
+#
+# dom_analysis.json — результат dom_parser.js (jsdom) для testdata/page_1.html.
+# Запуск: python -m pytest -q test_dom_parity.py
+
+import json
+from pathlib import Path
+
+from dom_extractor import DOMExtractor, DOMTreeBuilder, extract_page
+
+SRC_DIR = Path(__file__).resolve().parent
+PAGE = (SRC_DIR / "testdata" / "page_1.html").read_text(encoding="utf-8")
+RECORDED = json.loads((SRC_DIR / "dom_analysis.json").read_text(encoding="utf-8"))
+
+
+def test_page_matches_dom_parser_output():
+    recorded = RECORDED["results"][0]
+    result = extract_page(recorded["file"], PAGE)
+
+    assert result["stats"] == recorded["stats"]
+    assert result["domTree"] == recorded["domTree"]
+
+
+def test_summary_matches_dom_parser_output():
+    analysis = DOMExtractor(workers=1).extract([(RECORDED["results"][0]["file"], PAGE)])
+
+    assert analysis["summary"] == RECORDED["summary"]
+    assert analysis["analyzedAt"].endswith("Z")
+
+
+def test_process_pool_matches_inline():
+    pages = [(f"page_{i}.html", PAGE) for i in range(3)]
+
+    inline = DOMExtractor(workers=1).extract(pages)
+    pooled = DOMExtractor(workers=2).extract(pages)
+
+    assert pooled["results"] == inline["results"]
+    assert pooled["summary"] == inline["summary"]
+
+
+def test_implied_structure_like_html5_parser():
+    tree = DOMTreeBuilder().build("<title>T</title><p>a<p>b<table><tr><td>1<td>2</table><ul><li>x<li>y</ul>")
+
+    head, body = tree["children"]
+    assert head["tagName"] == "head" and body["tagName"] == "body"
+    assert [c["tagName"] for c in body["children"]] == ["p", "p", "table", "ul"]
+
+    table = body["children"][2]
+    assert [c["tagName"] for c in table["children"]] == ["tbody"]
+    assert [c["textContent"] for c in table["children"][0]["children"][0]["children"]] == ["1", "2"]
+    assert tree["elementCount"] == 13
+
+
+def test_text_content_limit_counts_utf16_units():
+    tree = DOMTreeBuilder().build("<body><p>" + "😀" * 150 + "</p></body>")
+
+    paragraph = tree["children"][1]["children"][0]
+    assert paragraph["textContent"] == "😀" * 100
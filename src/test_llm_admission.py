@@ -0,0 +1,63 @@
+# test_llm_admission.py - Слоты LLMAdmissionController не теряются при отмене ожидания
+#
+# Запуск: python -m pytest -q test_llm_admission.py
+
+import asyncio
+
+from assistant_api import LLMAdmissionController
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        admission = LLMAdmissionController(max_concurrency=1, max_queue=4, max_wait=5.0)
+        holder_entered = asyncio.Event()
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with admission.aslot("a"):
+                holder_entered.set()
+                await release_holder.wait()
+
+        async def waiter():
+            async with admission.aslot("b"):
+                pass
+
+        holder_task = asyncio.create_task(holder())
+        await holder_entered.wait()
+        waiter_task = asyncio.create_task(waiter())
+        await asyncio.sleep(0.01)
+        assert admission.get_info()["queue_depth"] == 1
+
+        waiter_task.cancel()
+        await asyncio.gather(waiter_task, return_exceptions=True)
+        release_holder.set()
+        await holder_task
+
+        info = admission.get_info()
+        assert info["active"] == 0
+        assert info["queue_depth"] == 0
+        assert info["waiting_sessions"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancel_after_grant_releases_slot():
+    async def scenario():
+        admission = LLMAdmissionController(max_concurrency=1, max_queue=4, max_wait=5.0)
+        entered = asyncio.Event()
+
+        async def waiter():
+            async with admission.aslot("b"):
+                entered.set()
+
+        with admission.slot("a"):
+            waiter_task = asyncio.create_task(waiter())
+            await asyncio.sleep(0.01)
+        # Слот передан ожидающему, но корутину отменяют до того, как она проснулась
+        waiter_task.cancel()
+        await asyncio.gather(waiter_task, return_exceptions=True)
+
+        assert not entered.is_set()
+        assert admission.get_info()["active"] == 0
+
+    asyncio.run(scenario())
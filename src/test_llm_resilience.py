@@ -0,0 +1,68 @@
+# test_llm_resilience.py - Deadline LLMResilience ограничивает и повторы, и каждую попытку
+#
+# Запуск: python -m pytest -q test_llm_resilience.py
+
+import pytest
+import requests
+
+from llm_resilience import LLMCallError, LLMResilience
+from llm_transport import LLMTransport
+
+
+class FakeClock:
+    """Монотонные часы, которые двигает только тест"""
+
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr("llm_resilience.time.monotonic", fake.monotonic)
+    return fake
+
+
+def test_attempts_receive_remaining_deadline(clock):
+    resilience = LLMResilience(deadline=20.0, backoff_base=1.0, backoff_max=1.0, sleep=clock.sleep)
+    seen = []
+
+    def attempt(remaining: float) -> str:
+        seen.append(remaining)
+        if len(seen) < 3:
+            # Попытка «висит» до своего таймаута
+            clock.now += min(8.0, remaining)
+            raise requests.exceptions.ReadTimeout("slow provider")
+        return "ok"
+
+    assert resilience.call("https://llm.example/v1", attempt) == "ok"
+    assert seen[0] == 20.0
+    assert all(later < earlier for earlier, later in zip(seen, seen[1:]))
+    assert all(0 < remaining <= 20.0 for remaining in seen)
+
+
+def test_attempt_never_outlives_deadline(clock, monkeypatch):
+    transport = LLMTransport(
+        read_timeout=120.0,
+        resilience=LLMResilience(deadline=5.0, backoff_base=0.5, backoff_max=0.5, sleep=clock.sleep),
+    )
+    timeouts = []
+
+    def slow_post(url, headers, json, timeout, stream):
+        timeouts.append(timeout)
+        clock.now += timeout[1]
+        raise requests.exceptions.ReadTimeout("slow provider")
+
+    monkeypatch.setattr(transport.session, "post", slow_post)
+    with pytest.raises((requests.exceptions.ReadTimeout, LLMCallError)):
+        transport.post_json("https://llm.example/v1", {}, {"model": "m"})
+
+    assert timeouts[0] == (5.0, 5.0)
+    assert all(read <= 5.0 for _, read in timeouts)
+    assert clock.now - 1000.0 <= 5.0
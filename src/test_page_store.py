@@ -0,0 +1,180 @@
+# test_page_store.py - Итоги обходов PageStore и фиксация базовой версии
+#
+# Запуск: python -m pytest -q test_page_store.py
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawler import SiteCrawler
+from page_store import PageStore, store_db
+
+SITE = "https://shop.example"
+
+
+@pytest.fixture
+def store(tmp_path):
+    page_store = PageStore(str(tmp_path / "page_snapshots.db"))
+    yield page_store
+    store_db.close()
+
+
+def record_run(store: PageStore, pages, failed=()):
+    """Обход без сети: pages — URL -> тело, failed — URL с временной ошибкой"""
+    store.begin_run()
+    for url, text in pages.items():
+        store.save(url, text, url, "text/html")
+    for url in failed:
+        store.mark_failed(url)
+    return store.changes()
+
+
+def counts(report):
+    return {state: len(urls) for state, urls in report.items() if urls}
+
+
+def test_unchanged_changed_and_failed_pages(store):
+    home, catalog, cart = f"{SITE}/", f"{SITE}/catalog", f"{SITE}/cart"
+    first = record_run(store, {home: "home v1", catalog: "catalog v1", cart: "cart v1"})
+    assert first["new"] == [home, cart, catalog]
+    store.commit_baseline()
+
+    report = record_run(store, {home: "home v1", catalog: "catalog v2"}, failed=[cart])
+    assert report == {
+        "new": [],
+        "changed": [catalog],
+        "unchanged": [home],
+        "removed": [],
+        "unreachable": [cart],
+    }
+    assert store.has_changes()
+
+    # Недоступная страница без других изменений не запускает анализ
+    assert not record_run(store, {home: "home v1", catalog: "catalog v1"}, failed=[cart])["removed"]
+    assert not store.has_changes()
+
+
+def test_baseline_moves_only_after_commit(store):
+    home, catalog = f"{SITE}/", f"{SITE}/catalog"
+    record_run(store, {home: "home v1", catalog: "catalog v1"})
+    store.commit_baseline()
+
+    # Анализ упал: commit_baseline не вызван, изменение видно и в следующем обходе
+    assert record_run(store, {home: "home v1", catalog: "catalog v2"})["changed"] == [catalog]
+    assert record_run(store, {home: "home v1", catalog: "catalog v2"})["changed"] == [catalog]
+
+    store.commit_baseline()
+    report = record_run(store, {home: "home v1", catalog: "catalog v2"})
+    assert report["changed"] == []
+    assert report["unchanged"] == [home, catalog]
+    assert not store.has_changes()
+
+
+def test_failed_page_leaves_baseline_but_keeps_snapshot(store):
+    home, cart = f"{SITE}/", f"{SITE}/cart"
+    record_run(store, {home: "home v1", cart: "cart v1"})
+    store.commit_baseline()
+
+    record_run(store, {home: "home v1"}, failed=[cart])
+    store.commit_baseline()
+    assert store.load(cart).text == "cart v1"
+
+    # Страница не вошла в анализ — когда она снова скачается, это новая страница
+    report = record_run(store, {home: "home v1", cart: "cart v1"})
+    assert report["new"] == [cart]
+    assert store.has_changes()
+
+
+def test_removed_and_truncated_runs(store):
+    home, old = f"{SITE}/", f"{SITE}/old"
+    record_run(store, {home: "home v1", old: "old v1", "https://other.example/": "other"})
+    store.commit_baseline()
+
+    store.begin_run()
+    store.save(home, "home v1", home, "text/html")
+    store.mark_truncated()
+    assert store.changes()["removed"] == []
+
+    # Страницы другого хоста не обходились — они не удалены
+    assert record_run(store, {home: "home v1"})["removed"] == [old]
+    store.commit_baseline()
+    assert store.load(old) is None
+    assert store.get_info()["snapshots"] == 2
+
+
+# ==================== Обход с сервером ====================
+
+class Site(BaseHTTPRequestHandler):
+    """Сайт из трёх страниц: тела и сбои задаются полями класса"""
+
+    protocol_version = "HTTP/1.1"
+    bodies = {}
+    failing = set()
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _reply(self, status: int, body: bytes = b"", headers=()) -> None:
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path in self.failing:
+            return self._reply(503)
+        if self.path not in self.bodies:
+            return self._reply(404)
+        body = self.bodies[self.path].encode("utf-8")
+        etag = f'"{hash(body) & 0xffffffff:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._reply(304, headers=[("ETag", etag)])
+        self._reply(200, body, [("Content-Type", "text/html; charset=utf-8"), ("ETag", etag)])
+
+
+@pytest.fixture
+def site():
+    links = '<a href="/catalog">Каталог</a><a href="/cart">Корзина</a>'
+    Site.bodies = {"/": f"<html><body>{links}</body></html>", "/catalog": "<p>v1</p>", "/cart": "<p>cart</p>"}
+    Site.failing = set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawler_runs_against_baseline(store, site):
+    crawler = SiteCrawler(max_depth=1, respect_robots=False, store=store)
+
+    list(crawler.crawl([f"{site}/"]))
+    assert counts(store.changes()) == {"new": 3}
+    store.commit_baseline()
+
+    # Без изменений: все страницы отвечают 304 и берутся из хранилища
+    list(crawler.crawl([f"{site}/"]))
+    assert counts(store.changes()) == {"unchanged": 3}
+    assert store.not_modified == 3
+    assert not store.has_changes()
+
+    # Изменилось тело каталога, корзина временно недоступна
+    Site.bodies["/catalog"] = "<p>v2</p>"
+    Site.failing = {"/cart"}
+    list(crawler.crawl([f"{site}/"]))
+    report = store.changes()
+    assert report["changed"] == [f"{site}/catalog"]
+    assert report["unreachable"] == [f"{site}/cart"]
+    assert report["removed"] == []
+
+    # Анализ не зафиксирован — следующий обход снова видит изменение
+    Site.failing = set()
+    list(crawler.crawl([f"{site}/"]))
+    assert store.changes()["changed"] == [f"{site}/catalog"]
+    store.commit_baseline()
+
+    list(crawler.crawl([f"{site}/"]))
+    assert counts(store.changes()) == {"unchanged": 3}
@@ -0,0 +1,196 @@
+# test_tree_sharding.py - Разбиение DOM на части и слияние поддеревьев ShardedTreeGenerator
+#
+# Запуск: python -m pytest -q test_tree_sharding.py
+
+import json
+import random
+from types import SimpleNamespace
+
+from tree_sharding import ShardedTreeGenerator, _size, _split_tree
+
+MAX_CHARS = 4000
+
+
+def make_sharded(max_chars: int = MAX_CHARS) -> ShardedTreeGenerator:
+    return ShardedTreeGenerator(SimpleNamespace(base_url="https://llm.example/v1"), max_chars=max_chars)
+
+
+def collect(task, found):
+    found.append(task)
+    for child in task["children"]:
+        collect(child, found)
+    return found
+
+
+# ==================== Слияние ====================
+
+def shard_trees():
+    nav = {
+        "task_id": "open_catalog",
+        "task_name": "Открыть каталог",
+        "aliases": ["каталог"],
+        "actions": [{"type": "click", "selector": "a.nav__catalog"}],
+        "children": [],
+    }
+    return [
+        # Общие блоки: навигация
+        {
+            "task_tree_version": "1.0",
+            "application": "EcoStore",
+            "root_task": {"task_id": "root", "task_name": "Главная EcoStore", "children": [nav]},
+        },
+        # Страницы каталога: та же задача по task_id, новые действия и алиасы
+        {
+            "task_tree_version": "1.0",
+            "application": "Другое название",
+            "root_task": {
+                "task_id": "root",
+                "task_name": "Главная",
+                "description": "Магазин экотоваров",
+                "children": [
+                    {
+                        **nav,
+                        "aliases": ["каталог", "товары"],
+                        "actions": nav["actions"] + [{"type": "scroll", "selector": ".catalog"}],
+                        "children": [{"task_id": "add_to_cart", "task_name": "Добавить в корзину"}],
+                    },
+                    {"task_id": "add_to_cart", "task_name": "Оформить заказ"},
+                ],
+            },
+        },
+        # Часть без общего корня: та же задача по названию, другой task_id
+        {
+            "root_task": {
+                "task_id": "catalog_section",
+                "task_name": "Открыть  каталог!",
+                "aliases": ["ассортимент"],
+                "actions": [{"type": "click", "selector": "a.nav__catalog"}],
+                "children": [{"task_id": "add_to_cart", "task_name": "Добавить в корзину"}],
+            },
+        },
+    ]
+
+
+def test_merge_builds_single_root_with_merged_tasks():
+    sharded = make_sharded()
+    tree = sharded.merge(shard_trees())
+    root = tree["root_task"]
+
+    assert tree["task_tree_version"] == "1.0"
+    assert tree["application"] == "EcoStore"
+    assert root["task_id"] == "root"
+    assert root["task_name"] == "Главная EcoStore"
+    assert root["description"] == "Магазин экотоваров"
+
+    catalog = [t for t in root["children"] if t["task_id"] == "open_catalog"]
+    assert len(catalog) == 1
+    assert catalog[0]["aliases"] == ["каталог", "товары", "ассортимент"]
+    assert catalog[0]["actions"] == [
+        {"type": "click", "selector": "a.nav__catalog"},
+        {"type": "scroll", "selector": ".catalog"},
+    ]
+    assert [t["task_name"] for t in catalog[0]["children"]] == ["Добавить в корзину"]
+    assert [t["task_name"] for t in root["children"]] == ["Открыть каталог", "Оформить заказ"]
+
+
+def test_merge_makes_task_ids_unique():
+    sharded = make_sharded()
+    tree = sharded.merge(shard_trees())
+    tasks = collect(tree["root_task"], [])
+    ids = [t["task_id"] for t in tasks]
+
+    assert len(ids) == len(set(ids))
+    assert sorted(ids) == ["add_to_cart", "add_to_cart_2", "open_catalog", "root"]
+    assert sharded.tasks == len(tasks)
+    assert all(isinstance(t["children"], list) for t in tasks)
+
+
+def test_merge_does_not_mutate_shard_trees():
+    trees = shard_trees()
+    before = json.dumps(trees, ensure_ascii=False, sort_keys=True)
+    make_sharded().merge(trees)
+
+    assert json.dumps(trees, ensure_ascii=False, sort_keys=True) == before
+
+
+# ==================== Разбиение ====================
+
+def random_tree(rnd: random.Random, depth: int) -> dict:
+    if depth == 0:
+        return {"tag": "a", "attrs": {"href": f"/item/{rnd.randrange(10 ** 6)}"}, "text": "товар " * rnd.randrange(1, 8)}
+    return {
+        "tag": rnd.choice(["div", "section", "ul", "form"]),
+        "attrs": {"class": f"block-{rnd.randrange(1000)}"},
+        "children": [random_tree(rnd, depth - 1) for _ in range(rnd.randrange(1, 4))],
+    }
+
+
+def deep_tree(depth: int, attr_size: int) -> dict:
+    """Цепочка узлов с крупными атрибутами: на глубине budget - overhead уходит в минус"""
+    node = {"tag": "button", "text": "Купить"}
+    for level in range(depth):
+        node = {"tag": "div", "attrs": {"data-state": f"{level}:" + "x" * attr_size}, "children": [node, dict(node)]}
+    return node
+
+
+def large_dom() -> dict:
+    rnd = random.Random(7)
+    nav = {"tag": "nav", "children": [{"tag": "a", "attrs": {"href": f"/s{i}"}, "text": f"Раздел {i}"} for i in range(400)]}
+    return {
+        "legend": "Сжатое дерево DOM",
+        "analyzedAt": "2025-12-03T16:46:44.756Z",
+        "summary": {"totalPages": 62},
+        "shared": {"s1": nav},
+        "templates": {"t1": {"tag": "li", "children": [{"template": "t2"}]}, "t2": {"tag": "a", "text": "карточка"}},
+        "pages": [
+            {"files": [f"p{i}.html"], "count": 1, "titles": [f"Страница {i}"], "tree": random_tree(rnd, 5)}
+            for i in range(60)
+        ]
+        + [
+            {"files": ["templated.html"], "count": 1, "titles": ["Шаблон"], "tree": {"tag": "ul", "children": [{"template": "t1", "count": 40}]}},
+            {"files": ["deep.html"], "count": 1, "titles": ["Глубокая"], "tree": deep_tree(depth=9, attr_size=300)},
+        ],
+    }
+
+
+def test_partition_respects_max_chars():
+    dom = large_dom()
+    shards = make_sharded().partition(dom)
+
+    assert len(shards) > 3
+    assert all(_size(shard) <= MAX_CHARS for shard in shards)
+    assert [s["shard"]["index"] for s in shards] == list(range(1, len(shards) + 1))
+    assert all(s["shard"]["total"] == len(shards) for s in shards)
+    assert shards[0]["shard"]["scope"] == "shared"
+
+    files = {f for s in shards for page in s.get("pages", []) for f in page["files"]}
+    assert files == {f for page in dom["pages"] for f in page["files"]}
+
+    templated = [s for s in shards for page in s.get("pages", []) if page["files"] == ["templated.html"]]
+    assert set(templated[0]["templates"]) == {"t1", "t2"}
+
+
+def test_partition_splits_raw_results():
+    rnd = random.Random(3)
+    dom = {
+        "summary": {"totalPages": 2},
+        "results": [
+            {"file": "a.html", "domTree": random_tree(rnd, 7)},
+            {"file": "b.html", "domTree": deep_tree(depth=10, attr_size=250)},
+        ],
+    }
+    shards = make_sharded().partition(dom)
+    parts = [page["part"] for s in shards for page in s["results"] if page["file"] == "b.html"]
+
+    assert all(_size(shard) <= MAX_CHARS for shard in shards)
+    assert len(parts) > 1 and parts[-1] == f"{len(parts)}/{len(parts)}"
+
+
+def test_split_tree_with_no_room_for_children():
+    tree = deep_tree(depth=12, attr_size=200)
+    budget = 700
+    pieces = _split_tree(tree, budget)
+
+    assert all(_size(piece) <= budget for piece in pieces)
+    # Ни одна кнопка не потерялась и не продублировалась
+    assert sum(json.dumps(piece).count('"button"') for piece in pieces) == 2 ** 12
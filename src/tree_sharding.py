@@ -0,0 +1,384 @@
+# tree_sharding.py - Генерация дерева задач по частям (map-reduce) для больших сайтов
+#
+# Один вызов LLM на весь сайт упирается в контекст модели и таймаут чтения.
+# Здесь анализ DOM (сжатый dom_compactor.py или полный) делится на части
+# ограниченного размера: общие блоки (навигация, шапка, подвал) — отдельно,
+# группы страниц — по порядку, слишком большие страницы — по разделам.
+# Поддеревья генерируются параллельно и сливаются в один root_task.
+
+import copy
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from action_tree_generator import ActionTreeGenerator
+from intent_extracter import get_provider_semaphore
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер JSON одной части, символов (кириллица — около 2 символов на токен)
+TREE_SHARD_MAX_CHARS: int = int(os.getenv("TREE_SHARD_MAX_CHARS", "60000"))
+
+SHARD_PROMPT: str = """
+
+Входной JSON — только часть сайта: поле shard (index из total). Построй дерево задач
+только для этой части в той же схеме. Если shard.scope = "shared", это общие для всех
+страниц блоки (навигация, шапка, подвал) — опиши задачи, доступные с любой страницы.
+Иначе ссылки {"shared": ...} описаны в другой части — не создавай для них задачи.
+Если у страницы есть поле part, это фрагмент большой страницы."""
+
+
+# ==================== Разбиение ====================
+
+def _size(value: Any) -> int:
+    return len(json.dumps(value, ensure_ascii=False))
+
+
+def _template_refs(value: Any, found: Set[str]) -> None:
+    if isinstance(value, dict):
+        if "template" in value:
+            found.add(value["template"])
+        for child in value.get("children", ()):
+            _template_refs(child, found)
+
+
+def _split_tree(node: Dict[str, Any], budget: int) -> List[Dict[str, Any]]:
+    """
+    Делит узел по потомкам на копии не больше budget символов
+
+    Каждая копия сохраняет узел-предка со своей частью потомков. Если сам
+    узел без потомков не оставляет места для них, потомки делятся отдельно
+    от него; лист больше budget остаётся целым.
+    """
+    if _size(node) <= budget or not node.get("children"):
+        return [node]
+    overhead: int = _size({**node, "children": []})
+    # Запятая между потомками — +1 символ на каждый
+    child_budget: int = budget - overhead - 1
+    if child_budget <= 0:
+        pieces: List[Dict[str, Any]] = [{**node, "children": []}]
+        for child in node["children"]:
+            pieces.extend(_split_tree(child, budget))
+        return pieces
+
+    pieces = []
+    current: List[Dict[str, Any]] = []
+    current_size: int = overhead
+    for child in node["children"]:
+        for piece in _split_tree(child, child_budget):
+            piece_size = _size(piece) + 1
+            # Неделимый лист или отделённый от потомков узел не помещается под предком
+            standalone: bool = overhead + piece_size > budget
+            if current and (standalone or current_size + piece_size > budget):
+                pieces.append({**node, "children": current})
+                current, current_size = [], overhead
+            if standalone:
+                pieces.append(piece)
+                continue
+            current.append(piece)
+            current_size += piece_size
+    if current:
+        pieces.append({**node, "children": current})
+    return pieces
+
+
+class ShardedTreeGenerator:
+    """
+    Генерация дерева задач по частям анализа DOM.
+
+    map: каждая часть отправляется в ActionTreeGenerator отдельным запросом
+    (параллельно, с общим лимитом запросов к провайдеру; неизменившиеся
+    части берутся из кэша ответов LLM). reduce: поддеревья сливаются в один
+    root_task — задачи с одинаковым task_id или названием объединяются,
+    оставшиеся повторы task_id получают суффикс.
+
+    Пример использования:
+        sharded = ShardedTreeGenerator(gen, max_chars=60000, workers=4)
+        tasks_tree = sharded.generate(compacted_dom, system_prompt)
+    """
+
+    def __init__(
+        self,
+        gen: ActionTreeGenerator,
+        max_chars: int = TREE_SHARD_MAX_CHARS,
+        workers: int = 4,
+        max_concurrency: int = 4,
+    ) -> None:
+        """
+        Args:
+            gen: Генератор, выполняющий запросы к LLM (ActionTreeGenerator)
+            max_chars: Максимальный размер JSON одной части, символов (int)
+            workers: Параллельные запросы частей (int)
+            max_concurrency: Лимит одновременных запросов к провайдеру (int)
+        """
+        self.gen: ActionTreeGenerator = gen
+        self.max_chars: int = max_chars
+        self.workers: int = max(1, workers)
+        self.semaphore = get_provider_semaphore(gen.base_url, max_concurrency)
+
+        # Статистика последней генерации
+        self.shards: int = 0
+        self.failed: int = 0
+        self.largest_shard: int = 0
+        self.tasks: int = 0
+
+    # ---------- Разбиение (приватные) ----------
+
+    def _units(self, dom: Dict[str, Any]) -> Tuple[List[Tuple[str, Dict[str, Any]]], str]:
+        """Единицы разбиения: (scope, элемент) — общие блоки и страницы; и ключ списка страниц"""
+        budget: int = self.max_chars // 2
+        units: List[Tuple[str, Dict[str, Any]]] = []
+
+        if "pages" in dom:
+            for shared_id, block in dom.get("shared", {}).items():
+                for piece in _split_tree(block, budget):
+                    units.append(("shared", {"shared_id": shared_id, "tree": piece}))
+            pages_key, tree_key = "pages", "tree"
+        else:
+            pages_key, tree_key = "results", "domTree"
+
+        for page in dom.get(pages_key, []):
+            tree = page.get(tree_key)
+            pieces = _split_tree(tree, budget) if tree else [tree]
+            for number, piece in enumerate(pieces, 1):
+                unit = {**page, tree_key: piece}
+                if len(pieces) > 1:
+                    unit["part"] = f"{number}/{len(pieces)}"
+                units.append(("pages", unit))
+        return units, pages_key
+
+    def partition(self, dom: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Делит анализ DOM на части не больше max_chars (кроме неделимых элементов)
+
+        Args:
+            dom: Сжатый (dom_compactor) или полный dom_analysis (Dict[str, Any])
+
+        Returns:
+            Части в формате входа: legend/summary/templates/pages или results (List[Dict[str, Any]])
+        """
+        units, pages_key = self._units(dom)
+        templates: Dict[str, Any] = dom.get("templates", {})
+        base: Dict[str, Any] = {key: dom[key] for key in ("legend", "analyzedAt", "summary") if key in dom}
+        base_size: int = _size(base) + 200
+
+        shards: List[Dict[str, Any]] = []
+        current: Optional[Dict[str, Any]] = None
+        current_size: int = 0
+
+        for scope, unit in units:
+            # Шаблоны, на которые ссылается элемент (включая вложенные в шаблоны)
+            refs: Set[str] = set()
+            _template_refs(unit.get("tree") or unit.get("domTree"), refs)
+            pending = list(refs)
+            while pending:
+                nested: Set[str] = set()
+                _template_refs(templates.get(pending.pop(), {}), nested)
+                pending.extend(nested - refs)
+                refs |= nested
+
+            if current is not None:
+                new_templates = {t: templates[t] for t in refs if t in templates and t not in current["templates"]}
+                unit_size = _size(unit) + _size(new_templates)
+            if current is None or current["shard"]["scope"] != scope or current_size + unit_size > self.max_chars:
+                current = {**base, "shard": {"scope": scope}, "templates": {}, "shared": {}, pages_key: []}
+                shards.append(current)
+                current_size = base_size
+                new_templates = {t: templates[t] for t in refs if t in templates}
+                unit_size = _size(unit) + _size(new_templates)
+
+            current["templates"].update(new_templates)
+            if scope == "shared":
+                current["shared"].setdefault(unit["shared_id"], []).append(unit["tree"])
+            else:
+                current[pages_key].append(unit)
+            current_size += unit_size
+
+        for index, shard in enumerate(shards, 1):
+            shard["shard"].update(index=index, total=len(shards))
+            for key in ("templates", "shared"):
+                if not shard[key]:
+                    del shard[key]
+            if "shared" in shard:
+                shard["shared"] = {
+                    shared_id: pieces[0] if len(pieces) == 1 else pieces
+                    for shared_id, pieces in shard["shared"].items()
+                }
+        return shards
+
+    # ---------- Слияние (приватные) ----------
+
+    @staticmethod
+    def _name_key(task: Dict[str, Any]) -> str:
+        return re.sub(r"\W+", " ", str(task.get("task_name", "")).lower()).strip()
+
+    def _merge_task(self, target: Dict[str, Any], task: Dict[str, Any]) -> None:
+        """Объединяет одну и ту же задачу из разных частей"""
+        if not target.get("description") and task.get("description"):
+            target["description"] = task["description"]
+        aliases: List[str] = list(target.get("aliases") or [])
+        for alias in task.get("aliases") or []:
+            if alias not in aliases:
+                aliases.append(alias)
+        if aliases:
+            target["aliases"] = aliases
+        actions: List[Dict[str, Any]] = list(target.get("actions") or [])
+        known = {json.dumps(a, ensure_ascii=False, sort_keys=True) for a in actions}
+        for action in task.get("actions") or []:
+            key = json.dumps(action, ensure_ascii=False, sort_keys=True)
+            if key not in known:
+                known.add(key)
+                actions.append(action)
+        target["actions"] = actions
+        target["children"] = self._merge_children(target.get("children") or [], task.get("children") or [])
+
+    def _merge_children(self, target: List[Dict[str, Any]], incoming: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        by_id: Dict[str, Dict[str, Any]] = {t.get("task_id"): t for t in target if t.get("task_id")}
+        by_name: Dict[str, Dict[str, Any]] = {self._name_key(t): t for t in target if self._name_key(t)}
+        for task in incoming:
+            if not isinstance(task, dict):
+                continue
+            existing = by_id.get(task.get("task_id")) or by_name.get(self._name_key(task))
+            if existing is not None:
+                self._merge_task(existing, task)
+                continue
+            task = copy.deepcopy(task)
+            task.setdefault("children", [])
+            target.append(task)
+            if task.get("task_id"):
+                by_id[task["task_id"]] = task
+            if self._name_key(task):
+                by_name[self._name_key(task)] = task
+        return target
+
+    @staticmethod
+    def _unique_ids(root: Dict[str, Any]) -> int:
+        """Делает task_id уникальными во всём дереве; возвращает число задач"""
+        seen: Set[str] = set()
+        count = 0
+        stack = [root]
+        while stack:
+            task = stack.pop()
+            count += 1
+            task_id: str = str(task.get("task_id") or f"task_{count}")
+            if task_id in seen:
+                suffix = 2
+                while f"{task_id}_{suffix}" in seen:
+                    suffix += 1
+                task_id = f"{task_id}_{suffix}"
+            seen.add(task_id)
+            task["task_id"] = task_id
+            task.setdefault("children", [])
+            stack.extend(reversed(task["children"]))
+        return count
+
+    def merge(self, trees: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Сливает деревья частей в одно дерево задач
+
+        Корни частей с task_id "root" растворяются в общем корне,
+        остальные становятся его потомками.
+
+        Args:
+            trees: Деревья задач частей по порядку частей (List[Dict[str, Any]])
+
+        Returns:
+            Дерево задач {"task_tree_version", "root_task", ...} (Dict[str, Any])
+        """
+        root: Dict[str, Any] = {
+            "task_id": "root",
+            "task_name": "Главная страница",
+            "description": "",
+            "aliases": [],
+            "actions": [],
+            "children": [],
+        }
+        merged: Dict[str, Any] = {"task_tree_version": "1.0"}
+        named: bool = False
+
+        for tree in trees:
+            for key, value in tree.items():
+                if key != "root_task":
+                    merged.setdefault(key, value)
+            shard_root = tree.get("root_task")
+            if not isinstance(shard_root, dict):
+                continue
+            if shard_root.get("task_id") == "root":
+                if not named and shard_root.get("task_name"):
+                    root["task_name"] = shard_root["task_name"]
+                    named = True
+                self._merge_task(root, {**shard_root, "task_name": root["task_name"]})
+            else:
+                self._merge_children(root["children"], [shard_root])
+
+        self.tasks = self._unique_ids(root)
+        merged["root_task"] = root
+        return merged
+
+    # ---------- Публичные методы ----------
+
+    def generate(self, dom: Dict[str, Any], system_prompt: str) -> Dict[str, Any]:
+        """
+        Дерево задач по частям
+
+        Args:
+            dom: Сжатый или полный dom_analysis (Dict[str, Any])
+            system_prompt: Системный промпт генерации дерева (str)
+
+        Returns:
+            Слитое дерево задач (Dict[str, Any])
+
+        Raises:
+            RuntimeError: Если не удалось сгенерировать ни одной части
+        """
+        shards: List[Dict[str, Any]] = self.partition(dom)
+        self.shards = len(shards)
+        self.largest_shard = max((_size(s) for s in shards), default=0)
+        logger.info(
+            f"🧩 Tasks tree: {len(shards)} shards (max {self.max_chars} chars, "
+            f"largest {self.largest_shard}), {self.workers} workers"
+        )
+        prompt: str = system_prompt + SHARD_PROMPT
+
+        def generate_shard(shard: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            index = shard["shard"]["index"]
+            try:
+                with self.semaphore:
+                    tree = self.gen.generate_dict(shard, prompt, verbose=False)
+                logger.info(f"✓ Shard {index}/{len(shards)} ({shard['shard']['scope']})")
+                return tree
+            except Exception as e:
+                logger.warning(f"⚠️ Shard {index}/{len(shards)} failed: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(generate_shard, shards))
+
+        trees: List[Dict[str, Any]] = [tree for tree in results if isinstance(tree, dict)]
+        self.failed = len(shards) - len(trees)
+        if not trees:
+            raise RuntimeError(f"All {len(shards)} tasks tree shards failed")
+        if self.failed:
+            logger.warning(f"⚠️ Tasks tree is partial: {self.failed} of {len(shards)} shards failed")
+
+        tasks_tree: Dict[str, Any] = self.merge(trees)
+        logger.info(f"✅ Tasks tree merged: {self.tasks} tasks from {len(trees)} shards")
+        return tasks_tree
+
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Статистика последней генерации
+
+        Returns:
+            Число частей, неудачных частей, размер наибольшей и задач в дереве (Dict[str, Any])
+        """
+        return {
+            "shards": self.shards,
+            "failed": self.failed,
+            "largest_shard_chars": self.largest_shard,
+            "max_chars": self.max_chars,
+            "tasks": self.tasks,
+        }